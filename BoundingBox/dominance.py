@@ -0,0 +1,110 @@
+import numpy as np
+import time
+
+
+def is_pareto_point(pareto_set, point):
+    '''
+    reference loop of optimize_design.is_pareto (maximizing)
+    '''
+    costs = np.vstack((point, pareto_set))
+    is_efficient = np.ones(costs.shape[0], dtype=bool)
+    for i, c in enumerate(costs):
+        if is_efficient[i]:
+            is_efficient[is_efficient] = np.any(costs[is_efficient] > c, axis=1)
+            is_efficient[i] = True
+    return is_efficient[0]
+
+
+def pareto_sample_mask(samples, pareto_set, max_elements=2 ** 24):
+    '''
+    samples : [num_objectives, n_samples, mc_samples] GP samples of every candidate
+    pareto_set : [n_pareto, num_objectives]
+    returns [n_samples, mc_samples] bool, True where is_pareto_point is True for the sample.
+
+    a sample is on the front unless some point of pareto_set is >= in every objective and > in one,
+    so all candidates x samples x front points are compared in one broadcast.
+    candidates are processed in chunks so that a chunk holds at most max_elements comparisons.
+    '''
+    num_objectives, n_samples, mc_samples = samples.shape
+    pareto_set = np.asarray(pareto_set, dtype=float).reshape(-1, num_objectives)
+    mask = np.ones((n_samples, mc_samples), dtype=bool)
+    if pareto_set.shape[0] == 0:
+        return mask
+
+    y = np.moveaxis(samples, 0, -1)  # [n_samples, mc_samples, num_objectives]
+    front = pareto_set[np.newaxis, np.newaxis]  # [1, 1, n_pareto, num_objectives]
+    chunk = max(1, max_elements // (mc_samples * pareto_set.shape[0] * num_objectives))
+    for start in range(0, n_samples, chunk):
+        y_chunk = y[start:start + chunk, :, np.newaxis, :]
+        dominated = np.logical_and(np.all(front >= y_chunk, axis=3), np.any(front > y_chunk, axis=3))
+        mask[start:start + chunk] = np.logical_not(np.any(dominated, axis=2))
+    return mask
+
+
+def count_pareto_samples(samples, pareto_set, max_elements=2 ** 24):
+    '''
+    returns [n_samples] the number of MC samples of each candidate for which is_pareto_point is True
+    '''
+    return np.sum(pareto_sample_mask(samples, pareto_set, max_elements), axis=1)
+
+
+def dominated_by_sample(samples, point_samples):
+    '''
+    samples : [num_objectives, n_samples, mc_samples], point_samples : [num_objectives, mc_samples]
+    returns [n_samples, mc_samples] bool, True where sample m of a candidate is dominated by sample m of the point,
+    i.e. where the candidate would leave the front if the point were observed with its m-th sample as value
+    '''
+    point = np.asarray(point_samples)[:, np.newaxis, :]
+    return np.logical_and(np.all(point >= samples, axis=0), np.any(point > samples, axis=0))
+
+
+def count_pareto_samples_loop(samples, pareto_set):
+    num_objectives, n_samples, mc_samples = samples.shape
+    n_pareto = np.zeros(n_samples, dtype=int)
+    for idx in range(n_samples):
+        for y_idx in range(mc_samples):
+            if is_pareto_point(pareto_set, samples[:, idx, y_idx]):
+                n_pareto[idx] += 1
+    return n_pareto
+
+
+if __name__ == '__main__':
+    # agreement with the loop, including ties and dominated points in the reference set
+    for trial in range(20):
+        samples = np.random.randint(0, 5, size=(2, 30, 10)).astype(float)
+        pareto_set = np.random.randint(0, 5, size=(np.random.randint(1, 8), 2)).astype(float)
+        assert (count_pareto_samples(samples, pareto_set, max_elements=50)
+                == count_pareto_samples_loop(samples, pareto_set)).all()
+    print("vectorized counts agree with is_pareto")
+
+    # a fantasized point removes exactly the samples it dominates
+    for trial in range(20):
+        samples = np.random.randint(0, 5, size=(2, 30, 10)).astype(float)
+        pareto_set = np.random.randint(0, 5, size=(np.random.randint(1, 8), 2)).astype(float)
+        point_samples = np.random.randint(0, 5, size=(2, 10)).astype(float)
+        mask = np.logical_and(pareto_sample_mask(samples, pareto_set),
+                              np.logical_not(dominated_by_sample(samples, point_samples)))
+        for m in range(10):
+            front_m = np.vstack((pareto_set, point_samples[:, m]))
+            assert (mask[:, m] == [is_pareto_point(front_m, samples[:, idx, m]) for idx in range(30)]).all()
+    print("fantasized fronts agree with is_pareto")
+
+    def front(n):
+        x = np.sort(np.random.uniform(0, 1, n))
+        return np.vstack((x, np.sqrt(1 - x ** 2))).T
+
+    print("%10s %10s %10s %12s %12s" % ("n_samples", "mc", "front", "loop [s]", "vector [s]"))
+    for n_samples, mc_samples, n_front in [(100, 100, 10), (1000, 100, 10), (1000, 100, 50),
+                                           (1000, 100, 200), (4000, 100, 50), (1000, 400, 50)]:
+        samples = np.random.uniform(0, 1.2, size=(2, n_samples, mc_samples))
+        pareto_set = front(n_front)
+        start = time.time()
+        count_pareto_samples(samples, pareto_set)
+        t_vec = time.time() - start
+        t_loop = float('nan')
+        if n_samples * mc_samples <= 100000:
+            sub = samples[:, :max(1, n_samples // 10)]
+            start = time.time()
+            count_pareto_samples_loop(sub, pareto_set)
+            t_loop = (time.time() - start) * n_samples / sub.shape[1]
+        print("%10d %10d %10d %12.3f %12.4f" % (n_samples, mc_samples, n_front, t_loop, t_vec))
@@ -0,0 +1,239 @@
+"""Interval-overlap masks of boxes: the not_overlapped mask of Observations without the triple loop"""
+
+import numpy as np
+import time
+
+
+def overlap_mask_bruteforce(lower_bounds, upper_bounds):
+    '''
+    the loop of Observations.is_overlap, kept as the reference of overlap_mask and OverlapCounter
+    '''
+    num_candidates, num_functions = lower_bounds.shape
+    not_overlapped = np.ones(num_candidates, dtype=bool)
+    for i in range(num_candidates):
+        l_ = lower_bounds[i]
+        u_ = upper_bounds[i]
+        for idx in range(num_candidates):
+            if idx != i:
+                for func_idx in range(num_functions):
+                    l_idx = lower_bounds[idx]
+                    u_idx = upper_bounds[idx]
+                    if l_[func_idx] < l_idx[func_idx] < u_[func_idx] or \
+                            l_[func_idx] < u_idx[func_idx] < u_[func_idx] or \
+                            (l_idx[func_idx] <= l_[func_idx] and u_idx[func_idx] >= u_[func_idx]):
+                        not_overlapped[idx] = False
+                        break
+    return not_overlapped
+
+
+def overlaps(l_, u_, lower_bounds, upper_bounds):
+    '''
+    l_, u_ : [..., num_objectives] boxes i, lower_bounds, upper_bounds : [..., num_objectives] boxes idx
+    returns [...] bool, True where box i marks box idx as overlapped in the loop: in some objective a bound of idx
+    lies strictly inside the interval of i, or the interval of idx contains the one of i
+    '''
+    return np.any(((l_ < lower_bounds) & (lower_bounds < u_)) |
+                  ((l_ < upper_bounds) & (upper_bounds < u_)) |
+                  ((lower_bounds <= l_) & (upper_bounds >= u_)), axis=-1)
+
+
+def overlap_mask_broadcast(lower_bounds, upper_bounds, max_elements=2 ** 24):
+    '''
+    all pairs compared in one broadcast, the boxes i processed in chunks of at most max_elements comparisons
+    '''
+    num_candidates, num_objectives = lower_bounds.shape
+    overlapped = np.zeros(num_candidates, dtype=bool)
+    chunk = max(1, max_elements // max(1, num_candidates * num_objectives))
+    for start in range(0, num_candidates, chunk):
+        end = min(start + chunk, num_candidates)
+        pairs = overlaps(lower_bounds[start:end, np.newaxis], upper_bounds[start:end, np.newaxis],
+                         lower_bounds[np.newaxis], upper_bounds[np.newaxis])  # [chunk, num_candidates]
+        pairs[np.arange(end - start), np.arange(start, end)] = False
+        overlapped |= np.any(pairs, axis=0)
+    return ~overlapped
+
+
+def overlap_mask_sweep(lower_bounds, upper_bounds):
+    '''
+    O(n log n) per objective. the intervals are sorted by (lower, upper); a bound x of idx lies strictly inside
+    another interval iff the running max of the uppers of the intervals with lower < x exceeds x, and idx contains
+    another interval iff an interval of lower >= l_idx sorted before idx exists (its lower is l_idx and its upper is
+    <= u_idx) or the min of the uppers sorted after idx is <= u_idx
+    '''
+    num_candidates, num_objectives = lower_bounds.shape
+    overlapped = np.zeros(num_candidates, dtype=bool)
+    if num_candidates < 2:
+        return ~overlapped
+    for f in range(num_objectives):
+        l_, u_ = lower_bounds[:, f], upper_bounds[:, f]
+        order = np.lexsort((u_, l_))
+        l_sorted, u_sorted = l_[order], u_[order]
+        max_upper = np.maximum.accumulate(u_sorted)
+        min_upper_after = np.append(np.minimum.accumulate(u_sorted[::-1])[::-1][1:], np.inf)
+
+        for x in (l_, u_):
+            k = np.searchsorted(l_sorted, x, side='left')
+            overlapped |= (k > 0) & (max_upper[np.maximum(k - 1, 0)] > x)
+
+        position = np.empty(num_candidates, dtype=int)
+        position[order] = np.arange(num_candidates)
+        first = np.searchsorted(l_sorted, l_, side='left')
+        overlapped |= (first < position) | (min_upper_after[position] <= u_)
+    return ~overlapped
+
+
+def overlap_mask(lower_bounds, upper_bounds, sweep_threshold=64, max_elements=2 ** 24):
+    '''
+    the not_overlapped mask of Observations.is_overlap: broadcast below sweep_threshold boxes, sweep-line above
+    '''
+    lower_bounds = np.asarray(lower_bounds, dtype=float)
+    upper_bounds = np.asarray(upper_bounds, dtype=float)
+    if lower_bounds.shape[0] < sweep_threshold:
+        return overlap_mask_broadcast(lower_bounds, upper_bounds, max_elements)
+    return overlap_mask_sweep(lower_bounds, upper_bounds)
+
+
+class OverlapCounter:
+    '''
+    not_overlapped mask of the active boxes (the Pareto boxes in Observations.is_overlap_in_dominant), kept up to
+    date by counting for every active box the other active boxes that mark it as overlapped. inserting, updating,
+    activating or deactivating a box only compares it with the other boxes, O(n) instead of the O(n^2) of a full
+    recomputation. inactive boxes are reported as not overlapped, as in is_overlap_in_dominant
+    '''
+    def __init__(self, num_objectives):
+        self.num_objectives = num_objectives
+        self.clear()
+
+    def clear(self):
+        self.num_boxes = 0
+        self.lower = np.empty((16, self.num_objectives))
+        self.upper = np.empty((16, self.num_objectives))
+        self.active = np.zeros(16, dtype=bool)
+        self.count = np.zeros(16, dtype=int)
+        self.num_rechecks = 0
+
+    def __len__(self):
+        return self.num_boxes
+
+    def mask(self):
+        n = self.num_boxes
+        return ~self.active[:n] | (self.count[:n] == 0)
+
+    def insert(self, lower, upper, active=True):
+        '''
+        returns the index of the new box
+        '''
+        idx = self.num_boxes
+        if idx == self.lower.shape[0]:
+            self.lower = np.vstack((self.lower, np.empty_like(self.lower)))
+            self.upper = np.vstack((self.upper, np.empty_like(self.upper)))
+            self.active = np.hstack((self.active, np.zeros_like(self.active)))
+            self.count = np.hstack((self.count, np.zeros_like(self.count)))
+        self.num_boxes += 1
+        self.lower[idx] = lower
+        self.upper[idx] = upper
+        if active:
+            self._activate(idx)
+        return idx
+
+    def update(self, idx, lower, upper, active=True):
+        if self.active[idx]:
+            self._deactivate(idx)
+        self.lower[idx] = lower
+        self.upper[idx] = upper
+        if active:
+            self._activate(idx)
+
+    def sync(self, lower_bounds, upper_bounds, active=None):
+        '''
+        update the boxes that differ from the rows of lower_bounds, upper_bounds or changed activity and insert the
+        new rows; returns the not_overlapped mask
+        '''
+        lower_bounds = np.asarray(lower_bounds, dtype=float).reshape(-1, self.num_objectives)
+        upper_bounds = np.asarray(upper_bounds, dtype=float).reshape(-1, self.num_objectives)
+        if active is None:
+            active = np.ones(lower_bounds.shape[0], dtype=bool)
+        if lower_bounds.shape[0] < self.num_boxes:
+            self.clear()
+        n = self.num_boxes
+        changed = np.nonzero(np.any(self.lower[:n] != lower_bounds[:n], axis=1) |
+                             np.any(self.upper[:n] != upper_bounds[:n], axis=1) |
+                             (self.active[:n] != active[:n]))[0]
+        for idx in changed:
+            self.update(idx, lower_bounds[idx], upper_bounds[idx], active[idx])
+        for idx in range(n, lower_bounds.shape[0]):
+            self.insert(lower_bounds[idx], upper_bounds[idx], active[idx])
+        return self.mask()
+
+    def _others(self, idx):
+        others = np.nonzero(self.active[:self.num_boxes])[0]
+        return others[others != idx]
+
+    def _activate(self, idx):
+        others = self._others(idx)
+        self.num_rechecks += others.shape[0]
+        self.count[others] += overlaps(self.lower[idx], self.upper[idx], self.lower[others], self.upper[others])
+        self.count[idx] = np.sum(overlaps(self.lower[others], self.upper[others], self.lower[idx], self.upper[idx]))
+        self.active[idx] = True
+
+    def _deactivate(self, idx):
+        self.active[idx] = False
+        others = self._others(idx)
+        self.num_rechecks += others.shape[0]
+        self.count[others] -= overlaps(self.lower[idx], self.upper[idx], self.lower[others], self.upper[others])
+        self.count[idx] = 0
+
+
+if __name__ == '__main__':
+    # python -m BoundingBox.overlap : agreement with the is_overlap loop and time per call
+    rng = np.random.RandomState(0)
+    for num_objectives in (1, 2, 3):
+        for trial in range(200):
+            counter = OverlapCounter(num_objectives)
+            lower = np.empty((0, num_objectives))
+            upper = np.empty((0, num_objectives))
+            active = np.empty(0, dtype=bool)
+            for step in range(30):
+                l_ = rng.randint(0, 6, num_objectives).astype(float)
+                u_ = l_ + rng.randint(0, 3, num_objectives)
+                a_ = rng.rand() < 0.7
+                if lower.shape[0] > 0 and rng.rand() < 0.4:
+                    idx = rng.randint(lower.shape[0])
+                    lower[idx], upper[idx], active[idx] = l_, u_, a_
+                else:
+                    lower, upper = np.vstack((lower, l_)), np.vstack((upper, u_))
+                    active = np.hstack((active, a_))
+                expected = overlap_mask_bruteforce(lower, upper)
+                assert np.array_equal(overlap_mask_broadcast(lower, upper, max_elements=7), expected), (trial, step)
+                assert np.array_equal(overlap_mask_sweep(lower, upper), expected), (trial, step)
+                expected_active = np.ones(lower.shape[0], dtype=bool)
+                expected_active[active] = overlap_mask_bruteforce(lower[active], upper[active])
+                assert np.array_equal(counter.sync(lower, upper, active), expected_active), (trial, step)
+        print("%d objectives: masks agree with is_overlap" % num_objectives)
+
+    print("%8s %12s %12s %12s %16s" % ("boxes", "loop [s]", "broadcast [s]", "sweep [s]", "incremental [ms]"))
+    for n in [100, 1000, 5000, 10000]:
+        lower = rng.uniform(0, 1, size=(n, 2))
+        upper = lower + rng.uniform(0, 1e-3, size=(n, 2))
+        if n <= 1000:
+            start = time.time()
+            overlap_mask_bruteforce(lower, upper)
+            t_loop = "%12.4f" % (time.time() - start)
+        else:
+            t_loop = "%12s" % "-"
+        start = time.time()
+        broadcast = overlap_mask_broadcast(lower, upper)
+        t_broadcast = time.time() - start
+        start = time.time()
+        sweep = overlap_mask_sweep(lower, upper)
+        t_sweep = time.time() - start
+        assert np.array_equal(broadcast, sweep)
+        # one update of a box once the counter holds all the others, the cost paid after each observation
+        counter = OverlapCounter(2)
+        counter.sync(lower, upper)
+        updates = rng.randint(0, n, 20)
+        start = time.time()
+        for idx in updates:
+            counter.update(idx, lower[idx] + 1e-4, upper[idx] + 1e-4)
+        t_incremental = (time.time() - start) / len(updates)
+        print("%8d %s %12.4f %12.4f %16.4f" % (n, t_loop, t_broadcast, t_sweep, 1e3 * t_incremental))
@@ -0,0 +1,367 @@
+"""Incremental Pareto archive of boxes: insert, update and the current Pareto mask without a full recomputation"""
+
+import bisect
+import numpy as np
+import time
+
+
+def pareto_mask_bruteforce(lower_bounds, upper_bounds):
+    '''
+    the loop of Observations.is_pareto_BB (maximizing), kept as the reference of ParetoArchive
+    '''
+    is_efficient = np.ones(lower_bounds.shape[0], dtype=bool)
+    for i in range(lower_bounds.shape[0]):
+        if is_efficient[i]:
+            is_efficient[is_efficient] = np.any(upper_bounds[is_efficient] > lower_bounds[i], axis=1)
+            is_efficient[i] = True
+    return is_efficient
+
+
+class Staircase:
+    '''
+    lower corners of two objectives. the non-dominated ones form the staircase, sorted by the first objective
+    ascending and so by the second descending, each step with the ids of every box whose lower corner it is.
+    a dominated corner waits in the list of a step that dominates it and is inserted again when that step goes away.
+    add and remove return the interval (lo, hi] of the first objective where max{second : first >= x} changed
+    '''
+    def __init__(self):
+        self.x = []
+        self.neg_y = []
+        self.ids = []
+        self.waiting = []
+        self.owner = {}
+
+    def add(self, idx, point):
+        x, y = float(point[0]), float(point[1])
+        k = bisect.bisect_left(self.x, x)
+        if k < len(self.x) and -self.neg_y[k] >= y:
+            # the first step right of x has the largest second objective of all steps right of x
+            self.owner[idx] = self.x[k]
+            if self.x[k] == x and -self.neg_y[k] == y:
+                self.ids[k].append(idx)
+                return self._left_of(k), x
+            self.waiting[k].append(((x, y), idx))
+            return None
+
+        # the steps the new one dominates are the ones left of it with a second objective <= y, and the step at x
+        m = bisect.bisect_left(self.neg_y, -y, 0, k)
+        end = k + 1 if k < len(self.x) and self.x[k] == x else k
+        waiting = []
+        for j in range(m, end):
+            waiting += [((self.x[j], -self.neg_y[j]), idx_) for idx_ in self.ids[j]] + self.waiting[j]
+        for _, idx_ in waiting:
+            self.owner[idx_] = x
+        self.owner[idx] = x
+        self.x[m:end] = [x]
+        self.neg_y[m:end] = [-y]
+        self.ids[m:end] = [[idx]]
+        self.waiting[m:end] = [waiting]
+        return self._left_of(m), x
+
+    def remove(self, idx, point):
+        x_step = self.owner.pop(idx)
+        k = bisect.bisect_left(self.x, x_step)
+        if idx not in self.ids[k]:
+            self.waiting[k].remove(((float(point[0]), float(point[1])), idx))
+            return None
+        self.ids[k].remove(idx)
+        lo = self._left_of(k)
+        if self.ids[k]:
+            return lo, x_step
+        waiting = self.waiting[k]
+        del self.x[k], self.neg_y[k], self.ids[k], self.waiting[k]
+        for point_, idx_ in waiting:
+            self.add(idx_, point_)
+        return lo, x_step
+
+    def _left_of(self, k):
+        return self.x[k - 1] if k > 0 else -np.inf
+
+    def dominates(self, u, accept):
+        '''
+        is there a lower corner >= u whose id is accepted? the first step right of u[0] is the only candidate:
+        a waiting corner >= u would be dominated by a step >= u different from it
+        '''
+        k = bisect.bisect_left(self.x, float(u[0]))
+        if k == len(self.x) or -self.neg_y[k] < u[1]:
+            return False
+        if self.x[k] != u[0] or -self.neg_y[k] != u[1]:
+            return True
+        return any(accept(idx) for idx in self.ids[k])
+
+
+class SortedPoints:
+    '''
+    upper corners of two objectives sorted by the first objective
+    '''
+    def __init__(self):
+        self.keys = []
+        self.y = {}
+
+    def add(self, idx, point):
+        bisect.insort(self.keys, (float(point[0]), idx))
+        self.y[idx] = float(point[1])
+
+    def remove(self, idx, point):
+        del self.keys[bisect.bisect_left(self.keys, (float(point[0]), idx))]
+        del self.y[idx]
+
+    def strip(self, lo, hi, max_y):
+        '''
+        ids of the points with lo < first <= hi and second <= max_y
+        '''
+        start = bisect.bisect_right(self.keys, (lo, np.inf))
+        end = bisect.bisect_right(self.keys, (hi, np.inf))
+        return [idx for _, idx in self.keys[start:end] if self.y[idx] <= max_y]
+
+
+class _Node:
+    def __init__(self, num_objectives, parent=None):
+        self.lo = np.full(num_objectives, np.inf)
+        self.hi = np.full(num_objectives, -np.inf)
+        self.parent = parent
+        self.children = []
+        self.ids = []
+
+    def extend(self, point):
+        np.minimum(self.lo, point, out=self.lo)
+        np.maximum(self.hi, point, out=self.hi)
+
+
+class NDTree:
+    '''
+    points with ids in a tree of nested bounding boxes, as the ND-tree of Jaszkiewicz and Lust (2018): a point goes
+    down to the child whose box center is closest, a leaf of more than leaf_size points splits into
+    num_objectives + 1 children seeded by points far apart, and every node keeps the componentwise min and max of the
+    points below it. dominated points are kept, so removing a point never brings back the points it was hiding.
+    removals do not shrink the boxes, which stay valid bounds
+    '''
+    def __init__(self, num_objectives, leaf_size=16):
+        self.num_objectives = num_objectives
+        self.leaf_size = leaf_size
+        self.root = _Node(num_objectives)
+        self.points = {}
+        self.leaf = {}
+
+    def add(self, idx, point):
+        point = np.asarray(point, dtype=float)
+        self.points[idx] = point
+        node = self.root
+        node.extend(point)
+        while node.children:
+            # a child left empty by duplicate points has lo > hi and is never closest
+            distance = [np.sum(((child.lo + child.hi) / 2 - point) ** 2) if np.all(child.lo <= child.hi) else np.inf
+                        for child in node.children]
+            node = node.children[int(np.argmin(distance))]
+            node.extend(point)
+        node.ids.append(idx)
+        self.leaf[idx] = node
+        if len(node.ids) > self.leaf_size:
+            self._split(node)
+
+    def _split(self, node):
+        points = np.array([self.points[idx] for idx in node.ids])
+        seeds = [int(np.argmax(np.sum((points - points.mean(axis=0)) ** 2, axis=1)))]
+        distance = np.sum((points - points[seeds[0]]) ** 2, axis=1)
+        while len(seeds) < self.num_objectives + 1:
+            distance[seeds] = -1.
+            seeds += [int(np.argmax(distance))]
+            distance = np.minimum(distance, np.sum((points - points[seeds[-1]]) ** 2, axis=1))
+        assignment = np.argmin(np.stack([np.sum((points - points[s]) ** 2, axis=1) for s in seeds]), axis=0)
+        node.children = [_Node(self.num_objectives, node) for _ in seeds]
+        for idx, point, child in zip(node.ids, points, assignment):
+            node.children[child].ids.append(idx)
+            node.children[child].extend(point)
+            self.leaf[idx] = node.children[child]
+        node.ids = []
+
+    def remove(self, idx, point=None):
+        self.leaf.pop(idx).ids.remove(idx)
+        del self.points[idx]
+
+    def dominates(self, u, accept):
+        '''
+        is there a point >= u whose id is accepted?
+        '''
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if np.any(node.hi < u):
+                continue
+            stack += node.children
+            for idx in node.ids:
+                if np.all(self.points[idx] >= u) and accept(idx):
+                    return True
+        return False
+
+    def leq(self, p):
+        '''
+        ids of the points <= p
+        '''
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if np.any(node.lo > p):
+                continue
+            stack += node.children
+            found += [idx for idx in node.ids if np.all(self.points[idx] <= p)]
+        return found
+
+
+class ParetoArchive:
+    '''
+    Pareto mask of boxes [lower, upper] under maximization, the mask of Observations.is_pareto_BB: box j is
+    dominated iff the lower corner of another box i is >= its upper corner in every objective. two identical
+    degenerate boxes (lower == upper) would dominate each other, the one of lowest index is kept. points are
+    degenerate boxes, e.g. the labels of simple_2d_design.optimize_design.is_pareto_simple_max.
+    the lower corners are indexed by a Staircase (two objectives) or an NDTree, the upper corners by SortedPoints or
+    an NDTree. a new or removed lower corner can only change the status of the boxes whose upper corner it dominates,
+    so insert and update only recheck those instead of every box
+    '''
+    def __init__(self, num_objectives, leaf_size=16):
+        self.num_objectives = num_objectives
+        self.leaf_size = leaf_size
+        self.clear()
+
+    def clear(self):
+        self.num_boxes = 0
+        self.lower = np.empty((16, self.num_objectives))
+        self.upper = np.empty((16, self.num_objectives))
+        self.is_pareto = np.empty(16, dtype=bool)
+        if self.num_objectives == 2:
+            self.lower_index, self.upper_index = Staircase(), SortedPoints()
+        else:
+            self.lower_index = NDTree(self.num_objectives, self.leaf_size)
+            self.upper_index = NDTree(self.num_objectives, self.leaf_size)
+        self.num_rechecks = 0
+
+    def __len__(self):
+        return self.num_boxes
+
+    def mask(self):
+        return self.is_pareto[:self.num_boxes].copy()
+
+    def insert(self, lower, upper):
+        '''
+        returns the index of the new box
+        '''
+        idx = self.num_boxes
+        if idx == self.lower.shape[0]:
+            self.lower = np.vstack((self.lower, np.empty_like(self.lower)))
+            self.upper = np.vstack((self.upper, np.empty_like(self.upper)))
+            self.is_pareto = np.hstack((self.is_pareto, np.empty_like(self.is_pareto)))
+        self.num_boxes += 1
+        self.lower[idx] = lower
+        self.upper[idx] = upper
+        self.is_pareto[idx] = True
+        self.upper_index.add(idx, self.upper[idx])
+        candidates = self._add_lower(idx)
+        self._recheck(candidates + [idx])
+        return idx
+
+    def update(self, idx, lower, upper):
+        freed = self._remove_lower(idx)
+        self.upper_index.remove(idx, self.upper[idx])
+        self.lower[idx] = lower
+        self.upper[idx] = upper
+        self.upper_index.add(idx, self.upper[idx])
+        dominated = self._add_lower(idx)
+        self._recheck(freed + dominated + [idx])
+
+    def sync(self, lower_bounds, upper_bounds):
+        '''
+        update the boxes that differ from the rows of lower_bounds, upper_bounds and insert the new rows;
+        returns the Pareto mask
+        '''
+        lower_bounds = np.asarray(lower_bounds, dtype=float).reshape(-1, self.num_objectives)
+        upper_bounds = np.asarray(upper_bounds, dtype=float).reshape(-1, self.num_objectives)
+        if lower_bounds.shape[0] < self.num_boxes:
+            self.clear()
+        n = self.num_boxes
+        changed = np.nonzero(np.any(self.lower[:n] != lower_bounds[:n], axis=1) |
+                             np.any(self.upper[:n] != upper_bounds[:n], axis=1))[0]
+        for idx in changed:
+            self.update(idx, lower_bounds[idx], upper_bounds[idx])
+        for idx in range(n, lower_bounds.shape[0]):
+            self.insert(lower_bounds[idx], upper_bounds[idx])
+        return self.mask()
+
+    def _add_lower(self, idx):
+        '''
+        returns the Pareto boxes the new lower corner of idx may dominate
+        '''
+        change = self.lower_index.add(idx, self.lower[idx])
+        return [j for j in self._below(self.lower[idx], change) if self.is_pareto[j]]
+
+    def _remove_lower(self, idx):
+        '''
+        returns the dominated boxes that may only have been dominated by the lower corner of idx
+        '''
+        change = self.lower_index.remove(idx, self.lower[idx])
+        return [j for j in self._below(self.lower[idx], change) if not self.is_pareto[j]]
+
+    def _below(self, point, change):
+        if self.num_objectives == 2:
+            return [] if change is None else self.upper_index.strip(change[0], change[1], point[1])
+        # a corner strictly dominated by another one changes no status
+        if self.lower_index.dominates(point, lambda i: np.any(self.lower[i] != point)):
+            return []
+        return self.upper_index.leq(point)
+
+    def _recheck(self, ids):
+        for j in set(ids):
+            self.num_rechecks += 1
+            self.is_pareto[j] = not self._dominated(j)
+
+    def _dominated(self, j):
+        degenerate_j = np.all(self.lower[j] == self.upper[j])
+
+        def accept(i):
+            # of two identical degenerate boxes, the lower index dominates
+            return i != j and not (i > j and degenerate_j and np.all(self.lower[i] == self.upper[i])
+                                   and np.all(self.lower[i] == self.upper[j]))
+        return self.lower_index.dominates(self.upper[j], accept)
+
+
+if __name__ == '__main__':
+    # python -m BoundingBox.pareto_archive : agreement with the is_pareto_BB loop and time per observation
+    rng = np.random.RandomState(0)
+    for num_objectives in (2, 3):
+        for trial in range(200):
+            archive = ParetoArchive(num_objectives, leaf_size=4)
+            lower = np.empty((0, num_objectives))
+            upper = np.empty((0, num_objectives))
+            for step in range(40):
+                l_ = rng.randint(0, 6, num_objectives).astype(float)
+                u_ = l_ + rng.randint(0, 2, num_objectives) * rng.randint(0, 3, num_objectives)
+                if lower.shape[0] > 0 and rng.rand() < 0.4:
+                    idx = rng.randint(lower.shape[0])
+                    lower[idx], upper[idx] = l_, u_
+                    archive.update(idx, l_, u_)
+                else:
+                    lower, upper = np.vstack((lower, l_)), np.vstack((upper, u_))
+                    archive.insert(l_, u_)
+                assert np.array_equal(archive.mask(), pareto_mask_bruteforce(lower, upper)), (trial, step)
+        print("%d objectives: masks agree with is_pareto_BB" % num_objectives)
+
+    print("%10s %12s %16s %16s %10s" % ("objectives", "boxes", "archive [ms/op]", "loop [ms/op]", "rechecks"))
+    for num_objectives in (2, 3):
+        for n in [100, 1000, 5000]:
+            lower = rng.uniform(0, 1, size=(n, num_objectives))
+            upper = lower + rng.uniform(0, 0.05, size=(n, num_objectives))
+            updates = rng.randint(0, n, n // 2)
+            archive = ParetoArchive(num_objectives)
+            start = time.time()
+            for idx in range(n):
+                archive.insert(lower[idx], upper[idx])
+            for idx in updates:
+                archive.update(idx, lower[idx] + 0.01, upper[idx])
+            t_archive = (time.time() - start) / (n + len(updates))
+            # the loop recomputes the whole mask at every observation
+            start = time.time()
+            for _ in range(5):
+                pareto_mask_bruteforce(lower, upper)
+            t_loop = (time.time() - start) / 5
+            print("%10d %12d %16.4f %16.4f %10.1f" % (num_objectives, n, 1e3 * t_archive, 1e3 * t_loop,
+                                                     archive.num_rechecks / float(n + len(updates))))
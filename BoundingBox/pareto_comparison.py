@@ -2,6 +2,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.collections import PatchCollection
 from matplotlib.patches import Rectangle
+from BoundingBox.pareto_archive import ParetoArchive
+from BoundingBox.overlap import OverlapCounter, overlap_mask
 
 
 class Observations:
@@ -19,6 +21,8 @@ class Observations:
         self.cur_pareto_idx = None
         self.not_overlapped = None
         self.is_pareto = None
+        self.archive = ParetoArchive(num_objectives)
+        self.overlap_counter = OverlapCounter(num_objectives)
         self.text_in_graph = text_in_graph
 
     def add_observation(self, lower_bounds, upper_bounds, num_experiments):
@@ -66,79 +70,21 @@ class Observations:
             return -1
 
     def is_overlap(self):
-        num_candidates = self.lower_bounds.shape[0]
-        num_functions = self.lower_bounds.shape[1]
-        not_overlapped = np.ones(num_candidates, dtype=bool)
-        for i in range(num_candidates):
-            # if not_overlapped[i]:
-            l_ = self.lower_bounds[i]
-            u_ = self.upper_bounds[i]
-            for idx in range(num_candidates):
-                if idx != i:
-                    # if not_overlapped[idx]:
-                    for func_idx in range(num_functions):
-                        l_idx = self.lower_bounds[idx]
-                        u_idx = self.upper_bounds[idx]
-                        if l_[func_idx] < l_idx[func_idx] < u_[func_idx] or \
-                                l_[func_idx] < u_idx[func_idx] < u_[func_idx] or \
-                                (l_idx[func_idx] <= l_[func_idx] and u_idx[func_idx] >= u_[func_idx]):
-                            not_overlapped[idx] = False
-                            break
+        not_overlapped = overlap_mask(self.lower_bounds, self.upper_bounds)
         self.not_overlapped = not_overlapped
-        if not_overlapped[not_overlapped].shape[0] < num_candidates:
-            return False
-        else:
-            return True
+        return bool(np.all(not_overlapped))
 
     def is_overlap_in_dominant(self):
-        num_candidates = self.lower_bounds[self.is_pareto].shape[0]
-        num_functions = self.lower_bounds[self.is_pareto].shape[1]
-        not_overlapped = np.ones(num_candidates, dtype=bool)
-        lower_bounds_ = self.lower_bounds[self.is_pareto]
-        upper_bounds_ = self.upper_bounds[self.is_pareto]
-        for i in range(num_candidates):
-            # if not_overlapped[i]:
-            l_ = lower_bounds_[i]
-            u_ = upper_bounds_[i]
-            for idx in range(num_candidates):
-                if idx != i:
-                    # if not_overlapped[idx]:
-                    for func_idx in range(num_functions):
-                        l_idx = lower_bounds_[idx]
-                        u_idx = upper_bounds_[idx]
-                        if l_[func_idx] < l_idx[func_idx] < u_[func_idx] or \
-                                l_[func_idx] < u_idx[func_idx] < u_[func_idx] or \
-                                (l_idx[func_idx] <= l_[func_idx] and u_idx[func_idx] >= u_[func_idx]):
-                            not_overlapped[idx] = False
-                            break
-                # not_overlapped[i] = True
-        global_not_overlapped = np.ones(self.lower_bounds.shape[0], dtype=bool)
-        global_not_overlapped[self.is_pareto] = not_overlapped
-        self.not_overlapped = global_not_overlapped
-
-        if not_overlapped[not_overlapped].shape[0] < num_candidates:
-            return False
-        else:
-            return True
+        # only the boxes added, changed or entering/leaving the Pareto set are compared with the others
+        self.not_overlapped = self.overlap_counter.sync(self.lower_bounds, self.upper_bounds, self.is_pareto)
+        return bool(np.all(self.not_overlapped[self.is_pareto]))
 
     def is_pareto_BB(self):
-        num_candidates = self.lower_bounds.shape[0]
-        is_efficient = np.ones(num_candidates, dtype=bool)
-
+        # the archive only rechecks the boxes added or changed since the last call
         if self.is_min:
-            for i in range(num_candidates):
-                if is_efficient[i]:
-                    is_efficient[is_efficient] = np.any(self.lower_bounds[is_efficient] < self.upper_bounds[i],
-                                                        axis=1)  # Keep any point with a lower cost
-                    is_efficient[i] = True  # And keep self
+            self.is_pareto = self.archive.sync(-self.upper_bounds, -self.lower_bounds)
         else: #maximizing
-            for i in range(num_candidates):
-                if is_efficient[i]:
-                    is_efficient[is_efficient] = np.any(self.upper_bounds[is_efficient] > self.lower_bounds[i],
-                                                        axis=1)  # Keep any point with a lower cost
-                    is_efficient[i] = True  # And keep self
-
-        self.is_pareto = is_efficient
+            self.is_pareto = self.archive.sync(self.lower_bounds, self.upper_bounds)
         return
 
     def draw_plot(self):
@@ -2,6 +2,11 @@ from .directions import Directions
 import cvxpy as cp
 import numpy as np
 import random, math, torch
+from scipy.spatial import ConvexHull
+try:
+    from scipy.spatial import QhullError
+except ImportError:
+    from scipy.spatial.qhull import QhullError
 torch.set_default_dtype(torch.float64)
 
 
@@ -47,6 +52,44 @@ def support(M,mu,alpha,pss,dss,nss,s,beta=None,hand_normal=None):
     prob.solve()
     return obj.value
 
+class SupportSolver:
+    #support() compiled once per contact set: the direction only enters the objective w^T*M*s,
+    #so it is passed as the parameter Ms=M*s and every direction re-solves the same problem with warm start.
+    #M itself may be replaced between calls (solver.M=...) without rebuilding the problem
+    #the canonicalization of a problem with parameters is only cached from cvxpy 1.1 on (DPP)
+    def __init__(self,M,mu,alpha,pss,dss,nss,beta=None,hand_normal=None):
+        self.M=M
+        self.w=cp.Variable(6)
+        self.Ms=cp.Parameter(6)
+        fss=[]
+        cons=[]
+        sumFN=0
+        sumW=-self.w
+        for i in range(len(pss)):
+            fss.append(cp.Variable(3))
+            fN=fss[-1].T@nss[i]
+            fT=fss[-1]-fN*nss[i]
+            #normal sum
+            if hand_normal is not None:
+                sumFN+=fN*math.exp(alpha*abs(dss[i])+beta*(1+np.dot(nss[i],hand_normal[i])))
+            else:
+                sumFN+=fN*math.exp(alpha*abs(dss[i]))
+            #frictional cone
+            cons.append(cp.SOC(fN*mu,fT))
+            #sum of f
+            f2w=np.concatenate((np.eye(3,3,dtype=np.float64),cross(pss[i])))
+            sumW+=f2w@fss[-1]
+        #normal sum
+        cons.append(sumFN<=1)
+        #sum of f
+        cons.append(sumW==0)
+        #objective
+        self.prob=cp.Problem(cp.Maximize(self.w.T@self.Ms),cons)
+    def support(self,s):
+        self.Ms.value=np.asarray(s,dtype=np.float64) if self.M is None else np.matmul(self.M,s)
+        self.prob.solve(warm_start=True)
+        return self.prob.value
+
 def support_analytic(M,mu,alpha,pss,dss,nss,s,beta=None,hand_normal=None):
     support_j=None
     for i in range(len(pss)):
@@ -65,22 +108,122 @@ def support_analytic(M,mu,alpha,pss,dss,nss,s,beta=None,hand_normal=None):
         support_j=max_sw if support_j is None else max(support_j,max_sw)
     return support_j
 
-def compute_Q1(M,mu,alpha,pss,dss,nss,sss,beta=None,hand_normal=None,analytic=False):
-    f_support=support_analytic if analytic else support
+class AnalyticQ1:
+    #vectorized support_analytic: f2w, f2w*n and f2w*(I-n*n^T) are computed once per contact set,
+    #then all directions x contacts are evaluated with batched matmuls
+    def __init__(self,M,pss,nss):
+        pss=np.asarray(pss,dtype=np.float64).reshape(-1,3)
+        nss=np.asarray(nss,dtype=np.float64).reshape(-1,3)
+        f2w=np.zeros((pss.shape[0],6,3),dtype=np.float64)
+        f2w[:,0,0]=f2w[:,1,1]=f2w[:,2,2]=1
+        f2w[:,5,1]= pss[:,0]
+        f2w[:,4,2]=-pss[:,0]
+        f2w[:,3,2]= pss[:,1]
+        f2w[:,5,0]=-pss[:,1]
+        f2w[:,4,0]= pss[:,2]
+        f2w[:,3,1]=-pss[:,2]
+        if M is not None:
+            f2w=np.matmul(np.asarray(M,dtype=np.float64),f2w)
+        self.nss=nss
+        self.f2w=f2w
+        #[np,6]
+        self.f2w_n=np.matmul(f2w,nss[:,:,None])[:,:,0]
+        #[np,6,3]
+        self.f2w_Innt=f2w-self.f2w_n[:,:,None]*nss[:,None,:]
+    def support(self,mu,sss,alpha=0.,dss=None,beta=None,hand_normal=None,decay=False):
+        #sss: [nd,6], returns the support of every direction: [nd]
+        sss=np.asarray(sss,dtype=np.float64).reshape(-1,6)
+        w_perp=np.matmul(sss,self.f2w_n.T)
+        w_para=np.linalg.norm(np.matmul(sss[None,:,:],self.f2w_Innt),axis=2).T
+        with np.errstate(divide='ignore',invalid='ignore'):
+            in_cone=w_perp+w_para**2/w_perp
+        not_in_cone=np.maximum(0,w_perp+mu*w_para)
+        max_sw=np.where(mu*w_perp>w_para,in_cone,not_in_cone)
+        if decay:
+            #same exponential decay as ComputeQ1Layer
+            exponent=-alpha*np.abs(np.asarray(dss,dtype=np.float64))
+            if hand_normal is not None:
+                exponent-=beta*(1+np.sum(self.nss*np.asarray(hand_normal,dtype=np.float64).reshape(-1,3),axis=1))
+            max_sw=max_sw*np.exp(exponent)[None,:]
+        return np.max(max_sw,axis=1)
+    def Q1(self,mu,sss,alpha=0.,dss=None,beta=None,hand_normal=None,decay=False):
+        return np.min(self.support(mu,sss,alpha,dss,beta,hand_normal,decay))
+
+def wrench_cone_edges(M,mu,alpha,pss,dss,nss,beta=None,hand_normal=None,num_edges=8):
+    #linearize each friction cone into num_edges edges with unit normal force, scaled by the weight of sumFN in support,
+    #and map them to wrenches: [#contact*num_edges,6]
+    pss=np.asarray(pss,dtype=np.float64).reshape(-1,3)
+    nss=np.asarray(nss,dtype=np.float64).reshape(-1,3)
+    axis=np.eye(3)[np.argmin(np.abs(nss),axis=1)]
+    t1=np.cross(nss,axis)
+    t1/=np.linalg.norm(t1,axis=1)[:,None]
+    t2=np.cross(nss,t1)
+    theta=np.arange(num_edges)*2*np.pi/num_edges
+    fss=nss[:,None,:]+mu*(np.cos(theta)[None,:,None]*t1[:,None,:]+np.sin(theta)[None,:,None]*t2[:,None,:])
+    exponent=alpha*np.abs(np.asarray(dss,dtype=np.float64)) if dss is not None else np.zeros(pss.shape[0])
+    if hand_normal is not None:
+        exponent=exponent+beta*(1+np.sum(nss*np.asarray(hand_normal,dtype=np.float64).reshape(-1,3),axis=1))
+    fss=fss/np.exp(exponent)[:,None,None]
+    wss=np.concatenate((fss,np.cross(pss[:,None,:],fss)),axis=2).reshape(-1,6)
+    if M is not None:
+        #support in direction s is max w^T*M*s
+        wss=np.matmul(wss,M)
+    return wss
+
+def compute_Q1_hull(M,mu,alpha,pss,dss,nss,beta=None,hand_normal=None,num_edges=8):
+    #exact Q1 of the linearized grasp wrench space: distance from the origin to the closest facet of
+    #conv({0} U cone edges), 0 if the origin is on the boundary or the hull is degenerate
+    wss=wrench_cone_edges(M,mu,alpha,pss,dss,nss,beta=beta,hand_normal=hand_normal,num_edges=num_edges)
+    points=np.vstack((np.zeros((1,6)),wss))
+    try:
+        hull=ConvexHull(points)
+    except QhullError:
+        return 0.
+    return max(0.,np.min(-hull.equations[:,-1]))
+
+def compute_Q1(M,mu,alpha,pss,dss,nss,sss,beta=None,hand_normal=None,analytic=False,method=None,num_edges=8):
+    #method: 'analytic' (support_analytic over sss), 'exact' (support over sss) or 'hull' (sss unused)
+    if method is None:
+        method='analytic' if analytic else 'exact'
+    if method=='hull':
+        return compute_Q1_hull(M,mu,alpha,pss,dss,nss,beta=beta,hand_normal=hand_normal,num_edges=num_edges)
+    if method=='analytic':
+        if len(sss)==0:
+            return None
+        return AnalyticQ1(M,pss,nss).Q1(mu,sss)
+    solver=SupportSolver(M,mu,alpha,pss,dss,nss,beta=beta,hand_normal=hand_normal)
     ret=None
     for s in sss:
         if ret is None:
-            if hand_normal is not None:
-                ret=f_support(M,mu,alpha,pss,dss,nss,s,beta=beta,hand_normal=hand_normal)
-            else:
-                ret=f_support(M,mu,alpha,pss,dss,nss,s)
+            ret=solver.support(s)
         else:
-            if hand_normal is not None:
-                ret=min(ret,f_support(M,mu,alpha,pss,dss,nss,s,beta=beta,hand_normal=hand_normal))
-            else:
-                ret=min(ret,f_support(M,mu,alpha,pss,dss,nss,s))
+            ret=min(ret,solver.support(s))
     return ret
 
+def compute_Q1_batched(M,mu,alpha,psss,dsss,nsss,sss):
+    #Q1 of b contact sets of different sizes in one ComputeQ1Layer call: psss/nsss [b][np_i,3], dsss [b][np_i]
+    #sets are padded to the largest np_i with a dummy contact (p=0, n=z) that the mask removes from the max
+    b=len(psss)
+    if b==0:
+        return np.zeros(0)
+    num_contact=max(len(pss) for pss in psss)
+    pss_pad=np.zeros((b,num_contact,3))
+    nss_pad=np.zeros((b,num_contact,3))
+    nss_pad[:,:,2]=1
+    dss_pad=np.zeros((b,num_contact))
+    mask=np.zeros((b,num_contact),dtype=bool)
+    for i in range(b):
+        n=len(psss[i])
+        pss_pad[i,:n]=np.asarray(psss[i]).reshape(-1,3)
+        nss_pad[i,:n]=np.asarray(nsss[i]).reshape(-1,3)
+        dss_pad[i,:n]=dsss[i]
+        mask[i,:n]=True
+    with torch.no_grad():
+        Q1=ComputeQ1Layer()(None if M is None else torch.tensor(M),mu,alpha,
+                            torch.tensor(pss_pad).transpose(1,2),torch.tensor(dss_pad),torch.tensor(nss_pad),
+                            torch.tensor(np.array(sss)),mask=torch.tensor(mask))
+    return Q1.numpy()
+
 class ComputeQ1Layer(torch.nn.Module):
     def __init__(self):
         super(ComputeQ1Layer,self).__init__()
@@ -99,7 +242,7 @@ class ComputeQ1Layer(torch.nn.Module):
                                         [ 0, 0, 0],
                                         [ 0, 0, 0],
                                         [ 0, 0, 0]])
-    def forward(self,M,mu,alpha,pss,dss,nss,sss,beta=None,hand_normal=None):
+    def forward(self,M,mu,alpha,pss,dss,nss,sss,beta=None,hand_normal=None,mask=None):
         #M: [6,6]
         #mu: scalar
         #alpha: scalar
@@ -107,6 +250,7 @@ class ComputeQ1Layer(torch.nn.Module):
         #dss: [b,np]
         #nss: [b,np,3]
         #sss: [nd,6]
+        #mask: [b,np] bool, False for padded contacts
         pss=pss.transpose(1,2)
         np=pss.shape[1]
         nd=sss.shape[0]
@@ -142,12 +286,14 @@ class ComputeQ1Layer(torch.nn.Module):
             support*=torch.exp(torch.abs(dss)*-alpha-beta*(1+normal_dot)).view([-1,np,1])
         else:
             support*=torch.exp(torch.abs(dss)*-alpha).view([-1,np,1])
+        #padded contacts: support>=0, so 0 never wins the max
+        if mask is not None:
+            support=support.masked_fill(~mask.view([-1,np,1]),0)
         #Q1
         Q1,max_index=torch.max(support,dim=1)
         # softmin=torch.nn.Softmin(dim=1)
         # Q1=softmin(Q1).mean()
         Q1,min_index=torch.min(Q1,dim=1)
-        print("Max support index: "+str(max_index[0][min_index[0]].item()))
         return Q1
     
     def value_check(M,mu,alpha,pss,dss,nss,sss,beta=None,hand_normal=None):
@@ -156,7 +302,8 @@ class ComputeQ1Layer(torch.nn.Module):
         pss=torch.Tensor(pss).transpose(1,2)
         dss=torch.Tensor(dss)
         nss=torch.Tensor(nss)
-        sss=torch.Tensor(sss)
+        #Directions.dirs is a shared read-only array, torch needs a writable copy
+        sss=torch.Tensor(np.array(sss))
         fn=ComputeQ1Layer()
         if hand_normal is not None:
             hand_normal=torch.Tensor(hand_normal).transpose(1,2)
@@ -171,7 +318,7 @@ class ComputeQ1Layer(torch.nn.Module):
         pss=torch.Tensor(pss).transpose(1,2)
         dss=torch.Tensor(dss)
         nss=torch.Tensor(nss)
-        sss=torch.Tensor(sss)
+        sss=torch.Tensor(np.array(sss))
         pss.requires_grad_()
         dss.requires_grad_()
         nss.requires_grad_()
@@ -230,4 +377,48 @@ if __name__=='__main__':
         print('Analytic_torch_err=',analytic_torch_error.sum(),'Analytic_torch_err_hand=',analytic_torch_error_hand.sum())
         ComputeQ1Layer.grad_check(M,0.7,0.1,psss,dsss,nsss,dirs.dirs)
         hand_normals=torch.Tensor(hand_normals).transpose(1,2)
-        ComputeQ1Layer.grad_check(M,0.7,0.1,psss,dsss,nsss,dirs.dirs,beta=0.1,hand_normal=hand_normals)
\ No newline at end of file
+        ComputeQ1Layer.grad_check(M,0.7,0.1,psss,dsss,nsss,dirs.dirs,beta=0.1,hand_normal=hand_normals)
+    #benchmark: per-direction loop of support_analytic vs AnalyticQ1
+    import time
+    for res in [2,4]:
+        dirs=Directions(res=res)
+        for num_contact in [5,20,100]:
+            pss=[np.random.random_sample((3))*2-1 for i in range(num_contact)]
+            nss=[n/np.linalg.norm(n) for n in np.random.random_sample((num_contact,3))*2-1]
+            t0=time.time()
+            Q1_loop=min([support_analytic(None,0.7,0.,pss,None,nss,s) for s in dirs.dirs])
+            t1=time.time()
+            Q1_vec=compute_Q1(None,0.7,0.,pss,None,nss,dirs.dirs,analytic=True)
+            t2=time.time()
+            print('res=%d #dir=%d #contact=%d loop=%.4fs vectorized=%.5fs err=%g'%(res,len(dirs.dirs),num_contact,t1-t0,t2-t1,abs(Q1_loop-Q1_vec)))
+
+    #benchmark: one cp.Problem per direction vs SupportSolver
+    for num_contact in [3,10,30]:
+        pss=[np.random.random_sample((3))*2-1 for i in range(num_contact)]
+        dss=[random.uniform(-1,1) for i in range(num_contact)]
+        nss=[n/np.linalg.norm(n) for n in np.random.random_sample((num_contact,3))*2-1]
+        sss=Directions(res=2).dirs[:16]
+        t0=time.time()
+        support_old=[support(None,0.7,0.1,pss,dss,nss,s) for s in sss]
+        t1=time.time()
+        solver=SupportSolver(None,0.7,0.1,pss,dss,nss)
+        t2=time.time()
+        support_new=[solver.support(s) for s in sss]
+        t3=time.time()
+        print('#contact=%d per direction: new problem=%.4fs parametrized=%.4fs (build %.4fs) err=%g'%
+              (num_contact,(t1-t0)/len(sss),(t3-t2)/len(sss),t2-t1,np.max(np.abs(np.array(support_old)-np.array(support_new)))))
+
+    #benchmark: convex hull of the linearized GWS vs support_analytic over direction sets
+    for num_contact in [3,10,50,200]:
+        pss=[np.random.random_sample((3))*2-1 for i in range(num_contact)]
+        nss=[-p/np.linalg.norm(p) for p in pss]
+        for num_edges in [4,8]:
+            t0=time.time()
+            Q1_hull=compute_Q1(None,0.7,0.,pss,None,nss,None,method='hull',num_edges=num_edges)
+            t_hull=time.time()-t0
+            line='#contact=%d #edge=%d hull: Q1=%.4f %.4fs'%(num_contact,num_edges,Q1_hull,t_hull)
+            for res in [2,4,6]:
+                t0=time.time()
+                Q1_analytic=compute_Q1(None,0.7,0.,pss,None,nss,Directions(res=res).dirs,analytic=True)
+                line+=' | res=%d: Q1=%.4f %.4fs'%(res,Q1_analytic,time.time()-t0)
+            print(line)
@@ -1,65 +1,42 @@
 import numpy as np
+import os
 
-def cmpToKey(mycmp):
-    'Convert a cmp= function into a key= function'
-    class K(object):
-        def __init__(self,obj,*args):
-            self.obj=obj
-        def __lt__(self,other):
-            return mycmp(self.obj,other.obj)<0
-        def __gt__(self,other):
-            return mycmp(self.obj,other.obj)>0
-        def __eq__(self,other):
-            return mycmp(self.obj,other.obj)==0
-        def __le__(self,other):
-            return mycmp(self.obj,other.obj)<=0  
-        def __ge__(self,other):
-            return mycmp(self.obj,other.obj)>=0
-        def __ne__(self,other):
-            return mycmp(self.obj,other.obj)!=0
-    return K
+#(res,dim) -> read-only [#dir,dim] float64 array, shared by every Directions of the process
+_DIRS_CACHE={}
+
+def generateDirs(res,dim):
+    #all points of the res^dim grid on [-1,1]^dim that lie on the boundary (one coordinate is +-1),
+    #in lexicographic order, normalized
+    grid=np.array([-1+2*i/float(res-1) for i in range(res)],dtype=np.float64)
+    dirs=np.stack(np.meshgrid(*([grid]*dim),indexing='ij'),axis=-1).reshape(-1,dim)
+    dirs=dirs[np.any(np.abs(dirs)==1,axis=1)]
+    norm=np.sqrt(np.matmul(dirs[:,None,:],dirs[:,:,None])[:,0,0])
+    return np.ascontiguousarray(dirs/norm[:,None])
+
+def getDirs(res=4,dim=6,cache_dir=None):
+    key=(res,dim)
+    if key not in _DIRS_CACHE:
+        path=None if cache_dir is None else os.path.join(cache_dir,'dirs_res%d_dim%d.npy'%key)
+        if path is not None and os.path.exists(path):
+            dirs=np.load(path)
+        else:
+            dirs=generateDirs(res,dim)
+            if path is not None:
+                os.makedirs(cache_dir,exist_ok=True)
+                tmp='%s.%d.tmp.npy'%(path[:-4],os.getpid())
+                np.save(tmp,dirs)
+                os.replace(tmp,path)
+        dirs.flags.writeable=False
+        _DIRS_CACHE[key]=dirs
+    return _DIRS_CACHE[key]
 
 class Directions:
-    def __init__(self,res=4,dim=6):
-        self.dirs=[]
+    #dirs: the read-only [#dir,dim] array of getDirs, shared with every other Directions of the same (res,dim);
+    #take np.array(dirs) for a writable copy, e.g. for torch
+    def __init__(self,res=4,dim=6,cache_dir=None):
         self.res=res
         self.dim=dim
-        n=np.array([0.0]*dim,dtype=np.float64)
-        for d in range(dim):
-            n[d]= 1
-            self.addDirs(0,d,n)
-            n[d]=-1
-            self.addDirs(0,d,n)
-        #sort dir
-        def cmp(A,B):
-            for d in range(dim):
-                if A[d]<B[d]:
-                    return -1
-                elif A[d]>B[d]:
-                    return 1
-            return 0
-        self.dirs=sorted(self.dirs,key=cmpToKey(cmp))
-        #make compact
-        j=0
-        for i in range(len(self.dirs)):
-            if i>0 and (self.dirs[i]==self.dirs[i-1]).all():
-                continue
-            else: 
-                self.dirs[j]=self.dirs[i]
-                j+=1
-        self.dirs=self.dirs[0:j]
-        #normalize
-        for i in range(len(self.dirs)):
-            self.dirs[i]/=np.linalg.norm(self.dirs[i])
-    def addDirs(self,d0,d,n):
-        if d0==self.dim:
-            self.dirs.append(n.astype(np.float64))
-        elif d0==d:
-            self.addDirs(d0+1,d,n)
-        else:
-            for i in range(self.res):
-                n[d0]=-1+2*i/float(self.res-1)
-                self.addDirs(d0+1,d,n)
+        self.dirs=getDirs(res,dim,cache_dir)
     def printDirs(self):
         print('res=%d dim=%d #dir=%d'%(self.res,self.dim,len(self.dirs)))
         for d in self.dirs:
@@ -0,0 +1,132 @@
+"""Sequential tests that stop the trials of an object once the grasp quality bound of its design is decided"""
+
+import numpy as np
+from scipy.stats import norm, t as student_t
+from .grasp_statistics import q1_statistics, design_quality_bound
+
+
+def sequential_gamma(gamma, num_looks):
+    '''
+    gamma of a test repeated num_looks times at the error level of one test at gamma (Bonferroni)
+    '''
+    return norm.isf(norm.sf(gamma) / max(num_looks, 1))
+
+
+def sequential_quality_bound(q1, gamma):
+    '''
+    Q1 of the successful trials of one object so far -> (lower, upper) that the grasp_statistics.quality_bounds
+    bound after the remaining trials stays within: the max can only grow, up to mean + t std, and the noise is
+    taken with the Student t quantile of the level of gamma, as the std of a few trials is itself uncertain.
+    a single success gives the noise 1 as quality_bounds
+    '''
+    q1 = np.asarray(q1, dtype=float)
+    if len(q1) == 1:
+        return q1[0], q1[0] + 2.
+    t = student_t.ppf(norm.cdf(gamma), len(q1) - 1)
+    std = np.std(q1, ddof=1)
+    return np.max(q1), max(np.max(q1), np.mean(q1) + t * std) + 2 * t * std / np.sqrt(len(q1))
+
+
+def success_half_width(num_success, num_trials, gamma):
+    '''
+    gamma standard deviations of the success rate of num_trials trials, p = (s + 1) / (t + 2) so that a run of
+    successes or failures is not certain after a few trials
+    '''
+    p = (num_success + 1.) / (num_trials + 2.)
+    return gamma * np.sqrt(p * (1 - p) / max(num_trials, 1))
+
+
+class SequentialStop:
+    '''
+    stop rule of GraspWorkerPool.submit(..., stop_rule=...), called with the trials of every object of the job after
+    each streamed trial. every object runs at least min_trials trials, then
+        - all objects stop once the Q1 bound of the design, averaged over the objects with a success as in
+          post_processing, is decided against the observed boxes: its upper bound is at most dominated_below, so a
+          lighter box dominates it, or its lower bound exceeds clear_above, the Q1 of every lighter box
+        - an object stops once its success rate half-width is at most success_tolerance and its Q1 half-width at
+          most q1_tolerance, or it has no success at all
+    the rule looks at the trials up to num_trials - min_trials + 1 times, so every test uses sequential_gamma and
+    sequential_quality_bound instead of gamma and quality_bounds: the bounds of the trials so far must contain the
+    bound all trials would give, not only the bound of the trials so far.
+    num_trials is the number of trials of an object when it does not stop
+    '''
+    def __init__(self, gamma, num_trials, min_trials=5, dominated_below=-np.inf, clear_above=np.inf,
+                 q1_tolerance=0., success_tolerance=0.):
+        self.gamma = gamma
+        self.num_trials = num_trials
+        self.min_trials = min(min_trials, num_trials)
+        self.sequential_gamma = sequential_gamma(gamma, self.num_trials - self.min_trials + 1)
+        self.dominated_below = dominated_below
+        self.clear_above = clear_above
+        self.q1_tolerance = q1_tolerance
+        self.success_tolerance = success_tolerance
+
+    def design_bound(self, trials, sequential=False):
+        '''
+        trials : per object {trial: (success, result_1, q1)} -> Q1 (lower, upper) of the design, (0, 1) without success.
+        sequential : the bound of the stop test, see sequential_quality_bound
+        '''
+        q1 = [[values[2] for values in object_trials.values() if values[0] and values[2] is not None]
+              for object_trials in trials]
+        if not sequential:
+            bound = design_quality_bound(q1_statistics(q1), self.gamma)
+            return (0., 1.) if bound is None else bound
+        bounds = [sequential_quality_bound(q1_, self.sequential_gamma) for q1_ in q1 if q1_]
+        if not bounds:
+            return 0., 1.
+        return tuple(np.mean(bounds, axis=0))
+
+    def __call__(self, trials):
+        '''
+        trials : per object {trial: (success, result_1, q1)} of the job so far -> objects to stop
+        '''
+        if min(len(object_trials) for object_trials in trials) >= self.min_trials:
+            lower, upper = self.design_bound(trials, sequential=True)
+            if upper <= self.dominated_below or lower > self.clear_above:
+                return list(range(len(trials)))
+
+        stop = []
+        for obj_idx, object_trials in enumerate(trials):
+            if not self.min_trials <= len(object_trials) < self.num_trials:
+                continue
+            num_success = len([values for values in object_trials.values() if values[0]])
+            if success_half_width(num_success, len(object_trials), self.sequential_gamma) > self.success_tolerance:
+                continue
+            # an object without success does not enter the Q1 bound
+            q1 = [values[2] for values in object_trials.values() if values[0] and values[2] is not None]
+            if q1:
+                q1_lower, q1_upper = sequential_quality_bound(q1, self.sequential_gamma)
+                if (q1_upper - q1_lower) / 2 > self.q1_tolerance:
+                    continue
+            elif num_success > 0:
+                continue
+            stop += [obj_idx]
+        return stop
+
+
+if __name__ == '__main__':
+    # python -m Simulation.early_stopping : trials saved and decisions changed on synthetic objects
+    rng = np.random.RandomState(0)
+    gamma, num_trials, num_objects = 1.96, 20, 3
+    saved, changed, num_designs = 0, 0, 200
+    for _ in range(num_designs):
+        success_rate = rng.uniform(0.3, 0.9, num_objects)
+        q1_mean = rng.uniform(0.05, 0.3)
+        trials = [{t: (float(rng.rand() < p), None, max(rng.normal(q1_mean, 0.03), 0.)) for t in range(num_trials)}
+                  for p in success_rate]
+        rule = SequentialStop(gamma, num_trials, dominated_below=0.2, clear_above=0.3, q1_tolerance=0.01,
+                              success_tolerance=0.2)
+        # replay the trials in the interleaved order of the worker pool
+        streamed = [{} for _ in range(num_objects)]
+        stopped = set()
+        for t in range(num_trials):
+            for obj_idx in range(num_objects):
+                if obj_idx not in stopped:
+                    streamed[obj_idx][t] = trials[obj_idx][t]
+                    stopped.update(rule(streamed))
+        full_lower, full_upper = rule.design_bound(trials)
+        lower, upper = rule.design_bound(streamed)
+        saved += num_trials * num_objects - sum(len(s) for s in streamed)
+        changed += int((full_upper <= 0.2) != (upper <= 0.2) or (full_lower > 0.3) != (lower > 0.3))
+    print("%d designs: %.1f%% of the trials saved, %d dominance decisions changed"
+          % (num_designs, 100. * saved / (num_designs * num_trials * num_objects), changed))
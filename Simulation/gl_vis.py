@@ -1,80 +1,508 @@
 from .create_design import create_new_design
+from .object_cache import load_object_mesh, prebuild_object_cache, make_geometry, OBJECT_SCALE, SPACING
+from .pose_library import PoseLibrary, prebuild_pose_libraries
+from .result_store import ResultStore, RESULT_STORE, design_key, build_key, object_key
 from .grasp_sim import *
 
-from multiprocessing import Queue, Process
+from multiprocessing import Queue, Process, Manager
+import json
 import queue
+import time
+import traceback
 
-def make_object_from_file(world, file_name):
-    object = Geometry3D()
-    print(file_name)
-    object.loadFile(file_name)
+def make_object_from_file(world, file_name, use_cache=True):
+    if use_cache:
+        vertices, indices, object_r, object_T = load_object_mesh(file_name)
+        object = make_geometry(vertices, indices)
+    else:
+        object = Geometry3D()
+        object.loadFile(file_name)
 
     obj = world.makeRigidObject("object")
     obj.geometry().set(object)
-    obj.geometry().scale(0.35)
+    if not use_cache:
+        obj.geometry().scale(OBJECT_SCALE)
     contact_params = obj.getContactParameters()
     contact_params.kRestitution = 0.0
     contact_params.kFriction = 0.500000
     contact_params.kStiffness = 200000.0
     contact_params.kDamping = 1000.0
     obj.setContactParameters(contact_params)
+    obj.appearance().setColor(0.9, 0, 0.4, 1.0)
+
+    if use_cache:
+        obj.setTransform(*object_T)
+        return object, object_r, object_T
 
     obj.setTransform(*math.se3.identity())
     bmin, bmax = obj.geometry().getBB()
     T = obj.getTransform()
-    spacing = 0.006
-    T = (T[0], math.vectorops.add(T[1], (-(bmin[0] + bmax[0]) * 0.5, -(bmin[1] + bmax[1]) * 0.5, -bmin[2] + spacing)))
+    T = (T[0], math.vectorops.add(T[1], (-(bmin[0] + bmax[0]) * 0.5, -(bmin[1] + bmax[1]) * 0.5, -bmin[2] + SPACING)))
     obj.setTransform(*T)
-    obj.appearance().setColor(0.9, 0, 0.4, 1.0)
 
     r = np.max(np.abs([bmin[0], bmax[0], bmin[1], bmax[1], bmin[2], bmax[2]]))
     return object, np.sqrt(3) * r, T
 
 
+def load_world(world_file):
+    world = WorldModel()
+    res = world.readFile(world_file)
+    if not res:
+        raise RuntimeError("Unable to load world")
+
+    robot = world.robot(0)
+    for i in range(6):
+        m = robot.link(i).getMass()
+        m.setInertia([0.0001] * 3)
+        robot.link(i).setMass(m)
+    return world
+
+
+def apply_design(robot, world_file, length, width, link_angle, radius, link_tilted_angle, curvature=None):
+    s = create_new_design(robot)
+    for i in range(9, 18):
+        s.scale_link_length(i, scale_factor=length[i - 9])
+        if "box" in world_file:
+            s.scale_link_width_box(i, scale_factor=width[i - 9])
+        elif "robotiq" in world_file:
+            s.scale_link_width(i, scale_factor=width[i - 9])
+    s.set_pos_on_palm(6, (radius[0], link_angle[0]), link_tilted_angle[0])
+    s.set_pos_on_palm(7, (radius[1], link_angle[1] + 120), link_tilted_angle[1])
+    s.set_pos_on_palm(8, (radius[2], link_angle[2] + 240), link_tilted_angle[2])
+    if curvature is not None:
+        s.change_curvature(curvature)
+
+
+def hand_mass(robot):
+    mass = 0
+    for i in range(5, robot.numLinks()):
+        mass += robot.link(i).getMass().getMass()
+    return mass
+
+
+class RobotTemplate:
+    '''
+    snapshot of the link geometries, masses and parent transforms of a freshly loaded robot.
+    restore() undoes apply_design() without re-reading the world file.
+    '''
+    def __init__(self, robot):
+        self.robot = robot
+        self.config = robot.getConfig()
+        self.geometries = []
+        self.masses = []
+        self.parent_transforms = []
+        for i in range(robot.numLinks()):
+            link = robot.link(i)
+            if link.geometry().empty():
+                self.geometries.append(None)
+            else:
+                geometry = Geometry3D()
+                geometry.setTriangleMesh(link.geometry().getTriangleMesh())
+                self.geometries.append(geometry)
+            self.masses.append(link.getMass())
+            self.parent_transforms.append(link.getParentTransform())
+
+    def restore(self):
+        for i in range(self.robot.numLinks()):
+            link = self.robot.link(i)
+            if self.geometries[i] is not None:
+                link.geometry().set(self.geometries[i])
+            link.setMass(self.masses[i])
+            link.setParentTransform(*self.parent_transforms[i])
+        self.robot.setConfig(self.config)
+
+
 def do_job(tasks_to_accomplish, result_queue):
     while True:
         try:
-            world_file, object_file, length, width, link_angle, radius, link_tilted_angle, curvature, max_iter\
-                = tasks_to_accomplish.get_nowait()
+            world_file, object_file, length, width, link_angle, radius, link_tilted_angle, curvature, max_iter,\
+                first_trial, sim_options = tasks_to_accomplish.get_nowait()
         except queue.Empty:
             break
         else:
-            world = WorldModel()
-            res = world.readFile(world_file)
-            if not res:
-                raise RuntimeError("Unable to load world")
-
+            world = load_world(world_file)
             robot = world.robot(0)
-            for i in range(6):
-                m = robot.link(i).getMass()
-                m.setInertia([0.0001] * 3)
-                robot.link(i).setMass(m)
-
-            s = create_new_design(robot)
-            for i in range(9, 18):
-                s.scale_link_length(i, scale_factor=length[i - 9])
-                if "box" in world_file:
-                    s.scale_link_width_box(i, scale_factor=width[i - 9])
-                elif "robotiq" in world_file:
-                    s.scale_link_width(i, scale_factor=width[i - 9])
-            s.set_pos_on_palm(6, (radius[0], link_angle[0]), link_tilted_angle[0])
-            s.set_pos_on_palm(7, (radius[1], link_angle[1] + 120), link_tilted_angle[1])
-            s.set_pos_on_palm(8, (radius[2], link_angle[2] + 240), link_tilted_angle[2])
-            if curvature is not None:
-                s.change_curvature(curvature)
+            apply_design(robot, world_file, length, width, link_angle, radius, link_tilted_angle, curvature)
 
             init_config = robot.getConfig()
             obj, object_r, object_T = make_object_from_file(world, object_file)
             set_moving_base_xform(robot, so3.identity(), [1, 1, 1])
             robot.setConfig(init_config)
-            grasp_test_module = GraspGL(world, object_r, object_T, max_iteration=max_iter)
+            grasp_test_module = GraspGL(world, object_r, object_T, max_iteration=max_iter,
+                                        pose_library=PoseLibrary(object_file), first_trial=first_trial,
+                                        **(sim_options or {}))
             grasp_test_module.run_simulation()
             success, quality = grasp_test_module.get_result()
             result_queue.put((object_file, success, quality))
     return True
 
 
-def grasp_test(world_file, length, width, link_angle, radius, link_tilted_angle,object_files, max_iter, curvature=None):
+def do_job_persistent(world_file, tasks_to_accomplish, result_queue, sim_options=None, use_pose_library=True,
+                      stop_flags=None):
+    '''
+    long-lived worker of GraspWorkerPool. the world and the robot template are loaded once;
+    each task only restores the template and applies its design when the design changes.
+    sim_options are extra keyword arguments of GraspGL, e.g. {'batch_q1': True}; the options of a task override them.
+    a streaming task reports every trial as it finishes and stops once stop_flags[(job_id, obj_idx)] is set
+    '''
+    sim_options = {} if sim_options is None else sim_options
+    cold_start = time.time()
+    world = load_world(world_file)
+    robot = world.robot(0)
+    template = RobotTemplate(robot)
+    num_world_objects = world.numRigidObjects()
+    result_queue.put(('ready', time.time() - cold_start))
+
+    current_design = None
+    while True:
+        task = tasks_to_accomplish.get()
+        if task is None:
+            break
+        job_id, obj_idx, design, object_file, num_trials, first_trial, task_options, stream = task
+        if stream and stop_flags.get((job_id, obj_idx), False):
+            result_queue.put(('result', job_id, obj_idx, first_trial, ([], [], []), [], 0.))
+            continue
+        on_trial = should_stop = None
+        if stream:
+            def on_trial(trial, values, trial_time, job_id=job_id, obj_idx=obj_idx):
+                result_queue.put(('trial', job_id, obj_idx, trial, values, trial_time))
+
+            def should_stop(job_id=job_id, obj_idx=obj_idx):
+                return stop_flags.get((job_id, obj_idx), False)
+        try:
+            restore_time = 0.
+            if design != current_design:
+                restore_start = time.time()
+                template.restore()
+                restore_time = time.time() - restore_start
+                apply_design(robot, world_file, *design)
+                current_design = design
+            init_config = robot.getConfig()
+            obj, object_r, object_T = make_object_from_file(world, object_file)
+            set_moving_base_xform(robot, so3.identity(), [1, 1, 1])
+            robot.setConfig(init_config)
+
+            pose_library = PoseLibrary(object_file) if use_pose_library else None
+            grasp_test_module = GraspGL(world, object_r, object_T, max_iteration=num_trials, pose_library=pose_library,
+                                        first_trial=first_trial, on_trial=on_trial, should_stop=should_stop,
+                                        **dict(sim_options, **task_options))
+            grasp_test_module.run_simulation()
+            trials = grasp_test_module.get_trials()
+            trial_times = grasp_test_module.get_trial_times()
+            robot.setConfig(init_config)
+        except Exception:
+            result_queue.put(('error', job_id, obj_idx, traceback.format_exc()))
+            # GraspGL only removes its object at the end of run_simulation; the next task must not grasp it
+            while world.numRigidObjects() > num_world_objects:
+                world.remove(world.rigidObject(world.numRigidObjects() - 1))
+            template.restore()
+            current_design = None
+            continue
+        result_queue.put(('result', job_id, obj_idx, first_trial, trials, trial_times, restore_time))
+    return True
+
+
+class GraspWorkerPool:
+    '''
+    persistent pool of grasp simulation workers shared by every design of an optimize_design run.
+    each object's max_iter trials are split into chunks of trials_per_task trials; the workers pull chunks
+    from one shared queue, so a slow object is spread over several workers instead of holding the design back.
+    usage:
+        pool = GraspWorkerPool(world_file)
+        pool.start()
+        job_id = pool.submit(design, object_files, max_iter)
+        num_success, grasp_result = pool.wait(job_id)
+        pool.close()
+    several jobs can be submitted before the first wait; their chunks share the queue, so a batch of designs keeps
+    every worker busy even with few objects (grasp_test_batch). wait_any returns the first of several jobs to finish.
+    design : (length, width, link_angle, radius, link_tilted_angle, curvature)
+    sim_options : keyword arguments passed to every worker's GraspGL; submit(..., sim_options) overrides them for one
+        job, e.g. {'dt': 0.04} for a low-fidelity evaluation
+    use_pose_library : trials draw their approach poses from the object's pose library, so that every design is
+        evaluated on the same poses; submit(..., first_trial) selects where in the library a job starts
+    result_store : ResultStore or its file name. trials already in the store are not simulated again and every
+        simulated trial is added to it; needs use_pose_library
+    streaming : workers report every trial of the jobs submitted with a stop_rule as soon as it finishes.
+        stop_rule(trials) gets the trials of every object of the job so far, [{trial: (success, result_1, result_2)}],
+        and returns the objects to stop (early_stopping.SequentialStop); their remaining trials are not simulated,
+        the workers see the stop flags through a multiprocessing Manager dict
+    '''
+    def __init__(self, world_file, number_of_processes=8, trials_per_task=None, sim_options=None,
+                 use_pose_library=True, result_store=None, streaming=False):
+        self.world_file = world_file
+        self.number_of_processes = number_of_processes
+        self.trials_per_task = trials_per_task
+        self.sim_options = sim_options
+        self.use_pose_library = use_pose_library
+        if isinstance(result_store, str):
+            result_store = ResultStore(result_store)
+        if result_store is not None and not use_pose_library:
+            raise ValueError("result_store needs use_pose_library")
+        self.result_store = result_store
+        self.build_keys = {}
+        self.object_keys = {}
+        self.streaming = streaming
+        self.manager = None
+        self.stop_flags = None
+        self.tasks_to_accomplish = None
+        self.result_queue = None
+        self.processes = []
+
+        self.world = None
+        self.template = None
+
+        self.next_job_id = 0
+        self.jobs = {}
+
+        self.spawn_time = 0.
+        self.cold_setup_times = []
+        self.restore_times = []
+        self.design_latency = []
+        self.design_num_objects = []
+        self.trials_reused = 0
+        self.trials_simulated = 0
+        self.trials_stopped = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def start(self):
+        if self.processes:
+            return
+        start_time = time.time()
+        self.tasks_to_accomplish = Queue()
+        self.result_queue = Queue()
+        if self.streaming:
+            self.manager = Manager()
+            self.stop_flags = self.manager.dict()
+        for w in range(self.number_of_processes):
+            p = Process(target=do_job_persistent, args=(self.world_file, self.tasks_to_accomplish, self.result_queue,
+                                                            self.sim_options, self.use_pose_library, self.stop_flags))
+            p.daemon = True
+            self.processes.append(p)
+            p.start()
+        self.spawn_time = time.time() - start_time
+
+        self.world = load_world(self.world_file)
+        self.template = RobotTemplate(self.world.robot(0))
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks_to_accomplish.put(None)
+        for p in self.processes:
+            p.join()
+        self.processes = []
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+            self.stop_flags = None
+
+    def design_mass(self, design):
+        self.template.restore()
+        apply_design(self.world.robot(0), self.world_file, *design)
+        return hand_mass(self.world.robot(0))
+
+    def _trials_per_task(self, num_objects, max_iter):
+        trials_per_task = self.trials_per_task
+        if trials_per_task is None:
+            # about 4 chunks per worker keeps every core busy until the end of the design
+            trials_per_task = int(np.ceil(num_objects * max_iter / (4. * self.number_of_processes)))
+        return int(np.clip(trials_per_task, 1, max_iter))
+
+    @staticmethod
+    def _chunks(trials, trials_per_task):
+        '''
+        sorted trial indices -> [(first_trial, num_trials)] of runs of consecutive trials, at most trials_per_task long
+        '''
+        chunks = []
+        for trial in trials:
+            if chunks and chunks[-1][0] + chunks[-1][1] == trial and chunks[-1][1] < trials_per_task:
+                chunks[-1] = (chunks[-1][0], chunks[-1][1] + 1)
+            else:
+                chunks.append((trial, 1))
+        return chunks
+
+    def _object_key(self, object_file):
+        if object_file not in self.object_keys:
+            self.object_keys[object_file] = object_key(object_file)
+        return self.object_keys[object_file]
+
+    def _build_key(self, sim_options):
+        '''
+        result store key of the pool's sim_options updated with the job's; trials simulated with different options are
+        stored apart
+        '''
+        options = dict(self.sim_options or {})
+        options.update(sim_options or {})
+        key = json.dumps(options, sort_keys=True)
+        if key not in self.build_keys:
+            self.build_keys[key] = build_key(self.world_file, options)
+        return self.build_keys[key]
+
+    def submit(self, design, object_files, max_iter, first_trial=0, sim_options=None, stop_rule=None):
+        if not self.processes:
+            raise RuntimeError("worker pool is not started")
+        if stop_rule is not None and not self.streaming:
+            raise ValueError("stop_rule needs a streaming pool")
+        design = tuple(tuple(d) if np.iterable(d) else d for d in design)
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        sim_options = dict(sim_options or {})
+        job = {'object_files': list(object_files), 'max_iter': max_iter, 'first_trial': first_trial,
+               'num_tasks': 0, 'trials': {}, 'stored': {}, 'start': time.time(),
+               'stop_rule': stop_rule, 'streamed': [{} for _ in object_files], 'stopped': set()}
+        if self.result_store is not None:
+            job['design_key'], job['design_parameters'] = design_key(design)
+            job['build_key'] = self._build_key(sim_options)
+
+        trials_per_task = self._trials_per_task(len(object_files), max_iter)
+        object_chunks = []
+        for obj_idx, object_file in enumerate(object_files):
+            missing = range(first_trial, first_trial + max_iter)
+            if self.result_store is not None:
+                stored = self.result_store.lookup(job['design_key'], job['build_key'], self._object_key(object_file),
+                                                  first_trial, max_iter)
+                job['stored'][obj_idx] = stored
+                missing = [trial for trial in missing if trial not in stored]
+                self.trials_reused += len(stored)
+                job['streamed'][obj_idx] = {trial: values[:3] for trial, values in stored.items()}
+            object_chunks.append(self._chunks(missing, trials_per_task))
+        self.jobs[job_id] = job
+        if stop_rule is not None:
+            # the stored trials may already decide some objects
+            for obj_idx in stop_rule(job['streamed']):
+                job['stopped'].add(obj_idx)
+                object_chunks[obj_idx] = []
+
+        # chunk-major order interleaves the objects, so every object makes progress from the start
+        for chunk_idx in range(max([len(chunks) for chunks in object_chunks] + [0])):
+            for obj_idx, object_file in enumerate(object_files):
+                if chunk_idx < len(object_chunks[obj_idx]):
+                    chunk_first_trial, num_trials = object_chunks[obj_idx][chunk_idx]
+                    self.tasks_to_accomplish.put((job_id, obj_idx, design, object_file, num_trials, chunk_first_trial,
+                                                  sim_options, stop_rule is not None))
+                    job['num_tasks'] += 1
+        return job_id
+
+    def _collect_one(self):
+        message = self.result_queue.get()
+        if message[0] == 'ready':
+            self.cold_setup_times += [message[1]]
+            return
+        if message[0] == 'error':
+            raise RuntimeError("grasp worker failed on %s:\n%s"
+                               % (self.jobs[message[1]]['object_files'][message[2]], message[3]))
+        if message[0] == 'trial':
+            self._add_streamed_trial(*message[1:])
+            return
+        _, job_id, obj_idx, first_trial, trials, trial_times, restore_time = message
+        job = self.jobs[job_id]
+        job['trials'][(obj_idx, first_trial)] = trials
+        self.restore_times += [restore_time]
+        self.trials_simulated += len(trials[0])
+        if self.result_store is not None and len(trials[0]) > 0:
+            object_file = job['object_files'][obj_idx]
+            self.result_store.add(job['design_key'], job['build_key'], self._object_key(object_file), first_trial,
+                                  trials, trial_times, job['design_parameters'], object_file)
+
+    def _add_streamed_trial(self, job_id, obj_idx, trial, values, trial_time):
+        '''
+        a trial reported by a streaming worker, the whole chunk follows in its 'result' message
+        '''
+        job = self.jobs[job_id]
+        job['streamed'][obj_idx][trial] = values
+        if obj_idx in job['stopped']:
+            return
+        for obj_idx_ in job['stop_rule'](job['streamed']):
+            if obj_idx_ not in job['stopped']:
+                job['stopped'].add(obj_idx_)
+                self.stop_flags[(job_id, obj_idx_)] = True
+
+    def is_done(self, job_id):
+        job = self.jobs[job_id]
+        return len(job['trials']) == job['num_tasks']
+
+    def wait_any(self, job_ids):
+        '''
+        collect results until one of job_ids is done and return its id; wait(job_id) then returns at once
+        '''
+        while True:
+            for job_id in job_ids:
+                if self.is_done(job_id):
+                    return job_id
+            self._collect_one()
+
+    def wait(self, job_id, return_trials=False):
+        '''
+        returns (num_success, grasp_result), with return_trials also the number of trials of every object, less than
+        max_iter for the objects the stop_rule stopped
+        '''
+        while not self.is_done(job_id):
+            self._collect_one()
+        job = self.jobs.pop(job_id)
+        self.design_latency += [time.time() - job['start']]
+        self.design_num_objects += [len(job['object_files'])]
+
+        num_success = []
+        grasp_result = []
+        trials_run = []
+        for obj_idx in range(len(job['object_files'])):
+            # trial index -> (success, result_1, result_2), stored and simulated trials merged in trial order
+            trials = {trial: values[:3] for trial, values in job['stored'].get(obj_idx, {}).items()}
+            for (obj_idx_, first_trial), (success_, result_1_, result_2_) in job['trials'].items():
+                if obj_idx_ == obj_idx:
+                    for i in range(len(success_)):
+                        trials[first_trial + i] = (success_[i], result_1_[i], result_2_[i])
+            ordered = [trials[trial] for trial in sorted(trials)]
+            result_success_prob = [t[0] for t in ordered]
+            result_1 = [t[1] for t in ordered]
+            result_2 = [t[2] for t in ordered]
+            num_trials = job['max_iter']
+            if obj_idx in job['stopped']:
+                num_trials = len(ordered)
+                self.trials_stopped += job['max_iter'] - num_trials
+                self.stop_flags.pop((job_id, obj_idx), None)
+            success, quality = collect_result(result_success_prob, result_1, result_2, num_trials)
+            num_success += [success]
+            grasp_result += [quality]
+            trials_run += [num_trials]
+        if return_trials:
+            return num_success, grasp_result, trials_run
+        return num_success, grasp_result
+
+    def report(self):
+        '''
+        the legacy path of grasp_test spawns the processes once per design and loads the world once per object;
+        the warm workers pay both once per run and only restore the robot template when the design changes.
+        the latency saved per design is estimated from these timings; grasp_benchmark.benchmark_worker_pool measures it
+        '''
+        if len(self.design_latency) == 0:
+            print("worker pool: no design evaluated")
+            return None
+        num_designs = len(self.design_latency)
+        tasks_per_design = len(self.restore_times) / num_designs
+        objects_per_design = np.mean(self.design_num_objects)
+        cold_setup = np.mean(self.cold_setup_times) if len(self.cold_setup_times) > 0 else 0.
+        restore = np.mean(self.restore_times)
+        saved = self.spawn_time \
+            + (objects_per_design * cold_setup - tasks_per_design * restore) / self.number_of_processes
+        print("worker pool: %d designs, mean latency %.3f s" % (num_designs, np.mean(self.design_latency)))
+        print("   spawn %.3f s, world loading %.3f s/task, template restore %.3f s/task"
+              % (self.spawn_time, cold_setup, restore))
+        print("   latency saved per design : %.3f s (estimate)" % saved)
+        if self.result_store is not None:
+            print("   result store: %d trials reused, %d simulated" % (self.trials_reused, self.trials_simulated))
+        if self.streaming:
+            print("   early stopping: %d trials not simulated" % self.trials_stopped)
+        return saved
+
+
+def grasp_test(world_file, length, width, link_angle, radius, link_tilted_angle,object_files, max_iter, curvature=None,
+               pool=None, first_trial=0, sim_options=None, make_stop_rule=None, return_trials=False):
     """
     length : (9,)
     width : (9,)
@@ -82,38 +510,28 @@ def grasp_test(world_file, length, width, link_angle, radius, link_tilted_angle,
     radius : (3,)
     link_tilted_angle(3,)
     gamma : constant ( real value < 1)
+    pool : GraspWorkerPool. if None, spawns new processes for this design only.
+    first_trial : index of the first trial in the objects' pose libraries, e.g. the number of trials a design
+        already has when it is re-evaluated
+    sim_options : keyword arguments of GraspGL for this design only, e.g. {'dt': 0.04}
+    make_stop_rule : function of the hand mass returning the stop_rule of the pool job (GraspWorkerPool streaming)
+        or None; ignored without pool
+    return_trials : also return the number of trials run on every object, see GraspWorkerPool.wait
     """
-    world = WorldModel()
-    res = world.readFile(world_file)
-    if not res:
-        raise RuntimeError("Unable to load world")
+    if pool is not None:
+        design = (length, width, link_angle, radius, link_tilted_angle, curvature)
+        mass = pool.design_mass(design)
+        stop_rule = None if make_stop_rule is None else make_stop_rule(mass)
+        job_id = pool.submit(design, object_files, max_iter, first_trial, sim_options, stop_rule)
+        num_success, grasp_result, trials_run = pool.wait(job_id, return_trials=True)
+        if return_trials:
+            return num_success, grasp_result, mass, trials_run
+        return num_success, grasp_result, mass
 
+    world = load_world(world_file)
     robot = world.robot(0)
-    for i in range(6):
-        m = robot.link(i).getMass()
-        m.setInertia([0.0001]*3)
-        robot.link(i).setMass(m)
-
-    original_mass = 0
-    for i in range(5, robot.numLinks()):
-        original_mass += robot.link(i).getMass().getMass()
-
-    s = create_new_design(robot)
-    for i in range(9, 18):
-        s.scale_link_length(i, scale_factor=length[i - 9])
-        if "box" in world_file:
-            s.scale_link_width_box(i, scale_factor=width[i - 9])
-        elif "robotiq" in world_file:
-            s.scale_link_width(i, scale_factor=width[i - 9])
-    s.set_pos_on_palm(6, (radius[0], link_angle[0]), link_tilted_angle[0])
-    s.set_pos_on_palm(7, (radius[1], link_angle[1] + 120), link_tilted_angle[1])
-    s.set_pos_on_palm(8, (radius[2], link_angle[2] + 240), link_tilted_angle[2])
-    if curvature is not None:
-        s.change_curvature(curvature)
-
-    mass = 0
-    for i in range(5, robot.numLinks()):
-        mass += robot.link(i).getMass().getMass()
+    apply_design(robot, world_file, length, width, link_angle, radius, link_tilted_angle, curvature)
+    mass = hand_mass(robot)
 
     grasp_result = []
     num_success =[]
@@ -140,7 +558,8 @@ def grasp_test(world_file, length, width, link_angle, radius, link_tilted_angle,
     tasks_to_accomplish = Queue()
     for object in object_files:
         tasks_to_accomplish.put(
-            [world_file, object, length, width, link_angle, radius, link_tilted_angle, curvature, max_iter])
+            [world_file, object, length, width, link_angle, radius, link_tilted_angle, curvature, max_iter,
+             first_trial, sim_options])
     result_queue = Queue()
     for w in range(number_of_processes):
         p = Process(target=do_job, args=(tasks_to_accomplish, result_queue))
@@ -165,4 +584,38 @@ def grasp_test(world_file, length, width, link_angle, radius, link_tilted_angle,
         num_success += [prev_success[arg_sort[idx]]]
         grasp_result += [prev_quality[arg_sort[idx]]]
 
+    if return_trials:
+        return num_success, grasp_result, mass, [max_iter] * len(object_files)
     return num_success, grasp_result, mass
+
+
+def grasp_test_batch(world_file, designs, object_files, max_iter, pool=None, first_trials=None, sim_options=None,
+                     make_stop_rule=None, return_trials=False):
+    """
+    designs : [(length, width, link_angle, radius, link_tilted_angle, curvature)] as in grasp_test
+    first_trials : first trial of every design, default 0
+    make_stop_rule : as in grasp_test, called with the mass of every design
+    every design is submitted to the pool before the first one is waited for, so the workers are busy with the
+    whole batch even when there are fewer object chunks per design than workers.
+    returns [(num_success, grasp_result, mass)] in the order of designs, with return_trials
+    [(num_success, grasp_result, mass, trials run per object)]
+    """
+    if first_trials is None:
+        first_trials = [0] * len(designs)
+    if pool is None:
+        return [grasp_test(world_file, *design[:5], object_files=object_files, max_iter=max_iter, curvature=design[5],
+                           first_trial=first_trial, sim_options=sim_options, return_trials=return_trials)
+                for design, first_trial in zip(designs, first_trials)]
+
+    masses = []
+    job_ids = []
+    for design, first_trial in zip(designs, first_trials):
+        masses += [pool.design_mass(design)]
+        stop_rule = None if make_stop_rule is None else make_stop_rule(masses[-1])
+        job_ids += [pool.submit(design, object_files, max_iter, first_trial, sim_options, stop_rule)]
+    results = []
+    for job_id, mass in zip(job_ids, masses):
+        num_success, grasp_result, trials_run = pool.wait(job_id, return_trials=True)
+        results += [(num_success, grasp_result, mass, trials_run)] if return_trials \
+            else [(num_success, grasp_result, mass)]
+    return results
@@ -3,21 +3,122 @@ from klampt.vis import GLRealtimeProgram
 from klampt.model import contact
 import numpy as np
 from klampt import vis
+import time
 
 from .moving_base import *
 from . import utils
 from .directions import Directions
-from .computeQ1UpperBound import compute_Q1
+from .computeQ1UpperBound import compute_Q1, compute_Q1_batched
+
+DEFAULT_DT = 0.02
+# m/s of the hand along its approach direction, 0.01 per step at the default dt
+APPROACH_SPEED = 0.5
+
+
+class ContactSnapshot:
+    '''
+    contacts of the object with every hand link at one simulation step, read with a single pass over the simulator.
+    points [n,3], normals [n,3], friction [n] and link_idx [n] are preallocated and only grown when a step has
+    more contacts than ever before; the valid rows are [:count].
+    links with empty geometry (the moving base) can not be in contact and are never queried.
+    '''
+    def __init__(self, world, capacity=64):
+        self.world = world
+        self.object_id = world.rigidObject(0).getID()
+        self.terrain_id = world.terrain(0).getID()
+        robot = world.robot(0)
+        self.links = [idx for idx in range(robot.numLinks()) if not robot.link(idx).geometry().empty()]
+        self.link_ids = [robot.link(idx).getID() for idx in self.links]
+
+        self.points = np.zeros((capacity, 3))
+        self.normals = np.zeros((capacity, 3))
+        self.friction = np.zeros(capacity)
+        self.link_idx = np.zeros(capacity, dtype=int)
+        self.count = 0
+        self.contacted_links = []
+        self.object_position = None
+        self.time = None
+
+        self.num_queries = 0
+        self.query_time = 0.
+
+    def _reserve(self, n):
+        capacity = self.points.shape[0]
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity)
+        self.points = np.resize(self.points, (capacity, 3))
+        self.normals = np.resize(self.normals, (capacity, 3))
+        self.friction = np.resize(self.friction, capacity)
+        self.link_idx = np.resize(self.link_idx, capacity)
+
+    def update(self, sim):
+        start = time.time()
+        count = 0
+        contacted_links = []
+        for idx, link_id in zip(self.links, self.link_ids):
+            self.num_queries += 1
+            if not sim.inContact(self.object_id, link_id):
+                continue
+            contact_points = sim.getContacts(self.object_id, link_id)
+            self.num_queries += 1
+            contacted_links += [idx]
+            n = len(contact_points)
+            if n == 0:
+                continue
+            self._reserve(count + n)
+            contact_points = np.asarray(contact_points)
+            self.points[count:count + n] = contact_points[:, 0:3]
+            self.normals[count:count + n] = contact_points[:, 3:6]
+            self.friction[count:count + n] = contact_points[:, 6]
+            self.link_idx[count:count + n] = idx
+            count += n
+
+        self.count = count
+        self.contacted_links = contacted_links
+        self.object_position = np.asarray(sim.body(self.world.rigidObject(0)).getTransform()[1])
+        self.time = sim.getTime()
+        self.query_time += time.time() - start
+
+    def update_terrain(self, sim):
+        '''
+        number of contacts of the hand with the terrain; only needed while approaching
+        '''
+        start = time.time()
+        num_contacts = 0
+        for link_id in self.link_ids:
+            self.num_queries += 1
+            if sim.inContact(self.terrain_id, link_id):
+                num_contacts += len(sim.getContacts(self.terrain_id, link_id))
+                self.num_queries += 1
+        self.query_time += time.time() - start
+        return num_contacts
 
 
 class Grasp(GLRealtimeProgram):
-    def __init__(self, world, sim):
+    '''
+    contact_snapshot: every consumer of the contacts of a step (check_contacts, check_force_closure,
+    construct_wrench_space) reads one ContactSnapshot. with contact_snapshot=False each of them re-queries the
+    simulator, as before; kept for step_stats comparisons.
+    dt: simulation timestep. the approach and finger speeds and the force-closure and failure durations are kept
+    in seconds, so a coarser dt simulates the same grasp with fewer steps.
+    '''
+    def __init__(self, world, sim, defer_q1=False, contact_snapshot=True, dt=DEFAULT_DT):
         GLRealtimeProgram.__init__(self, "GLTest")
         self.world = world
         self.sim = sim
+        self.defer_q1 = defer_q1
+        self.result_contact_set = None
+        self.contact_snapshot = contact_snapshot
+        self.contacts = ContactSnapshot(world)
+        self.num_steps = 0
+        self.step_time = 0.
         self.sim.enableContactFeedbackAll()
-        self.dt = 0.02
+        self.dt = dt
         self.angular_velocity = 0.5
+        # steps of force closure before success and of failed tests before giving up, 20 and 80 at the default dt
+        self.closure_steps = int(round(20 * DEFAULT_DT / dt))
+        self.failure_steps = int(round(80 * DEFAULT_DT / dt))
 
         self.hand_state = 2
         self.joint_limits = self.world.robot(0).getJointLimits()
@@ -44,26 +145,20 @@ class Grasp(GLRealtimeProgram):
         self.iter_shaking = 0
         self.dynamic_score = 0.0
 
+    def get_contacts(self):
+        contacts = self.contacts
+        if not self.contact_snapshot or contacts.time != self.sim.getTime():
+            contacts.update(self.sim)
+        return contacts
+
     def check_contacts(self):
-        num_contacts = 0
-        contacted_links = []
-        for idx in range(5, 18):
-            link_id = self.world.robot(0).link(idx).getID()
-            if self.sim.inContact(self.object_id, link_id):
-                contact_points = self.sim.getContacts(self.object_id, link_id)
-                num_contacts += len(contact_points)
-                contacted_links += [idx]
-        return num_contacts, contacted_links
+        contacts = self.get_contacts()
+        hand_links = [idx for idx in contacts.contacted_links if idx >= 5]
+        num_contacts = int(np.count_nonzero(contacts.link_idx[:contacts.count] >= 5))
+        return num_contacts, hand_links
 
     def check_contacts_terrain(self):
-        num_contacts = 0
-        terrain_id = self.world.terrain(0).getID()
-        for idx in range(5, 18):
-            link_id = self.world.robot(0).link(idx).getID()
-            if self.sim.inContact(terrain_id, link_id):
-                contact_points = self.sim.getContacts(terrain_id, link_id)
-                num_contacts += len(contact_points)
-        return num_contacts > 0
+        return self.contacts.update_terrain(self.sim) > 0
 
     def change_hand_state(self, is_success=None, gws_result=None, collide_terrain=None):
         if self.hand_state == 2:  # approaching -> grasping
@@ -118,49 +213,35 @@ class Grasp(GLRealtimeProgram):
         return self.hand_state
 
     def check_force_closure(self):
-        clist = []
-        for idx in range(self.world.robot(0).numLinks()):
-            link_id = self.world.robot(0).link(idx).getID()
-            if self.sim.inContact(self.object_id, link_id):
-                contact_points = self.sim.getContacts(self.object_id, link_id)
-                # forces = self.sim.getContactForces(self.object_id, link_id)
-                for pt_idx in range(len(contact_points)):
-                    x = np.asarray(contact_points[pt_idx][:3])
-                    n = np.asarray(contact_points[pt_idx][3:6])
-                    k = contact_points[pt_idx][6]
-                    clist.append(contact.ContactPoint(x, n, k))
+        contacts = self.get_contacts()
+        clist = [contact.ContactPoint(contacts.points[i], contacts.normals[i], contacts.friction[i])
+                 for i in range(contacts.count)]
         return contact.forceClosure(clist)
 
     def construct_wrench_space(self):
-        contact_list = []
-
-        for idx in range(self.world.robot(0).numLinks()):
-            link_id = self.world.robot(0).link(idx).getID()
-
-            if self.sim.inContact(self.object_id, link_id):
-                contact_list += self.sim.getContacts(self.object_id, link_id)
-
-        contacts = np.asarray(contact_list)
-        k_friction = self.world.rigidObject(0).getContactParameters().kFriction
-
+        pss, dss, nss, k_friction = self.get_contact_set()
+        if self.defer_q1:
+            # Q1 is evaluated later for all trials at once by GraspGL
+            self.result_contact_set = (pss, dss, nss, k_friction)
+            return None, None
         dirs = Directions(res=2)
-        pss = []
-        dss = []
-        nss =[]
-
-        num_contact = contacts[:, 3:6].shape[0]
-        for idx in range(num_contact):
-            p = np.asarray(contacts[idx, 0:3])
-            c =np.asarray(self.sim.body(self.world.rigidObject(0)).getTransform()[1])
-            n = np.asarray(contacts[idx, 3:6])
-            p = p-c
-            n = n/np.linalg.norm(n)
-            dss.append(np.random.uniform(-1,1))
-            nss.append(n)
-            pss.append(p)
         q = compute_Q1(None, k_friction, 0., pss, dss, nss, dirs.dirs, analytic=True)
         return None, q
 
+    def get_contact_set(self):
+        contacts = self.get_contacts()
+        k_friction = self.world.rigidObject(0).getContactParameters().kFriction
+
+        pss = list(contacts.points[:contacts.count] - contacts.object_position)
+        nss = list(contacts.normals[:contacts.count] /
+                   np.linalg.norm(contacts.normals[:contacts.count], axis=1, keepdims=True))
+        dss = [np.random.uniform(-1, 1) for _ in range(contacts.count)]
+        return pss, dss, nss, k_friction
+
+    def get_step_stats(self):
+        return {'steps': self.num_steps, 'step_time': self.step_time,
+                'contact_queries': self.contacts.num_queries, 'contact_time': self.contacts.query_time}
+
     # def display(self):
     #     self.sim.updateWorld()
     #     self.world.drawGL()
@@ -173,6 +254,7 @@ class Grasp(GLRealtimeProgram):
                 return
 
     def idle(self):
+        step_start = time.time()
         controller = self.sim.controller(0)
         if self.sim.getTime() >= 1 and self.hand_state > 1:
             num_contacts, contacted_links = self.check_contacts()
@@ -183,7 +265,7 @@ class Grasp(GLRealtimeProgram):
                     if self.check_contacts_terrain():
                         self.change_hand_state(collide_terrain=True)
                     T = self.world.robot(0).link(5).getTransform()
-                    translation = math.vectorops.add(so3.apply(T[0], [0, 0, -0.01]), T[1])
+                    translation = math.vectorops.add(so3.apply(T[0], [0, 0, -APPROACH_SPEED * self.dt]), T[1])
                     send_moving_base_xform_linear(controller, T[0], translation, self.dt)
             elif self.hand_state == 3:
                 q = controller.getCommandedConfig()
@@ -199,13 +281,13 @@ class Grasp(GLRealtimeProgram):
                     self.is_forceClosure = self.check_force_closure()
                     if self.is_forceClosure:
                         self.num_forceClosure += 1
-                        if self.num_forceClosure > 20:
+                        if self.num_forceClosure > self.closure_steps:
                             avg, max_radius = self.construct_wrench_space()
                             self.change_hand_state(is_success=True, gws_result=(avg, max_radius))
                     else:
                         self.num_failures += 1
                         self.num_forceClosure = 0
-                if self.num_failures > 80:
+                if self.num_failures > self.failure_steps:
                     self.change_hand_state(is_success=False)
                     print('     fail!')
             # elif self.hand_state == 4:
@@ -257,11 +339,15 @@ class Grasp(GLRealtimeProgram):
             #                 self.dynamic_score = 0.75
             #             self.change_hand_state()
         self.sim.simulate(self.dt)
+        self.num_steps += 1
+        self.step_time += time.time() - step_start
         return
 
 
 class GraspGL:
-    def __init__(self, world, object_radius, object_T, max_iteration=10):
+    def __init__(self, world, object_radius, object_T, max_iteration=10, batch_q1=False, contact_snapshot=True,
+                 fast_approach=False, approach_standoff=0.02, prescreen=False, pose_library=None, first_trial=0,
+                 dt=DEFAULT_DT, on_trial=None, should_stop=None):
         self.world = world
         self.object_id = self.world.rigidObject(0).getID()
         self.object_r = object_radius + 0.4
@@ -277,10 +363,51 @@ class GraspGL:
         self.result_success_prob = []
         self.result_1 = [] #result_gws_volume or dynamic simulation result
         self.result_2 = [] #result gws max radius
-
-    def _get_new_transform(self):
+        self.result_time = [] #wall time of every trial, rejected attempts included
+
+        # batch_q1: keep the contact set of every successful grasp and evaluate all their Q1 in one
+        # ComputeQ1Layer call at the end of run_simulation
+        self.batch_q1 = batch_q1
+        self.result_contact_set = []
+
+        # summed Grasp.get_step_stats of every simulated trial
+        self.contact_snapshot = contact_snapshot
+        self.step_stats = {}
+
+        # fast_approach: move the hand in free space along its approach direction until it is approach_standoff
+        # away from the object or the terrain before the dynamic simulation starts, see _fast_forward_approach
+        self.fast_approach = fast_approach
+        self.approach_standoff = approach_standoff
+        self.dt = dt
+        self.approach_step = APPROACH_SPEED * dt  # distance the hand moves per step in Grasp.idle
+
+        # prescreen: sweep the hand along the approach path with collision queries and draw a new pose without
+        # simulating it if it would hit the terrain before the object. 'audit' simulates every pose anyway and
+        # logs (predicted terrain hit, final hand state) in prescreen_log
+        self.prescreen = prescreen
+        self.sweep_step = self.approach_step / 2
+        self.prescreen_log = []
+        self.final_hand_state = None
+
+        # pose_library: pose_library.PoseLibrary of the object. attempt a of trial first_trial + i uses
+        # pose_library.pose(a, first_trial + i), so every design sees the same poses; attempts beyond
+        # pose_library.num_attempts fall back to utils.sample_hemisphere
+        self.pose_library = pose_library
+        self.first_trial = first_trial
+
+        # streaming: on_trial(trial, (success, result_1, result_2), wall time) is called as soon as a trial is done,
+        # with its Q1 even if batch_q1 is set; should_stop() is asked before every new trial and ends the run early,
+        # get_result then covers the trials run so far
+        self.on_trial = on_trial
+        self.should_stop = should_stop
+        self.stopped = False
+
+    def _get_new_transform(self, trial=None, attempt=0):
         object_origin = self.object_T[1]
-        point_sphere = utils.sample_hemisphere(70)
+        if self.pose_library is not None and trial is not None and attempt < self.pose_library.num_attempts:
+            point_sphere = self.pose_library.pose(attempt, trial)
+        else:
+            point_sphere = utils.sample_hemisphere(70)
         R = math.so3.canonical(point_sphere)
         new_R = np.zeros(9)
         new_R[6:9] = R[:3]
@@ -290,27 +417,128 @@ class GraspGL:
 
     def run_simulation(self):
         iteration = 0
+        attempt = 0
+        trial_start = time.time()
         while iteration < self.max_iteration:
+            if attempt == 0 and self.should_stop is not None and self.should_stop():
+                self.stopped = True
+                break
             # Set object position & set robot position
-            self.hand_se3_goal = self._get_new_transform()
+            self.hand_se3_goal = self._get_new_transform(self.first_trial + iteration, attempt)
+            attempt += 1
             set_moving_base_xform(self.world.robot(0), *self.hand_se3_goal)
             q = self.world.robot(0).getConfig()
             for i in range(9, 18):
                 q[i] = self.init_q[i]
             self.world.robot(0).setConfig(q)
             self.world.rigidObject(0).setTransform(*self.object_T)
+            predicted_terrain = False
+            if self.fast_approach or self.prescreen:
+                predicted_terrain = not self._prepare_approach()
+                if predicted_terrain and self.prescreen is True:
+                    continue
+            start = time.time()
             is_simulation_success = self._simulation()
+            self._add_stats(trials=1, trial_time=time.time() - start)
+            if self.final_hand_state == 0:
+                self._add_stats(terrain_trials=1, terrain_trial_time=time.time() - start)
+            if self.prescreen == 'audit':
+                self.prescreen_log += [(predicted_terrain, self.final_hand_state)]
             if is_simulation_success:
                 iteration += 1
+                attempt = 0
+                self.result_time += [time.time() - trial_start]
+                trial_start = time.time()
+                if self.on_trial is not None:
+                    self.on_trial(self.first_trial + iteration - 1,
+                                  (self.result_success_prob[-1], self.result_1[-1], self.result_2[-1]),
+                                  self.result_time[-1])
         self.world.remove(self.world.rigidObject(0))
+        if self.batch_q1:
+            self._evaluate_q1_batched()
         return
 
+    def _add_stats(self, **stats):
+        for key, value in stats.items():
+            self.step_stats[key] = self.step_stats.get(key, 0) + value
+
+    def _prepare_approach(self):
+        '''
+        fast_approach: leaves the hand at the standoff pose found by _advance_to_standoff.
+        prescreen: returns False if the swept approach path of the hand hits the terrain before the object.
+        '''
+        start = time.time()
+        robot = self.world.robot(0)
+        R, t = self.hand_se3_goal
+        direction = so3.apply(R, [0, 0, -1])
+        obstacles = [self.world.rigidObject(0).geometry(), self.world.terrain(0).geometry()]
+        hand = [robot.link(idx).geometry() for idx in range(5, 18)]
+
+        t_standoff, travelled = self._advance_to_standoff(R, t, direction, hand, obstacles)
+        hits_object = True
+        if self.prescreen:
+            hits_object = self._first_hit(R, t_standoff, direction, hand, obstacles) != 1
+            self._add_stats(prescreen_poses=1, prescreen_rejected=int(not hits_object),
+                            prescreen_time=time.time() - start)
+
+        if self.fast_approach:
+            self.hand_se3_goal = (R, t_standoff)
+            self._add_stats(approach_steps_saved=int(travelled / self.approach_step))
+        set_moving_base_xform(robot, *self.hand_se3_goal)
+        self._add_stats(approach_time=time.time() - start)
+        return hits_object
+
+    def _advance_to_standoff(self, R, t, direction, hand, obstacles, max_advance=20):
+        '''
+        conservative advancement: no part of the hand is closer than the distance d to the object or the terrain,
+        so it can move d - approach_standoff along any direction without touching either of them.
+        '''
+        robot = self.world.robot(0)
+        travelled = 0.
+        for _ in range(max_advance):
+            d = min(geometry_distance(link, obstacle) for link in hand for obstacle in obstacles)
+            if d <= self.approach_standoff * 1.05:
+                break
+            t = math.vectorops.madd(t, direction, d - self.approach_standoff)
+            travelled += d - self.approach_standoff
+            set_moving_base_xform(robot, R, t)
+        return t, travelled
+
+    def _first_hit(self, R, t, direction, hand, obstacles):
+        '''
+        index of the obstacle the hand collides with first when swept from t along direction, None if it hits nothing
+        within object_r. the object is checked first, as in Grasp.idle.
+        '''
+        robot = self.world.robot(0)
+        travelled = 0.
+        while travelled <= self.object_r:
+            set_moving_base_xform(robot, R, math.vectorops.madd(t, direction, travelled))
+            for idx, obstacle in enumerate(obstacles):
+                if any(link.collides(obstacle) for link in hand):
+                    return idx
+            travelled += self.sweep_step
+        return None
+
+    def _evaluate_q1_batched(self):
+        trial_idx = [i for i, c in enumerate(self.result_contact_set) if c is not None]
+        if len(trial_idx) == 0:
+            return
+        contact_sets = [self.result_contact_set[i] for i in trial_idx]
+        k_friction = contact_sets[0][3]
+        q = compute_Q1_batched(None, k_friction, 0., [c[0] for c in contact_sets], [c[1] for c in contact_sets],
+                               [c[2] for c in contact_sets], Directions(res=2).dirs)
+        for i, q_i in zip(trial_idx, q):
+            self.result_2[i] = q_i
+
     def _simulation(self):
         sim = Simulator(self.world)
-        glRealProgram = Grasp(self.world, sim)
+        glRealProgram = Grasp(self.world, sim, defer_q1=self.batch_q1 and self.on_trial is None,
+                              contact_snapshot=self.contact_snapshot, dt=self.dt)
         glRealProgram.run()
+        self._add_stats(**glRealProgram.get_step_stats())
 
         final_hand_state = glRealProgram.get_hand_state()
+        self.final_hand_state = final_hand_state
         if final_hand_state == 0:
             # Collide with Terrain
             return False
@@ -323,16 +551,40 @@ class GraspGL:
         self.result_success_prob += [result[0]]
         self.result_1 += [result[1]]
         self.result_2 += [result[2]]
+        self.result_contact_set += [glRealProgram.result_contact_set]
         return True
 
+    def get_trials(self):
+        return self.result_success_prob, self.result_1, self.result_2
+
+    def get_trial_times(self):
+        return self.result_time
+
     def get_result(self):
-        cond = np.asarray(self.result_success_prob, dtype=bool)
-        if len(cond) != self.max_iteration:
-            raise RuntimeError("Result size is not same with max iteration")
-        num_success = cond.sum()
-        result = np.empty((2, 0))
-        if num_success > 0:
-            result1 = np.extract(cond, np.asarray(self.result_1)) #vol or dynamic simulation result
-            result2 = np.extract(cond, np.asarray(self.result_2)) #radius
-            result = np.hstack((result, [result1, result2]))
-        return result.shape[1], result
+        num_trials = len(self.result_success_prob) if self.stopped else self.max_iteration
+        return collect_result(self.result_success_prob, self.result_1, self.result_2, num_trials)
+
+
+def geometry_distance(geometry_a, geometry_b):
+    '''
+    Geometry3D.distance returns a float in klampt 0.8 and a DistanceQueryResult in later versions;
+    negative (signed) distances of penetrating geometries count as 0
+    '''
+    d = geometry_a.distance(geometry_b)
+    return max(getattr(d, 'd', d), 0.)
+
+
+def collect_result(result_success_prob, result_1, result_2, max_iteration):
+    '''
+    per-trial lists (possibly merged from several GraspGL runs on the same object) -> (num_success, [2, num_success])
+    '''
+    cond = np.asarray(result_success_prob, dtype=bool)
+    if len(cond) != max_iteration:
+        raise RuntimeError("Result size is not same with max iteration")
+    num_success = cond.sum()
+    result = np.empty((2, 0))
+    if num_success > 0:
+        result1 = np.extract(cond, np.asarray(result_1)) #vol or dynamic simulation result
+        result2 = np.extract(cond, np.asarray(result_2)) #radius
+        result = np.hstack((result, [result1, result2]))
+    return result.shape[1], result
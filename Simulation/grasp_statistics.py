@@ -0,0 +1,113 @@
+"""Running Q1 statistics of every (design, object) pair, updated in place as re-evaluations add trials"""
+
+import numpy as np
+
+STATISTICS_DTYPE = np.dtype([('count', np.int64), ('mean', np.float64), ('m2', np.float64), ('max', np.float64)])
+
+
+def object_statistics(grasp_quality):
+    '''
+    grasp_quality : per object [2, num_success] as grasp_test returns it -> [num_objects] STATISTICS_DTYPE
+    of the Q1 row
+    '''
+    return q1_statistics([quality[1] for quality in grasp_quality])
+
+
+def q1_statistics(q1_per_object):
+    '''
+    per object the Q1 of its successful trials -> [num_objects] STATISTICS_DTYPE
+    '''
+    statistics = np.zeros(len(q1_per_object), dtype=STATISTICS_DTYPE)
+    statistics['max'] = -np.inf
+    merge(statistics, q1_per_object)
+    return statistics
+
+
+def merge(statistics, q1_per_object):
+    '''
+    add the Q1 of new trials to statistics in place, the parallel variance update of Chan et al.:
+    only the count, mean, sum of squared deviations and max of each object are kept
+    '''
+    for obj_idx, q1 in enumerate(q1_per_object):
+        q1 = np.asarray(q1, dtype=float)
+        if q1.shape[0] == 0:
+            continue
+        count, mean = statistics['count'][obj_idx], statistics['mean'][obj_idx]
+        batch_mean = np.mean(q1)
+        total = count + q1.shape[0]
+        delta = batch_mean - mean
+        statistics['mean'][obj_idx] = mean + delta * q1.shape[0] / total
+        statistics['m2'][obj_idx] += np.sum((q1 - batch_mean) ** 2) + delta ** 2 * count * q1.shape[0] / total
+        statistics['max'][obj_idx] = np.maximum(statistics['max'][obj_idx], np.max(q1))
+        statistics['count'][obj_idx] = total
+
+
+def quality_bounds(statistics, gamma):
+    '''
+    per object Q1 (lower, upper) = [max, max + 2 gamma std / sqrt(n)], the noise of a single success is 1.
+    objects without success are nan
+    '''
+    count = statistics['count']
+    std = np.sqrt(statistics['m2'] / np.maximum(count, 1))
+    noise = np.where(count == 1, 1., std * gamma / np.sqrt(np.maximum(count, 1)))
+    lower = np.where(count > 0, statistics['max'], np.nan)
+    return lower, lower + 2 * noise
+
+
+def design_quality_bound(statistics, gamma):
+    '''
+    Q1 (lower, upper) of a design, the quality_bounds of its objects averaged over the objects with a success;
+    None without success
+    '''
+    success = statistics['count'] > 0
+    if not np.any(success):
+        return None
+    lower, upper = quality_bounds(statistics, gamma)
+    return np.mean(lower[success]), np.mean(upper[success])
+
+
+class GraspStatistics:
+    '''
+    [num_designs, num_objects] STATISTICS_DTYPE in a preallocated array that doubles when full.
+    adding the trials of a re-evaluation costs O(trials), and the memory of a design does not grow with its rounds
+    '''
+    def __init__(self, num_objects, capacity=16):
+        self.num_objects = num_objects
+        self.num_designs = 0
+        self.data = np.zeros((capacity, num_objects), dtype=STATISTICS_DTYPE)
+
+    def __len__(self):
+        return self.num_designs
+
+    def __getitem__(self, idx):
+        '''
+        a copy of the [num_objects] statistics of design idx: a view would go stale once the array doubles
+        '''
+        return self.data[self._index(idx)].copy()
+
+    def _index(self, idx):
+        if not -self.num_designs <= idx < self.num_designs:
+            raise IndexError("design %d of %d" % (idx, self.num_designs))
+        return idx % self.num_designs
+
+    def append(self, grasp_quality):
+        '''
+        returns the index of the new design
+        '''
+        return self.append_statistics(object_statistics(grasp_quality))
+
+    def append_statistics(self, statistics):
+        if self.num_designs == self.data.shape[0]:
+            self.data = np.vstack((self.data, np.zeros_like(self.data)))
+        self.data[self.num_designs] = statistics
+        self.num_designs += 1
+        return self.num_designs - 1
+
+    def add_trials(self, idx, grasp_quality):
+        merge(self.data[self._index(idx)], [quality[1] for quality in grasp_quality])
+
+    def array(self):
+        '''
+        a copy of the [num_designs, num_objects] statistics
+        '''
+        return self.data[:self.num_designs].copy()
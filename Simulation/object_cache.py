@@ -0,0 +1,75 @@
+"""On-disk cache of scaled object meshes and their resting placement"""
+
+from klampt import Geometry3D
+from klampt.io import numpy_convert
+import numpy as np
+import hashlib
+import os
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'objects')
+OBJECT_SCALE = 0.35
+SPACING = 0.006
+
+
+def _cache_key(file_name, scale):
+    stat = os.stat(file_name)
+    key = '%s|%d|%d|%r' % (os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size, scale)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _save_atomic(path, array):
+    tmp = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def build_object_mesh(file_name, scale=OBJECT_SCALE):
+    '''
+    parse the mesh file once and compute what make_object_from_file needs:
+    scaled vertices (n,3), triangle indices (m,3), the radius object_r and the resting transform object_T
+    '''
+    geometry = Geometry3D()
+    if not geometry.loadFile(file_name):
+        raise RuntimeError("Unable to load object " + file_name)
+    vertices, indices = numpy_convert.to_numpy(geometry.getTriangleMesh())
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3) * scale
+    indices = np.asarray(indices, dtype=np.int32).reshape(-1, 3)
+
+    bmin = vertices.min(axis=0)
+    bmax = vertices.max(axis=0)
+    translation = (-(bmin[0] + bmax[0]) * 0.5, -(bmin[1] + bmax[1]) * 0.5, -bmin[2] + SPACING)
+    r = np.max(np.abs([bmin[0], bmax[0], bmin[1], bmax[1], bmin[2], bmax[2]]))
+    meta = np.hstack(([np.sqrt(3) * r], translation))
+    return vertices, indices, meta
+
+
+def load_object_mesh(file_name, scale=OBJECT_SCALE, cache_dir=CACHE_DIR):
+    '''
+    returns memory-mapped (vertices, indices) and (object_r, object_T).
+    the cache entry is keyed by the absolute path, mtime and size of the file, so an edited mesh is re-parsed.
+    '''
+    key = _cache_key(file_name, scale)
+    paths = [os.path.join(cache_dir, key + suffix) for suffix in ('_vertices.npy', '_indices.npy', '_meta.npy')]
+    if not all(os.path.exists(path) for path in paths):
+        os.makedirs(cache_dir, exist_ok=True)
+        for path, array in zip(paths, build_object_mesh(file_name, scale)):
+            _save_atomic(path, array)
+
+    vertices = np.load(paths[0], mmap_mode='r')
+    indices = np.load(paths[1], mmap_mode='r')
+    meta = np.load(paths[2])
+    R = (1., 0., 0., 0., 1., 0., 0., 0., 1.)
+    object_T = (R, meta[1:4].tolist())
+    return vertices, indices, meta[0], object_T
+
+
+def prebuild_object_cache(object_files, scale=OBJECT_SCALE, cache_dir=CACHE_DIR):
+    for file_name in object_files:
+        load_object_mesh(file_name, scale, cache_dir)
+
+
+def make_geometry(vertices, indices):
+    mesh = numpy_convert.from_numpy((np.asarray(vertices), np.asarray(indices)), 'TriangleMesh')
+    geometry = Geometry3D()
+    geometry.setTriangleMesh(mesh)
+    return geometry
@@ -0,0 +1,115 @@
+"""Seeded low-discrepancy approach directions, shared by every design and worker"""
+
+from .object_cache import CACHE_DIR
+import numpy as np
+import hashlib
+import os
+
+POSE_DIR = os.path.join(os.path.dirname(CACHE_DIR), 'poses')
+ATTEMPTS_PER_TRIAL = 8
+TRIALS_PER_LIBRARY = 512
+CAP_LIMIT = 70
+# bump when the poses of a (object, trial, attempt) change, part of result_store.build_key
+LIBRARY_VERSION = 2
+
+# (object key, block, trials, attempts, limit) -> read-only [attempts, trials, 3] library block of this process
+_LIBRARIES = {}
+# absolute object file -> object_key of this process
+_OBJECT_KEYS = {}
+
+
+def radical_inverse(indices, base):
+    indices = np.asarray(indices, dtype=np.int64).copy()
+    result = np.zeros(indices.shape)
+    scale = 1. / base
+    while np.any(indices > 0):
+        result += (indices % base) * scale
+        indices //= base
+        scale /= base
+    return result
+
+
+def halton(n, bases=(2, 3), skip=1):
+    indices = np.arange(skip, skip + n)
+    return np.stack([radical_inverse(indices, base) for base in bases], axis=1)
+
+
+def cap_directions(points, limit=CAP_LIMIT):
+    '''
+    points [n,2] in [0,1)^2 -> unit vectors [n,3] uniform in area on the cap of polar angle <= limit degrees
+    around +z, the distribution utils.sample_hemisphere(limit) draws from
+    '''
+    cos_limit = np.cos(np.pi * limit / 180.)
+    z = 1. - points[:, 0] * (1. - cos_limit)
+    azimuth = 2. * np.pi * points[:, 1]
+    r = np.sqrt(np.maximum(1. - z ** 2, 0.))
+    return np.stack((r * np.cos(azimuth), r * np.sin(azimuth), z), axis=1)
+
+
+def object_key(object_file):
+    '''
+    sha1 of the content of object_file, so objects of the same name in different directories are told apart and
+    every machine and process shares the same library of an object
+    '''
+    path = os.path.abspath(object_file)
+    if path not in _OBJECT_KEYS:
+        sha = hashlib.sha1()
+        with open(object_file, 'rb') as f:
+            sha.update(f.read())
+        _OBJECT_KEYS[path] = sha.hexdigest()
+    return _OBJECT_KEYS[path]
+
+
+def object_seed(object_file):
+    return int(object_key(object_file)[:8], 16)
+
+
+def build_pose_library(object_file, block=0, num_trials=TRIALS_PER_LIBRARY, num_attempts=ATTEMPTS_PER_TRIAL,
+                       limit=CAP_LIMIT):
+    '''
+    [num_attempts, num_trials, 3] float32 directions of the trials block * num_trials to (block + 1) * num_trials - 1.
+    attempt a of trial t of the block is point a * num_trials + t of the block's part of a Halton sequence, so the
+    first attempts of all trials are consecutive, well spread points, and later blocks continue the sequence.
+    the sequence is shifted modulo 1 by a random offset seeded by the object (Cranley-Patterson rotation).
+    '''
+    shift = np.random.RandomState(object_seed(object_file)).uniform(size=2)
+    points = np.mod(halton(num_attempts * num_trials, skip=1 + block * num_attempts * num_trials) + shift, 1.)
+    return cap_directions(points, limit).astype(np.float32).reshape(num_attempts, num_trials, 3)
+
+
+def load_pose_library(object_file, block=0, num_trials=TRIALS_PER_LIBRARY, num_attempts=ATTEMPTS_PER_TRIAL,
+                      limit=CAP_LIMIT, cache_dir=POSE_DIR):
+    key = (object_key(object_file), block, num_trials, num_attempts, limit)
+    if key not in _LIBRARIES:
+        path = os.path.join(cache_dir, '%s_%d_%d_%d_%d.npy' % key)
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = '%s.%d.tmp.npy' % (path[:-4], os.getpid())
+            np.save(tmp, build_pose_library(object_file, block, num_trials, num_attempts, limit))
+            os.replace(tmp, path)
+        _LIBRARIES[key] = np.load(path, mmap_mode='r')
+    return _LIBRARIES[key]
+
+
+class PoseLibrary:
+    '''
+    approach directions of every trial of an object, loaded one block of num_trials trials at a time, so a design
+    re-evaluated past num_trials trials gets new poses instead of repeating the first ones
+    '''
+    def __init__(self, object_file, num_trials=TRIALS_PER_LIBRARY, num_attempts=ATTEMPTS_PER_TRIAL, limit=CAP_LIMIT,
+                 cache_dir=POSE_DIR):
+        self.object_file = object_file
+        self.num_trials = num_trials
+        self.num_attempts = num_attempts
+        self.limit = limit
+        self.cache_dir = cache_dir
+
+    def pose(self, attempt, trial):
+        block = load_pose_library(self.object_file, trial // self.num_trials, self.num_trials, self.num_attempts,
+                                  self.limit, self.cache_dir)
+        return np.asarray(block[attempt, trial % self.num_trials], dtype=float)
+
+
+def prebuild_pose_libraries(object_files, **kwargs):
+    for object_file in object_files:
+        load_pose_library(object_file, **kwargs)
@@ -0,0 +1,147 @@
+"""SQLite store of simulated grasp trials, keyed by design, gripper build, object and pose"""
+
+from .object_cache import CACHE_DIR
+from .pose_library import ATTEMPTS_PER_TRIAL, TRIALS_PER_LIBRARY, CAP_LIMIT, LIBRARY_VERSION, object_key
+import numpy as np
+import ast
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+RESULT_STORE = os.path.join(os.path.dirname(CACHE_DIR), 'results.sqlite')
+# bump when a change outside SIMULATION_MODULES makes stored trials incomparable with new ones, e.g. a new klampt
+# or a change of the store's columns; changes of these modules are caught by simulation_source_key
+STORE_VERSION = 1
+# modules whose code decides the result of a trial, hashed into build_key
+SIMULATION_MODULES = ['gl_vis.py', 'grasp_sim.py', 'computeQ1UpperBound.py', 'directions.py', 'moving_base.py',
+                      'utils.py', 'create_design.py', 'object_cache.py', 'pose_library.py']
+
+
+def design_key(design):
+    '''
+    design : (length, width, link_angle, radius, link_tilted_angle, curvature) as given to GraspWorkerPool.submit
+    '''
+    normalized = [list(np.asarray(d, dtype=float).ravel()) if d is not None else None for d in design]
+    text = json.dumps(normalized)
+    return hashlib.sha1(text.encode()).hexdigest(), text
+
+
+def _hash_files(sha, paths):
+    for path in paths:
+        sha.update(path.encode())
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+
+
+class _ResultCode(ast.NodeTransformer):
+    '''
+    drops the parts of a module that cannot change a trial: docstrings, the if __name__ == '__main__' block and
+    print() statements. comments and formatting are not in the tree at all
+    '''
+    def generic_visit(self, node):
+        node = ast.NodeTransformer.generic_visit(self, node)
+        body = getattr(node, 'body', None)
+        if isinstance(body, list) and body and isinstance(body[0], ast.Expr) and \
+                isinstance(body[0].value, ast.Constant) and isinstance(body[0].value.value, str):
+            node.body = body[1:] or [ast.Pass()]
+        return node
+
+    def visit_If(self, node):
+        test = node.test
+        if isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and test.left.id == '__name__':
+            return None
+        return self.generic_visit(node)
+
+    def visit_Expr(self, node):
+        value = node.value
+        if isinstance(value, ast.Call) and isinstance(value.func, ast.Name) and value.func.id == 'print':
+            return None
+        return self.generic_visit(node)
+
+
+def simulation_source_key():
+    '''
+    sha1 of the syntax trees of SIMULATION_MODULES without what _ResultCode drops, by file name so that the key
+    does not depend on the checkout directory. editing a comment, docstring, print or benchmark keeps the stored
+    trials; any other edit of these modules discards them, even a rename that does not change a result
+    '''
+    sha = hashlib.sha1()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in SIMULATION_MODULES:
+        with open(os.path.join(directory, name)) as f:
+            tree = _ResultCode().visit(ast.parse(f.read()))
+        sha.update(name.encode())
+        sha.update(ast.dump(tree).encode())
+    return sha.hexdigest()
+
+
+def build_key(world_file, sim_options=None):
+    '''
+    the world file, every file of the robots directory next to it, the GraspGL options, the pose library
+    parameters and the source of the simulation; a trial is only reused when all of them are unchanged
+    '''
+    sha = hashlib.sha1()
+    robot_dir = os.path.join(os.path.dirname(os.path.abspath(world_file)), 'robots')
+    robot_files = []
+    for root, _, files in os.walk(robot_dir):
+        robot_files += [os.path.join(root, f) for f in files]
+    _hash_files(sha, [os.path.abspath(world_file)] + sorted(robot_files))
+    options = dict(sim_options or {})
+    options.update(store_version=STORE_VERSION,
+                   simulation_source=simulation_source_key(),
+                   pose_library=(TRIALS_PER_LIBRARY, ATTEMPTS_PER_TRIAL, CAP_LIMIT, LIBRARY_VERSION))
+    sha.update(json.dumps(options, sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+class ResultStore:
+    '''
+    one row per simulated trial: success, result_1, Q1 and the wall time of the trial.
+    trial is the index of the pose in the object's pose library, so a row is only meaningful for trials that were
+    drawn from the library (GraspWorkerPool(use_pose_library=True)).
+    every add() is committed at once, so results survive a crash or Ctrl-C of the optimization.
+    '''
+    def __init__(self, file_name=RESULT_STORE):
+        self.file_name = file_name
+        directory = os.path.dirname(os.path.abspath(file_name))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(file_name, timeout=60.)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS trials (
+                                   design TEXT, build TEXT, object TEXT, trial INTEGER,
+                                   success REAL, result_1 REAL, q1 REAL, sim_time REAL,
+                                   design_parameters TEXT, object_file TEXT, created REAL,
+                                   PRIMARY KEY (design, build, object, trial))''')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, design, build, obj, first_trial, num_trials):
+        '''
+        returns {trial: (success, result_1, q1, sim_time)} of the stored trials in [first_trial, first_trial + num_trials)
+        '''
+        rows = self.connection.execute('''SELECT trial, success, result_1, q1, sim_time FROM trials
+                                          WHERE design = ? AND build = ? AND object = ? AND trial >= ? AND trial < ?''',
+                                       (design, build, obj, first_trial, first_trial + num_trials))
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def add(self, design, build, obj, first_trial, trials, sim_times, design_parameters='', object_file=''):
+        '''
+        trials : (result_success_prob, result_1, result_2) of GraspGL.get_trials, trial i has index first_trial + i
+        '''
+        now = time.time()
+        rows = [(design, build, obj, first_trial + i, _to_float(s), _to_float(r1), _to_float(r2), float(t),
+                 design_parameters, object_file, now)
+                for i, (s, r1, r2, t) in enumerate(zip(trials[0], trials[1], trials[2], sim_times))]
+        self.connection.executemany('INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def num_trials(self):
+        return self.connection.execute('SELECT COUNT(*) FROM trials').fetchone()[0]
+
+
+def _to_float(value):
+    return None if value is None else float(value)
@@ -31,6 +31,5 @@ def sample_hemisphere(limit):
         v = v / np.sum(v ** 2) ** 0.5
         phi = np.arctan(np.sqrt(v[0]**2 + v[1]**2)/v[2])
 
-    print ("            phi = ", phi*180/np.pi)
     return v
 
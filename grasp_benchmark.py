@@ -0,0 +1,151 @@
+from Simulation.gl_vis import *
+import glob
+import os
+import sys
+
+
+def sample_designs(num_designs):
+    designs = []
+    for d in np.linspace(-1., 1., num_designs):
+        theta = 15.
+        designs += [([1.] * 9, [1.] * 9, [60, 90 - theta, 30 + theta], [0.07, 0.07, 0.07],
+                     [0, -(30 - theta), 30 - theta], d)]
+    return designs
+
+
+def benchmark_worker_pool(world_file, object_files, max_iter, num_designs=3, num_processes=8):
+    '''
+    per-design latency of grasp_test with freshly spawned processes vs. the persistent GraspWorkerPool
+    '''
+    designs = sample_designs(num_designs)
+
+    legacy = []
+    for design in designs:
+        start = time.time()
+        grasp_test(world_file, *design[:5], curvature=design[5], object_files=object_files, max_iter=max_iter)
+        legacy += [time.time() - start]
+
+    warm = []
+    with GraspWorkerPool(world_file, num_processes) as pool:
+        for design in designs:
+            start = time.time()
+            grasp_test(world_file, *design[:5], curvature=design[5], object_files=object_files, max_iter=max_iter,
+                       pool=pool)
+            warm += [time.time() - start]
+        pool.report()
+
+    print("legacy path : %.3f s/design" % np.mean(legacy))
+    print("warm workers: %.3f s/design" % np.mean(warm))
+    print("saved       : %.3f s/design" % (np.mean(legacy) - np.mean(warm)))
+    return legacy, warm
+
+
+def benchmark_trial_chunks(world_file, object_files, max_iter, num_designs=3, num_processes=8):
+    '''
+    per-design latency when a task is one object with all its trials vs. the default (object, trial-chunk) tasks
+    '''
+    designs = sample_designs(num_designs)
+    latency = {}
+    for name, trials_per_task in (('per object', max_iter), ('trial chunks', None)):
+        with GraspWorkerPool(world_file, num_processes, trials_per_task=trials_per_task) as pool:
+            for design in designs:
+                grasp_test(world_file, *design[:5], curvature=design[5], object_files=object_files,
+                           max_iter=max_iter, pool=pool)
+            latency[name] = np.mean(pool.design_latency)
+        print("%-12s: %.3f s/design" % (name, latency[name]))
+    return latency
+
+
+def benchmark_contact_snapshot(world_file, object_file, num_trials=5):
+    '''
+    contact queries and step time of Grasp when every consumer re-queries the simulator vs. one ContactSnapshot per step
+    '''
+    stats = {}
+    for name, contact_snapshot in (('re-query', False), ('snapshot', True)):
+        world = load_world(world_file)
+        robot = world.robot(0)
+        init_config = robot.getConfig()
+        obj, object_r, object_T = make_object_from_file(world, object_file)
+        set_moving_base_xform(robot, so3.identity(), [1, 1, 1])
+        robot.setConfig(init_config)
+        np.random.seed(0)
+        grasp_test_module = GraspGL(world, object_r, object_T, max_iteration=num_trials,
+                                    contact_snapshot=contact_snapshot)
+        grasp_test_module.run_simulation()
+        stats[name] = grasp_test_module.step_stats
+    print("%-9s %8s %14s %16s %14s" % ("", "steps", "queries/step", "contact ms/step", "step ms/step"))
+    for name, s in stats.items():
+        print("%-9s %8d %14.1f %16.3f %14.3f" % (name, s['steps'], s['contact_queries'] / float(s['steps']),
+                                                  1e3 * s['contact_time'] / s['steps'], 1e3 * s['step_time'] / s['steps']))
+    return stats
+
+
+def benchmark_fast_approach(world_file, object_file, num_trials=20):
+    '''
+    steps per trial and grasp outcomes of the dynamic approach vs. the geometric fast-forward to the standoff
+    '''
+    results = {}
+    for name, fast_approach in (('dynamic', False), ('fast-forward', True)):
+        world = load_world(world_file)
+        robot = world.robot(0)
+        init_config = robot.getConfig()
+        obj, object_r, object_T = make_object_from_file(world, object_file)
+        set_moving_base_xform(robot, so3.identity(), [1, 1, 1])
+        robot.setConfig(init_config)
+        np.random.seed(0)
+        grasp_test_module = GraspGL(world, object_r, object_T, max_iteration=num_trials, fast_approach=fast_approach)
+        grasp_test_module.run_simulation()
+        success, _, q1 = [np.asarray(r, dtype=float) for r in grasp_test_module.get_trials()]
+        results[name] = (grasp_test_module.step_stats, success, q1)
+
+    print("%-12s %12s %14s %10s %16s" % ("", "steps/trial", "saved/trial", "success", "Q1 of successes"))
+    for name, (stats, success, q1) in results.items():
+        q1 = q1[success > 0]
+        print("%-12s %12.1f %14.1f %10.2f %9.4f+-%.4f" % (
+            name, stats['steps'] / float(num_trials), stats.get('approach_steps_saved', 0) / float(num_trials),
+            success.mean(), q1.mean() if len(q1) else 0., q1.std() / np.sqrt(max(len(q1), 1))))
+    return results
+
+
+def benchmark_prescreen(world_file, object_files, num_trials=10):
+    '''
+    per object: how often the pre-screen predicts the terrain hits of the simulation ('audit' run, every pose
+    simulated), then the rejection rate and the time per object with the pre-screen on
+    '''
+    print("%-28s %8s %8s %8s %10s %10s %10s" % ("object", "recall", "false rej", "rejected", "audit [s]", "screen [s]",
+                                                 "saved [s]"))
+    for object_file in object_files:
+        stats = {}
+        for prescreen in ('audit', True):
+            world = load_world(world_file)
+            robot = world.robot(0)
+            init_config = robot.getConfig()
+            obj, object_r, object_T = make_object_from_file(world, object_file)
+            set_moving_base_xform(robot, so3.identity(), [1, 1, 1])
+            robot.setConfig(init_config)
+            np.random.seed(0)
+            start = time.time()
+            grasp_test_module = GraspGL(world, object_r, object_T, max_iteration=num_trials, prescreen=prescreen)
+            grasp_test_module.run_simulation()
+            stats[prescreen] = (grasp_test_module, time.time() - start)
+
+        audit, audit_time = stats['audit']
+        log = np.array(audit.prescreen_log, dtype=int).reshape(-1, 2)
+        terrain = log[:, 1] == 0
+        recall = np.mean(log[terrain, 0]) if terrain.any() else float('nan')
+        false_rejection = np.mean(log[~terrain, 0]) if (~terrain).any() else float('nan')
+        screened, screened_time = stats[True]
+        rejection_rate = screened.step_stats['prescreen_rejected'] / float(screened.step_stats['prescreen_poses'])
+        print("%-28s %8.2f %8.2f %8.2f %10.2f %10.2f %10.2f" % (
+            os.path.basename(object_file), recall, false_rejection, rejection_rate, audit_time, screened_time,
+            audit_time - screened_time))
+
+
+if __name__ == '__main__':
+    world_file = 'Simulation/box_robot_floating.xml'
+    object_files = glob.glob('../ObjectNet3D/CAD/off/cup/[0-9][0-9].off')
+    benchmark_worker_pool(world_file, object_files, max_iter=2)
+    benchmark_trial_chunks(world_file, object_files, max_iter=20)
+    benchmark_contact_snapshot(world_file, object_files[0])
+    benchmark_fast_approach(world_file, object_files[0])
+    benchmark_prescreen(world_file, object_files[:5])
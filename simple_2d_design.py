@@ -1,16 +1,46 @@
 from Simulation.gl_vis import *
+from Simulation.early_stopping import SequentialStop
+from Simulation.grasp_statistics import GraspStatistics, object_statistics, design_quality_bound
 from BoundingBox.pareto_comparison import Observations
+from BoundingBox.dominance import pareto_sample_mask, dominated_by_sample, is_pareto_point
+from BoundingBox.hypervolume import pareto_front_2d, hypervolume_2d, expected_hypervolume_improvement_2d
+from BoundingBox.pareto_archive import ParetoArchive
 import glob
+from sklearn.base import clone
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import (RBF, Matern, RationalQuadratic)
+from surrogate import SurrogateManager
 import pdb
 from pyDOE import *
+from scipy.optimize import minimize
 from scipy.stats import uniform
 import matplotlib.pyplot as plt
+import json
+import os
+import sys
 start_time = time.time()
 
 class optimize_design:
-    def __init__(self, init_with_lhs, num_init_samples,  obj_space_lim, world_file_name, object_file_name, iter_per_obj, num_objectives, exps_th, gamma, num_designs, bounds, show_step):
+    def __init__(self, init_with_lhs, num_init_samples,  obj_space_lim, world_file_name, object_file_name, iter_per_obj, num_objectives, exps_th, gamma, num_designs, bounds, show_step, num_processes=8, batch_size=1, asynchronous=False, sim_options=None, result_store=None, checkpoint_file=None, surrogate_options=None, acquisition='mc', hv_reference=None, fidelities=None, fidelity_threshold=0.5, early_stopping=None):
+        # constructor arguments, saved in every checkpoint so that load_checkpoint can rebuild the run
+        self.init_args = dict(init_with_lhs=init_with_lhs, num_init_samples=num_init_samples,
+                              obj_space_lim=obj_space_lim, world_file_name=world_file_name,
+                              object_file_name=object_file_name, iter_per_obj=iter_per_obj,
+                              num_objectives=num_objectives, exps_th=exps_th, gamma=gamma, num_designs=num_designs,
+                              bounds=np.asarray(bounds).tolist(), show_step=show_step, num_processes=num_processes,
+                              batch_size=batch_size, asynchronous=asynchronous, sim_options=sim_options,
+                              result_store=result_store.file_name if isinstance(result_store, ResultStore)
+                              else result_store, checkpoint_file=checkpoint_file,
+                              surrogate_options=surrogate_options, acquisition=acquisition,
+                              hv_reference=None if hv_reference is None else np.asarray(hv_reference).tolist(),
+                              fidelities=fidelities, fidelity_threshold=fidelity_threshold,
+                              early_stopping=early_stopping)
+        if checkpoint_file is not None:
+            # fail before any simulation rather than at the first checkpoint
+            try:
+                json.dumps(self.init_args)
+            except TypeError as e:
+                raise ValueError("the constructor arguments of a checkpointed run must be JSON serializable: %s" % e)
         self.num_init_samples = num_init_samples
         self.init_with_lhs = init_with_lhs
         self.obj_space_lim = obj_space_lim
@@ -18,6 +48,8 @@ class optimize_design:
         self.world_file_name = world_file_name
         self.object_list = glob.glob(object_file_name)
         self.num_objects = len(self.object_list)
+        prebuild_object_cache(self.object_list)
+        prebuild_pose_libraries(self.object_list)
         self.iter_per_object = iter_per_obj
         self.num_objectives = num_objectives
         self.num_designs = num_designs
@@ -29,23 +61,105 @@ class optimize_design:
         self.train_labels = np.empty((0, bounds.shape[0]))
 
         self.process_bb = Observations(num_objectives, exps_th=exps_th, show_step=show_step, text_in_graph=True)
+        # labels are points, the degenerate boxes of a ParetoArchive
+        self.label_archive = ParetoArchive(num_objectives)
         self.gamma = gamma
 
+        # acquisition : 'mc' (acquisition_MC_batch) or 'ehvi' (acquisition_EHVI, two objectives)
+        # hv_reference : reference point of the hypervolume, by default the lower corner of obj_space_lim
+        if acquisition not in ('mc', 'ehvi'):
+            raise ValueError("unknown acquisition %s" % acquisition)
+        if acquisition == 'ehvi' and num_objectives != 2:
+            raise ValueError("ehvi acquisition needs two objectives")
+        self.acquisition = acquisition
+        self.hv_reference = np.asarray([lim[0] for lim in obj_space_lim] if hv_reference is None else hv_reference,
+                                       dtype=float)
+
         self.design_parameter = []
         self.num_trials = []
         self.num_success = []
-        self.grasp_quality = []
+        # Q1 count, mean, variance and max of every (design, object), updated in place by re-evaluations
+        self.grasp_stats = GraspStatistics(self.num_objects)
         self.mass = []
+
+        # fidelities : cheap low-fidelity evaluations, e.g. [{'trials': 5, 'objects': 2, 'dt': 0.04}]: fewer trials per
+        # object, the given number of objects spread over object_list and a coarser simulation step. the full
+        # evaluation is always the last level. with low fidelities the GPs take the cost of a level relative to the
+        # full evaluation as an extra input, and choose_fidelities picks the level of every proposed design.
+        # low-fidelity results only train the GPs, they are never observations of process_bb
+        self.fidelity_options = fidelities or []
+        self.fidelities = self._fidelity_levels(self.fidelity_options)
+        self.fidelity_threshold = fidelity_threshold
+        self.max_low_fidelity = 4 * num_designs
+        self.low_fidelity_design = np.empty((0, self.dim_design_space))
+        self.low_fidelity_level = np.empty(0, dtype=int)
+        self.low_fidelity_lower = np.empty((0, num_objectives))
+        self.low_fidelity_upper = np.empty((0, num_objectives))
+        # keyword arguments of SurrogateManager, e.g. full_restart_every or n_jobs
+        self.surrogate_options = surrogate_options
+        self.num_processes = num_processes
         self._initialize_gp(num_objectives)
 
-    def _initialize_gp(self, num_objectives):
-        self.gp = []
-        for i in range(num_objectives):
-            gp = GaussianProcessRegressor(kernel=Matern(nu=2.5), n_restarts_optimizer=25, alpha = 0.0001)
-            self.gp.append(gp)
+        # designs proposed per iteration and simulated together on the pool, see propose_designs.
+        # asynchronous: keep batch_size simulations in flight and propose a new design whenever one finishes
+        self.batch_size = batch_size
+        self.asynchronous = asynchronous
+        self.sim_options = sim_options
+        self.result_store = result_store
+        self.pool = None
+        # early_stopping : keyword arguments of SequentialStop, e.g. {'min_trials': 5}, {} for its defaults. the
+        # workers then stream the trials of every new design and stop its objects once stop_rule decides them;
+        # re-evaluations always run all their trials. None runs every trial
+        self.early_stopping = early_stopping
+
+        # checkpoint_file: save_checkpoint after every design, re-evaluation and new candidate.
+        # loop_state says where _run continues: phase 'init' (latin cube samples) or 'bo', the design index idx,
+        # stage 'candidate' (x_max is the next design to evaluate) or 'evaluated' (re-evaluate parent_idx, then fit).
+        # the asynchronous loop saves phase 'async': idx designs proposed, x_max and reevaluating are in flight
+        self.checkpoint_file = checkpoint_file
+        self.loop_state = None
 
-    def do_experiment(self, design_idx):
-        d = self.design_parameter[design_idx]
+    def _initialize_gp(self, num_objectives):
+        options = dict(self.surrogate_options or {})
+        if len(self.fidelities) > 1:
+            # one length scale per design parameter and one along the fidelity
+            options.setdefault('kernel', Matern(length_scale=np.ones(self.dim_design_space + 1), nu=2.5))
+        # the GP fits run while the grasp workers may still be simulating, leave their cores to them
+        options.setdefault('n_jobs', max(1, (os.cpu_count() or 1) - self.num_processes))
+        self.surrogate = SurrogateManager(num_objectives, **options)
+        self.gp = self.surrogate.gp
+
+    def _fidelity_levels(self, fidelities):
+        '''
+        [{'objects', 'trials', 'sim_options', 'cost'}] of the low fidelities and the full evaluation, cost relative to
+        the full evaluation (simulated trials, times steps per trial)
+        '''
+        levels = []
+        for fidelity in fidelities:
+            num_objects = min(fidelity.get('objects') or self.num_objects, self.num_objects)
+            picked = np.unique(np.linspace(0, self.num_objects - 1, num_objects).round().astype(int))
+            trials = fidelity.get('trials') or self.iter_per_object
+            dt = fidelity.get('dt')
+            cost = len(picked) * trials / float(self.num_objects * self.iter_per_object)
+            levels += [{'objects': [self.object_list[i] for i in picked], 'trials': trials,
+                        'sim_options': None if dt is None else {'dt': dt},
+                        'cost': cost if dt is None else cost * DEFAULT_DT / dt}]
+        levels += [{'objects': self.object_list, 'trials': self.iter_per_object, 'sim_options': None, 'cost': 1.}]
+        return levels
+
+    def _gp_input(self, x, fidelity=None):
+        '''
+        GP inputs of designs x at fidelity (a level or one level per design, the full evaluation by default):
+        x itself without low fidelities, else x and the cost of the level
+        '''
+        x = np.asarray(x, dtype=float).reshape(-1, self.dim_design_space)
+        if len(self.fidelities) == 1:
+            return x
+        costs = np.array([level['cost'] for level in self.fidelities])
+        cost = costs[-1 if fidelity is None else np.asarray(fidelity, dtype=int)]
+        return np.hstack((x, np.broadcast_to(np.reshape(cost, (-1, 1)), (x.shape[0], 1))))
+
+    def hand_parameters(self, d):
         if len(d) is not 2:
             raise RuntimeError("design parameter's dimension is wrong")
         length = [1.]*9
@@ -56,178 +170,302 @@ class optimize_design:
         theta = d[1]*30.
         link_angle = [60, 90 - theta, 30 + theta]
         link_tilted_angle = [0, -(30 - theta), 30 - theta]
-
-        num_success, grasp_quality, mass \
+        return length, width, link_angle, radius, link_tilted_angle, curvature
+
+    def do_experiment(self, design_idx, first_trial=0, fidelity=None, early_stopping=False):
+        return self.simulate_design(self.design_parameter[design_idx], first_trial, fidelity, early_stopping)
+
+    def simulate_design(self, d, first_trial=0, fidelity=None, early_stopping=False):
+        '''
+        simulate design parameters d at fidelity, an index of self.fidelities (the full evaluation by default).
+        early_stopping : stop the objects of a new design with stop_rule
+        returns (num_success, grasp_quality, mass, trials run per object)
+        '''
+        level = self.fidelities[-1 if fidelity is None else fidelity]
+        length, width, link_angle, radius, link_tilted_angle, curvature = self.hand_parameters(d)
+        num_success, grasp_quality, mass, trials_run \
             = grasp_test(self.world_file_name, length, width, link_angle, radius, link_tilted_angle, curvature=curvature,
-                         object_files=self.object_list, max_iter=self.iter_per_object)
+                         object_files=level['objects'], max_iter=level['trials'], pool=self.pool,
+                         first_trial=first_trial, sim_options=level['sim_options'],
+                         make_stop_rule=self.stop_rule if early_stopping else None, return_trials=True)
         print("num_success : ", num_success)
         print("grasp_quality: ", grasp_quality)
         print("mass : ", mass)
-        return np.asarray(num_success), grasp_quality, mass
+        return np.asarray(num_success), grasp_quality, mass, np.asarray(trials_run, dtype=int)
+
+    def do_experiments(self, design_indices, first_trials=None):
+        '''
+        simulate several designs at once: all of them are submitted to the worker pool before waiting for the first.
+        returns [(num_success, grasp_quality, mass, trials run per object)] in the order of design_indices
+        '''
+        design_indices = list(design_indices)
+        if first_trials is None:
+            first_trials = [0] * len(design_indices)
+        if self.pool is None or len(design_indices) == 1:
+            return [self.do_experiment(idx, first_trial, early_stopping=True)
+                    for idx, first_trial in zip(design_indices, first_trials)]
+
+        designs = [self.hand_parameters(self.design_parameter[idx]) for idx in design_indices]
+        results = grasp_test_batch(self.world_file_name, designs, self.object_list, self.iter_per_object,
+                                   pool=self.pool, first_trials=first_trials, make_stop_rule=self.stop_rule,
+                                   return_trials=True)
+        experiments = []
+        for idx, (num_success, grasp_quality, mass, trials_run) in zip(design_indices, results):
+            print("design %d" % idx)
+            print("num_success : ", num_success)
+            print("grasp_quality: ", grasp_quality)
+            print("mass : ", mass)
+            experiments += [(np.asarray(num_success), grasp_quality, mass, np.asarray(trials_run, dtype=int))]
+        return experiments
+
+    def submit_experiment(self, d, first_trial=0, fidelity=None, early_stopping=False):
+        '''
+        start the simulation of design parameters d on the worker pool without waiting for it;
+        returns (job_id, mass), pool.wait(job_id, return_trials=True) returns (num_success, grasp_quality, trials run)
+        '''
+        level = self.fidelities[-1 if fidelity is None else fidelity]
+        design = self.hand_parameters(d)
+        mass = self.pool.design_mass(design)
+        stop_rule = self.stop_rule(mass) if early_stopping else None
+        return self.pool.submit(design, level['objects'], level['trials'], first_trial,
+                                sim_options=level['sim_options'], stop_rule=stop_rule), mass
+
+    def stop_rule(self, mass):
+        '''
+        SequentialStop of a new design of hand mass mass against the boxes observed so far, None without early_stopping.
+        the design is dominated once its Q1 upper bound is at most the Q1 lower bound of a lighter box, and clear of
+        the boxes once its Q1 lower bound exceeds the Q1 upper bound of every lighter box. the lightest design is never
+        clear: the heavier ones are compared against its box
+        '''
+        if self.early_stopping is None or self.pool is None:
+            return None
+        lower, upper = self.process_bb.lower_bounds, self.process_bb.upper_bounds
+        lighter_lower = lower[:, 0] >= -mass
+        lighter_upper = upper[:, 0] >= -mass
+        dominated_below = np.max(lower[lighter_lower, 1]) if np.any(lighter_lower) else -np.inf
+        clear_above = np.max(upper[lighter_upper, 1]) if np.any(lighter_upper) else np.inf
+        return SequentialStop(self.gamma, self.iter_per_object, dominated_below=dominated_below,
+                              clear_above=clear_above, **self.early_stopping)
 
     def is_pareto(self, pareto_set, point):
-        costs = np.vstack((point, pareto_set))
-        is_efficient = np.ones(costs.shape[0], dtype=bool)
-        for i, c in enumerate(costs):
-            if is_efficient[i]:
-                is_efficient[is_efficient] = np.any(costs[is_efficient] > c, axis=1)
-                is_efficient[i] = True
-        return is_efficient[0]
+        return is_pareto_point(pareto_set, point)
 
     def is_pareto_simple_max(self):
-        costs = self.train_labels
-        pareto_set = []
-        non_pareto_set = []
-
-        is_efficient = np.ones(costs.shape[0], dtype=bool)
-        for i, c in enumerate(costs):
-            if is_efficient[i]:
-                is_efficient[is_efficient] = np.any(costs[is_efficient] > c, axis=1)
-                is_efficient[i] = True  # And keep self
-
-        for i in range(costs.shape[0]):
-            if is_efficient[i]:
-                pareto_set.append(costs[i])
-            else:
-                non_pareto_set.append(costs[i])
-        pareto_set = np.asarray(pareto_set)
-        non_pareto_set = np.asarray(non_pareto_set)
+        costs = self.train_labels.reshape(-1, self.num_objectives)
+        is_efficient = self.label_archive.sync(costs, costs)
+        pareto_set = costs[is_efficient]
+        non_pareto_set = costs[~is_efficient]
 
         return pareto_set, non_pareto_set
 
     def post_processing_per_design(self, idx):
-        grasp_quality = self.grasp_quality[idx]
-        l_bounds_result = np.zeros((1, 2))
-        u_bounds_result = np.zeros((1, 2))
-        num_obj_success = 0
-        #TODO: for self.grasp_quality[idx][obj_idx][0] : average value- gamma*std , average + gamma*std
-        # for self.grasp_quality[idx][obj_idx][1]: max , max+ noise
-
-        for obj_idx in range(self.num_objects):
-            num_exp = grasp_quality[obj_idx].shape[1]
-            if num_exp > 0:
-                print(grasp_quality[obj_idx])
-                noise = np.std(grasp_quality[obj_idx][1].astype(float)) * self.gamma/np.sqrt(num_exp)
-                if num_exp == 1: noise =1.
-                max_radius = np.max(grasp_quality[obj_idx][1].astype(float))
-                l_bounds_result += np.array([0, max_radius])
-                u_bounds_result += np.array([0, max_radius+noise*2])
-                num_obj_success += 1
-        if num_obj_success == 0:
-            l_bounds_result[0, 0] = -self.mass[idx]
+        return self.post_processing_statistics(self.grasp_stats[idx], self.mass[idx])
+
+    def post_processing(self, grasp_quality, mass):
+        return self.post_processing_statistics(object_statistics(grasp_quality), mass)
+
+    def post_processing_statistics(self, statistics, mass):
+        '''
+        statistics : per object STATISTICS_DTYPE of the Q1 of a design -> (lower, upper) bounds of the design,
+        (-mass, design_quality_bound), or a Q1 of [0, 1] without success
+        '''
+        #TODO: for the volume : average value- gamma*std , average + gamma*std
+        bound = design_quality_bound(statistics, self.gamma)
+        if bound is None:
+            l_bounds_result = np.array([[-mass, 0.]])
             return l_bounds_result, l_bounds_result + np.array([0, 1.])
-        else:
-            l_bounds_result = l_bounds_result / num_obj_success
-            l_bounds_result[0,0] = -self.mass[idx]
-            u_bounds_result = u_bounds_result / num_obj_success
-            u_bounds_result[0,0] = -self.mass[idx]
-            print("bound " ,l_bounds_result, u_bounds_result )
-            return l_bounds_result, u_bounds_result
+        l_bounds_result = np.array([[-mass, bound[0]]])
+        u_bounds_result = np.array([[-mass, bound[1]]])
+        print("bound " ,l_bounds_result, u_bounds_result )
+        return l_bounds_result, u_bounds_result
+
+    def propose_designs(self, pareto_set, batch_size, pending=None):
+        if self.acquisition == 'ehvi':
+            return self.acquisition_EHVI(pareto_set, batch_size, pending)
+        return self.acquisition_MC_batch(pareto_set, batch_size, pending)
+
+    def choose_fidelities(self, designs, num_running=0):
+        '''
+        fidelity of every proposed design, as MF-GP-UCB: the cheapest level at which the grasp quality GP is still
+        uncertain about the design, std > fidelity_threshold * sqrt(cost), else the full evaluation. once the cheap
+        levels are known well enough around a design, it is evaluated for real. at most max_low_fidelity low-fidelity
+        evaluations are run, num_running of them still in flight
+        '''
+        full = len(self.fidelities) - 1
+        num_low = self.low_fidelity_level.shape[0] + num_running
+        chosen = []
+        for x in np.asarray(designs, dtype=float).reshape(-1, self.dim_design_space):
+            fidelity = full
+            if num_low < self.max_low_fidelity:
+                for level in range(full):
+                    std = self.gp[1].predict(self._gp_input(x, level), return_std=True)[1][0]
+                    if std > self.fidelity_threshold * np.sqrt(self.fidelities[level]['cost']):
+                        fidelity = level
+                        num_low += 1
+                        break
+            chosen += [fidelity]
+        return chosen
 
     def acquisition_MC_random(self, pareto_set):
+        return self.acquisition_MC_batch(pareto_set, 1)[0]
+
+    def acquisition_MC_batch(self, pareto_set, batch_size, pending=None):
+        '''
+        [batch_size, dim] designs to evaluate together, picked one after the other from the same random candidates
+        and joint GP samples. a picked design is fantasized as observed: in every MC sample, the candidates its sample
+        dominates are no longer Pareto, and the exploration std is conditioned on the picked designs, so the batch
+        spreads over the front instead of repeating the best candidate. batch_size=1 is the sequential acquisition.
+        pending : designs still being simulated, fantasized as picked before the batch
+        '''
         # TODO: Randomly sampled candidates & return argmax value of acquistion function
         exploration = 0.9
         n_samples = 1000
         mc_samples = 100
         tolerance = 0.95
-        acquisition_func = np.zeros(n_samples)
-        sampled_points = []
-        argmax_idx = 0
+        pending = np.empty((0, self.dim_design_space)) if pending is None \
+            else np.asarray(pending, dtype=float).reshape(-1, self.dim_design_space)
         x_tries = np.random.uniform(
             self.bounds[:, 0], self.bounds[:, 1], size=(n_samples, self.dim_design_space))
+        x_tries = np.vstack((pending, x_tries))
+        n_samples = x_tries.shape[0]
 
         f = []
         for i in range(self.num_objectives):
-            f += [self.gp[i].sample_y(x_tries, mc_samples)]
+            f += [self.gp[i].sample_y(self._gp_input(x_tries), mc_samples)]
         f = np.asarray(f)
         print(f.shape)
 
-        prob = np.random.uniform()
-        if prob > exploration:
-            print("exploration")
-            # TODO: Add heuristic exploration term using std values
-            _, std = self.gp[1].predict(x_tries, return_std=True)
-            std_max = np.max(std)
-            extracted = np.extract(std > std_max * tolerance, std)
-            subset_idx = np.random.randint(0, extracted.shape[0])
-            argmax_idx = np.extract(std > std_max * tolerance, np.arange(std.shape[0]))[subset_idx]
-        else:
-            n_pareto_vals = []
-            for idx in range(n_samples):
-                # y_samples = np.vstack((f_1[idx], f_2[idx]))
-                y_samples = np.asarray(f[:, idx, :])
-                n_pareto = 0
-                for y_idx in range(mc_samples):
-                    if self.is_pareto(pareto_set, y_samples[:, y_idx]):
-                        n_pareto += 1
-
-                acquisition_func[idx] = n_pareto
-                n_pareto_vals.append([idx, n_pareto])
-                sampled_points.append(y_samples)
-
-            n_pareto_vals = np.asarray(n_pareto_vals)
-            n_pareto_max = np.max(n_pareto_vals[:, 1])
-            top_values = []
-
-            for i in range(n_samples):
-                if n_pareto_vals[i, 1] > tolerance * n_pareto_max:
-                    top_values.append(n_pareto_vals[i, 0])
-            argmax_idx = np.random.choice(top_values)
-
-            ## Graph
-            # ss = [[self.gp[0].predict([x_tries[argmax_idx]], return_std=True)[0],
-            #        self.gp[1].predict([x_tries[argmax_idx]], return_std=True)[0]]]
-            # ss += [sampled_points[argmax_idx]]
-            # self.process_bb.draw_plot_pareto(lim =self.obj_space_lim, sampled_point= ss)
-        x_max = x_tries[argmax_idx]
-        return x_max
+        is_pareto = pareto_sample_mask(f, pareto_set)
+        available = np.ones(n_samples, dtype=bool)
+        selected = []
+        for argmax_idx in range(pending.shape[0]):
+            available[argmax_idx] = False
+            is_pareto = np.logical_and(is_pareto, np.logical_not(dominated_by_sample(f, f[:, argmax_idx, :])))
+        selected = list(range(pending.shape[0]))
+        for _ in range(batch_size):
+            prob = np.random.uniform()
+            if prob > exploration:
+                print("exploration")
+                # TODO: Add heuristic exploration term using std values
+                std = self._std_given_pending(1, x_tries, x_tries[selected])
+                std_max = np.max(std[available])
+                top_values = np.arange(n_samples)[np.logical_and(available, std > std_max * tolerance)]
+                argmax_idx = top_values[np.random.randint(0, top_values.shape[0])]
+            else:
+                acquisition_func = np.sum(is_pareto, axis=1)
+                n_pareto_max = np.max(acquisition_func[available])
+                top_values = np.arange(n_samples)[np.logical_and(available,
+                                                                 acquisition_func > tolerance * n_pareto_max)]
+                if top_values.shape[0] == 0:
+                    # no candidate is Pareto in any sample any more
+                    top_values = np.arange(n_samples)[available]
+                argmax_idx = np.random.choice(top_values)
+
+                ## Graph
+                # ss = [[self.gp[0].predict([x_tries[argmax_idx]], return_std=True)[0],
+                #        self.gp[1].predict([x_tries[argmax_idx]], return_std=True)[0]]]
+                # ss += [f[:, argmax_idx, :]]
+                # self.process_bb.draw_plot_pareto(lim =self.obj_space_lim, sampled_point= ss)
+            selected += [argmax_idx]
+            available[argmax_idx] = False
+            is_pareto = np.logical_and(is_pareto, np.logical_not(dominated_by_sample(f, f[:, argmax_idx, :])))
+        return x_tries[selected[pending.shape[0]:]]
+
+    def _std_given_pending(self, obj, x, pending):
+        '''
+        std of gp[obj] at x after observing the pending designs
+        '''
+        return self._fantasy_gp(obj, pending).predict(self._gp_input(x), return_std=True)[1]
+
+    def _fantasy_gp(self, obj, pending):
+        '''
+        gp[obj] conditioned on the pending designs observed at their full-fidelity predicted mean, with the fitted
+        hyperparameters.
+        the mean is unchanged and the std shrinks around the pending designs. the believed values are taken as exact
+        (up to the smallest alpha), else a noisy design would be picked again and again
+        '''
+        gp = self.gp[obj]
+        if len(pending) == 0:
+            return gp
+        alpha = np.broadcast_to(np.asarray(gp.alpha, dtype=float), (gp.X_train_.shape[0],))
+        fantasy = clone(gp)
+        fantasy.kernel = gp.kernel_
+        fantasy.optimizer = None
+        fantasy.alpha = np.hstack((alpha, np.full(len(pending), min(np.min(alpha), 1e-4))))
+        pending = self._gp_input(pending)
+        fantasy.fit(np.vstack((gp.X_train_, pending)), np.hstack((gp.y_train_, gp.predict(pending))))
+        return fantasy
+
+    def acquisition_EHVI(self, pareto_set, batch_size, pending=None):
+        '''
+        [batch_size, dim] maximizers of the expected hypervolume improvement over the front of pareto_set, exact for the
+        two independent GP posteriors (expected_hypervolume_improvement_2d) with reference point hv_reference.
+        each maximizer is searched by L-BFGS-B from the n_starts best of n_candidates random designs.
+        pending and already picked designs are believed at their predicted mean: they join the front and the GPs are
+        conditioned on them, so the next pick goes where they leave the most expected improvement
+        '''
+        n_candidates = 200
+        n_starts = 5
+        believed = [] if pending is None \
+            else [x for x in np.asarray(pending, dtype=float).reshape(-1, self.dim_design_space)]
+        picked = []
+        for _ in range(batch_size):
+            gps = [self._fantasy_gp(obj, believed) for obj in range(self.num_objectives)]
+            front = np.asarray(pareto_set, dtype=float).reshape(-1, self.num_objectives)
+            if believed:
+                believed_x = self._gp_input(believed)
+                front = np.vstack([front, np.stack([gp.predict(believed_x) for gp in self.gp], axis=1)])
+            front = pareto_front_2d(front)
+
+            def ehvi(x):
+                predictions = [gp.predict(self._gp_input(x), return_std=True) for gp in gps]
+                mu = np.stack([p[0] for p in predictions], axis=1)
+                sigma = np.stack([p[1] for p in predictions], axis=1)
+                return expected_hypervolume_improvement_2d(mu, sigma, front, self.hv_reference)
+
+            x_tries = np.random.uniform(
+                self.bounds[:, 0], self.bounds[:, 1], size=(n_candidates, self.dim_design_space))
+            values = ehvi(x_tries)
+            x_max, value_max = x_tries[np.argmax(values)], np.max(values)
+            for x0 in x_tries[np.argsort(-values)[:n_starts]]:
+                res = minimize(lambda x: -ehvi(x[np.newaxis])[0], x0, method='L-BFGS-B', bounds=self.bounds)
+                if -res.fun > value_max:
+                    x_max, value_max = np.clip(res.x, self.bounds[:, 0], self.bounds[:, 1]), -res.fun
+            print("ehvi %.4g at " % value_max, x_max)
+            picked += [x_max]
+            believed += [x_max]
+        return np.asarray(picked).reshape(-1, self.dim_design_space)
 
     def latin_cube_init(self):
-        samples = lhs(self.dim_design_space,samples= self.num_init_samples,criterion='center')
-        train_ = np.zeros(samples.shape)
+        if self.loop_state is None:
+            samples = lhs(self.dim_design_space,samples= self.num_init_samples,criterion='center')
+            train_ = np.zeros(samples.shape)
 
-        for i in range(self.dim_design_space):
-            loc_ = self.bounds[i, 0]
-            scale_ = self.bounds[i, 1]- self.bounds[i,0]
-            train_[:, i] = uniform.ppf(samples[:, i], loc=loc_, scale= scale_)
-
-        self.design_parameter += train_.tolist()
-        self.train_features = np.vstack((self.train_features, train_))
-
-        parent_idx = -1
-        for idx in range(self.num_init_samples):
-            num_success_, grasp_quality_, mass_ = self.do_experiment(idx)
-            self.num_trials += [self.iter_per_object]
-            self.num_success += [num_success_]
-            self.grasp_quality += [grasp_quality_]
-            self.mass += [mass_]
-            print(mass_)
-            # TODO : post processing grasp_quality values
-            new_label = self.post_processing_per_design(idx)
-            print(new_label)
-            parent_idx = self.process_bb.add_observation(new_label[0], new_label[1], np.average(num_success_))
+            for i in range(self.dim_design_space):
+                loc_ = self.bounds[i, 0]
+                scale_ = self.bounds[i, 1]- self.bounds[i,0]
+                train_[:, i] = uniform.ppf(samples[:, i], loc=loc_, scale= scale_)
+
+            self.design_parameter += train_.tolist()
+            self.train_features = np.vstack((self.train_features, train_))
+            parent_idx = -1
+        else:
+            parent_idx = self.loop_state['parent_idx']
+
+        # resumes after the last evaluated batch of samples
+        for start in range(len(self.num_trials), self.num_init_samples, self.batch_size):
+            indices = list(range(start, min(start + self.batch_size, self.num_init_samples)))
+            self._evaluate_designs(indices)
+            for idx in indices:
+                parent_idx = self._observe_design(idx)
+            self.checkpoint('init', indices[-1], 'evaluated', parent_idx)
 
         while parent_idx != -1:
-            num_success_, grasp_quality_, _ = self.do_experiment(parent_idx)
-            # update data
-            self.num_success[parent_idx] += num_success_
-            for obj_idx in range(self.num_objects):
-                self.grasp_quality[parent_idx][obj_idx] = np.hstack((self.grasp_quality[parent_idx][obj_idx],
-                                                                     grasp_quality_[obj_idx]))
-
-            self.num_trials[parent_idx] += self.iter_per_object
-            new_label = self.post_processing_per_design(parent_idx)
-            parent_idx = self.process_bb.update_observation(new_label[0], new_label[1],
-                                                             np.average(self.num_success[parent_idx]),
-                                                             parent_idx=parent_idx)
+            parent_idx = self._reevaluate_design(parent_idx, verbose=False)
+            self.checkpoint('init', self.num_init_samples - 1, 'evaluated', parent_idx)
 
         """update gaussian process fitting & predict & new candidates"""
-        self.train_labels = (self.process_bb.upper_bounds + self.process_bb.lower_bounds) * 0.5
-        noise = ((self.process_bb.upper_bounds - self.process_bb.lower_bounds) * 0.5 / self.gamma)
-        for obj in range(self.num_objectives):
-            if obj == 1:
-                self.gp[obj].alpha = noise[:, obj]
-            self.gp[obj].fit(self.train_features, self.train_labels[:, obj])
+        self._fit_gp()
 
         #Graph
         # x_set = []
@@ -260,7 +498,216 @@ class optimize_design:
         # self.process_bb.draw_plot_pareto(lim = self.obj_space_lim, add_exact_graph=False)
 
 
+    def _evaluate_designs(self, indices):
+        '''
+        simulate the new designs indices together and append their results; _observe_design adds them to the bounds
+        '''
+        for num_success_, grasp_quality_, mass_, trials_run_ in self.do_experiments(indices):
+            self._add_design(num_success_, grasp_quality_, mass_, trials_run_)
+
+    def _add_design(self, num_success_, grasp_quality_, mass_, trials_run_):
+        # trials simulated per object, fewer than iter_per_object for the objects early_stopping stopped
+        self.num_trials += [np.asarray(trials_run_, dtype=int)]
+        self.num_success += [num_success_]
+        self.grasp_stats.append(grasp_quality_)
+        self.mass += [mass_]
+        print(mass_)
+
+    def _add_low_fidelity(self, d, fidelity, num_success_, grasp_quality_, mass_):
+        '''
+        bounds of a low-fidelity evaluation of design parameters d, used as GP training points only
+        '''
+        lower, upper = self.post_processing(grasp_quality_, mass_)
+        print("low fidelity %d: " % fidelity, d, np.average(num_success_), lower, upper)
+        self.low_fidelity_design = np.vstack((self.low_fidelity_design, d))
+        self.low_fidelity_level = np.hstack((self.low_fidelity_level, fidelity))
+        self.low_fidelity_lower = np.vstack((self.low_fidelity_lower, lower))
+        self.low_fidelity_upper = np.vstack((self.low_fidelity_upper, upper))
+
+    def _submit_low_fidelity(self, designs, fidelities):
+        '''
+        start the low-fidelity evaluations of a batch on the pool; _collect_low_fidelity waits for them
+        '''
+        jobs = []
+        for d, fidelity in zip(designs, fidelities):
+            job_id, mass = self.submit_experiment(d, fidelity=fidelity) if self.pool is not None else (None, None)
+            jobs += [(d, fidelity, job_id, mass)]
+        return jobs
+
+    def _collect_low_fidelity(self, jobs):
+        for d, fidelity, job_id, mass_ in jobs:
+            if job_id is None:
+                num_success_, grasp_quality_, mass_, _ = self.simulate_design(d, fidelity=fidelity)
+            else:
+                num_success_, grasp_quality_ = self.pool.wait(job_id)
+            self._add_low_fidelity(d, fidelity, np.asarray(num_success_), grasp_quality_, mass_)
+
+    def _observe_design(self, idx):
+        '''
+        returns the design to re-evaluate or -1
+        '''
+        # TODO : post processing grasp_quality values
+        new_label = self.post_processing_per_design(idx)
+        print(new_label)
+        return self.process_bb.add_observation(new_label[0], new_label[1], np.average(self.num_success[idx]))
+
+    def _reevaluate_design(self, parent_idx, verbose=True):
+        num_success_, grasp_quality_, _, _ = self.do_experiment(parent_idx, self.next_trial(parent_idx))
+        return self._add_trials(parent_idx, num_success_, grasp_quality_, verbose)
+
+    def next_trial(self, idx):
+        '''
+        first trial of a re-evaluation of design idx: after the last trial of every object, so that no pose of the
+        library is simulated twice on an object even if early_stopping stopped some objects before the others
+        '''
+        return int(np.max(self.num_trials[idx]))
+
+    def _add_trials(self, parent_idx, num_success_, grasp_quality_, verbose=True):
+        '''
+        add the trials of a re-evaluation of design parent_idx; returns the next design to re-evaluate or -1
+        '''
+        self.num_success[parent_idx] += num_success_
+        self.grasp_stats.add_trials(parent_idx, grasp_quality_)
+
+        self.num_trials[parent_idx] = self.num_trials[parent_idx] + self.iter_per_object
+        new_label = self.post_processing_per_design(parent_idx)
+        if verbose:
+            print(new_label)
+        return self.process_bb.update_observation(new_label[0], new_label[1],
+                                                  np.average(self.num_success[parent_idx]),
+                                                  parent_idx=parent_idx)
+
+    def _fit_gp(self):
+        self.train_labels = (self.process_bb.upper_bounds + self.process_bb.lower_bounds) * 0.5
+        noise = ((self.process_bb.upper_bounds - self.process_bb.lower_bounds)*0.5/self.gamma)
+        features = self._gp_input(self.train_features)
+        labels = self.train_labels
+        if self.low_fidelity_level.shape[0] > 0:
+            features = np.vstack((features, self._gp_input(self.low_fidelity_design, self.low_fidelity_level)))
+            labels = np.vstack((labels, (self.low_fidelity_upper + self.low_fidelity_lower) * 0.5))
+            noise = np.vstack((noise, (self.low_fidelity_upper - self.low_fidelity_lower) * 0.5 / self.gamma))
+        for obj in range(self.num_objectives):
+            if obj == 1:
+                self.gp[obj].alpha = noise[:, obj]
+        self.surrogate.fit(features, labels)
+
+    def checkpoint(self, phase, idx, stage, parent_idx=-1, x_max=None, reevaluating=(), fidelity=None):
+        self.loop_state = {'phase': phase, 'idx': int(idx), 'stage': stage, 'parent_idx': int(parent_idx),
+                           'x_max': None if x_max is None else np.asarray(x_max, dtype=float).tolist(),
+                           'reevaluating': [int(parent_idx_) for parent_idx_ in reevaluating],
+                           'fidelity': None if fidelity is None else [int(level) for level in fidelity]}
+        if self.checkpoint_file is not None:
+            self.save_checkpoint(self.checkpoint_file)
+
+    def save_checkpoint(self, file_name):
+        '''
+        arrays of every evaluated design, the Observations bounds, the fitted GP hyperparameters, the numpy RNG
+        state and loop_state in one compressed .npz, written atomically
+        '''
+        num_designs = len(self.num_trials)
+        rng_state = np.random.get_state()
+
+        arrays = dict(design_parameter=np.asarray(self.design_parameter, dtype=float).reshape(-1, self.dim_design_space),
+                      train_features=self.train_features, train_labels=self.train_labels,
+                      num_trials=np.asarray(self.num_trials, dtype=int).reshape(num_designs, self.num_objects),
+                      num_success=np.asarray(self.num_success, dtype=int).reshape(num_designs, self.num_objects),
+                      mass=np.asarray(self.mass, dtype=float),
+                      grasp_stats=self.grasp_stats.array(),
+                      lower_bounds=self.process_bb.lower_bounds, upper_bounds=self.process_bb.upper_bounds,
+                      num_exps=self.process_bb.num_exps,
+                      rng_keys=rng_state[1], rng_pos=np.array(rng_state[2:4]), rng_gauss=np.array(rng_state[4]),
+                      object_list=np.array(self.object_list),
+                      init_args=np.array(json.dumps(self.init_args)), loop_state=np.array(json.dumps(self.loop_state)),
+                      surrogate_num_fits=np.array(self.surrogate.num_fits),
+                      low_fidelity_design=self.low_fidelity_design, low_fidelity_level=self.low_fidelity_level,
+                      low_fidelity_lower=self.low_fidelity_lower, low_fidelity_upper=self.low_fidelity_upper)
+        for obj, gp in enumerate(self.gp):
+            if hasattr(gp, 'kernel_'):
+                arrays['gp%d_theta' % obj] = gp.kernel_.theta
+                arrays['gp%d_alpha' % obj] = np.asarray(gp.alpha, dtype=float)
+                arrays['gp%d_X' % obj] = gp.X_train_
+                arrays['gp%d_y' % obj] = gp.y_train_
+
+        tmp = '%s.%d.tmp' % (file_name, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, file_name)
+
+    @classmethod
+    def load_checkpoint(cls, file_name, **overrides):
+        '''
+        rebuild an optimize_design from save_checkpoint; run() then continues where the checkpoint was written.
+        overrides replace constructor arguments, e.g. num_processes
+        '''
+        data = np.load(file_name)
+        init_args = json.loads(str(data['init_args']))
+        init_args.update(overrides)
+        init_args['bounds'] = np.asarray(init_args['bounds'])
+        init_args['checkpoint_file'] = init_args.get('checkpoint_file') or file_name
+        self = cls(**init_args)
+        self.object_list = [str(f) for f in data['object_list']]
+        self.num_objects = len(self.object_list)
+        self.fidelities = self._fidelity_levels(self.fidelity_options)
+
+        self.design_parameter = data['design_parameter'].tolist()
+        self.train_features = data['train_features']
+        self.train_labels = data['train_labels']
+        num_trials = data['num_trials']
+        if num_trials.ndim == 1:
+            # checkpoints of one trial count per design
+            num_trials = np.repeat(num_trials[:, np.newaxis], self.num_objects, axis=1)
+        self.num_trials = [n for n in num_trials]
+        self.num_success = [n for n in data['num_success']]
+        self.mass = data['mass'].tolist()
+        self.grasp_stats = GraspStatistics(self.num_objects, capacity=max(16, len(self.num_trials)))
+        if 'grasp_stats' in data:
+            for statistics in data['grasp_stats']:
+                self.grasp_stats.append_statistics(statistics)
+        else:
+            # checkpoints of the raw trial arrays
+            offsets = np.hstack(([0], np.cumsum(data['quality_counts'].ravel())))
+            for idx in range(len(self.num_trials)):
+                self.grasp_stats.append([data['quality_values'][:, offsets[k]:offsets[k + 1]]
+                                         for k in range(idx * self.num_objects, (idx + 1) * self.num_objects)])
+
+        self.process_bb.lower_bounds = data['lower_bounds']
+        self.process_bb.upper_bounds = data['upper_bounds']
+        self.process_bb.num_exps = data['num_exps']
+        if 'low_fidelity_level' in data:
+            self.low_fidelity_design = data['low_fidelity_design']
+            self.low_fidelity_level = data['low_fidelity_level']
+            self.low_fidelity_lower = data['low_fidelity_lower']
+            self.low_fidelity_upper = data['low_fidelity_upper']
+        if len(self.process_bb.num_exps) > 0:
+            self.process_bb.is_pareto_BB()
+            self.process_bb.is_overlap_in_dominant()
+
+        # refit on the saved training set with the saved hyperparameters and without optimizing them
+        for obj in range(self.num_objectives):
+            if 'gp%d_theta' % obj in data:
+                self.surrogate.restore(obj, data['gp%d_theta' % obj], data['gp%d_alpha' % obj],
+                                       data['gp%d_X' % obj], data['gp%d_y' % obj])
+        if 'surrogate_num_fits' in data:
+            self.surrogate.num_fits = int(data['surrogate_num_fits'])
+
+        rng_pos = data['rng_pos']
+        np.random.set_state(('MT19937', data['rng_keys'], int(rng_pos[0]), int(rng_pos[1]), float(data['rng_gauss'])))
+        self.loop_state = json.loads(str(data['loop_state']))
+        return self
+
     def run(self):
+        self.pool = GraspWorkerPool(self.world_file_name, self.num_processes, sim_options=self.sim_options,
+                                    result_store=self.result_store, streaming=self.early_stopping is not None)
+        self.pool.start()
+        try:
+            self._run()
+        finally:
+            self.pool.close()
+            self.pool.report()
+            self.surrogate.report()
+            self.pool = None
+
+    def _run(self):
         x_set = []
         for i in range(self.dim_design_space):
             x_i = np.linspace(self.bounds[i, 0], self.bounds[i, 1], 20)
@@ -274,59 +721,100 @@ class optimize_design:
             x_ndim_flatten.append(x_ndim[i].flatten())
         x_ = np.array(x_ndim_flatten).T
 
-        argmax_idx = np.random.randint(1, x_set.shape[1], x_set.shape[0])
-
-        x_max = []
-        if self.init_with_lhs:
-            self.latin_cube_init()
-            pareto_set, _ = self.is_pareto_simple_max()
-            x_max = self.acquisition_MC_random(pareto_set)
-            print("start bayesian opt with first candidate : ",x_max)
+        # designs of the latin cube initialization, not counted in num_designs
+        num_init = self.num_init_samples if self.init_with_lhs else 0
+        state = self.loop_state
+        if state is None or state['phase'] == 'init':
+            x_max = []
+            fidelity = None
+            if self.init_with_lhs:
+                self.latin_cube_init()
+                pareto_set, _ = self.is_pareto_simple_max()
+                x_max = self.propose_designs(pareto_set, min(self.batch_size, self.num_designs))
+                fidelity = self.choose_fidelities(x_max)
+                print("start bayesian opt with first candidate : ",x_max)
+            else:
+                for _ in range(min(self.batch_size, self.num_designs)):
+                    argmax_idx = np.random.randint(1, x_set.shape[1], x_set.shape[0])
+                    x_max += [[x_set[i, argmax_idx[i]] for i in range(self.dim_design_space)]]
+            self.checkpoint('bo', 0, 'candidate', x_max=x_max, fidelity=fidelity)
+            state = self.loop_state
+        print("continue at design %d (%s)" % (state['idx'], state['stage']))
+        if self.asynchronous:
+            self._run_async(state, num_init)
         else:
-            for i in range(self.dim_design_space):
-                x_max += [x_set[i, argmax_idx[i]]]
-
-        for idx in range(self.num_designs):
-            print(" design: ",idx , ": ",  x_max)
-            self.train_features = np.vstack((self.train_features, x_max))
-            self.design_parameter += [x_max]
-            num_success_, grasp_quality_, mass_ = self.do_experiment(-1)
-
-            self.num_trials += [self.iter_per_object]
-            self.num_success += [num_success_]
-            self.grasp_quality += [grasp_quality_]
-            self.mass += [mass_]
-            print(mass_)
-            # TODO : post processing grasp_quality values
-            new_label = self.post_processing_per_design(idx)
-            print(new_label)
-            parent_idx = self.process_bb.add_observation(new_label[0], new_label[1], np.average(num_success_))
-            while parent_idx != -1:
-                num_success_, grasp_quality_, _ = self.do_experiment(parent_idx)
-                self.num_success[parent_idx] += num_success_
-                for obj_idx in range(self.num_objects):
-                    self.grasp_quality[parent_idx][obj_idx] = np.hstack((self.grasp_quality[parent_idx][obj_idx],
-                                                                         grasp_quality_[obj_idx]))
-
-                self.num_trials[parent_idx] += self.iter_per_object
-                new_label = self.post_processing_per_design(parent_idx)
-                print(new_label)
-                parent_idx = self.process_bb.update_observation(new_label[0], new_label[1],
-                                                                 np.average(self.num_success[parent_idx]),
-                                                                 parent_idx=parent_idx)
+            self._run_batches(state, num_init)
+
+        fontsize_title = 10
+        plt.figure(figsize=(5, 6))
+        for func_idx in range(self.num_objectives):
+            function_name = "function " + str(func_idx)
+            plt.subplot(2, 2, func_idx + 1)
+            plt.title(function_name, fontsize=fontsize_title)
+            f_i = self.gp[func_idx].sample_y(self._gp_input(x_))
+            plt.pcolormesh(x_ndim[0], x_ndim[1], f_i.reshape((20, 20)))
+            plt.scatter(np.asarray(self.design_parameter)[:, 0], np.asarray(self.design_parameter)[:, 1], c='g',s=3)
+            plt.colorbar()
+            _, std = self.gp[func_idx].predict(self._gp_input(x_), return_std=True)
+            plt.subplot(2, 2, 3 + func_idx)
+            plt.pcolormesh(x_ndim[0], x_ndim[1], std.reshape((20, 20)))
+            plt.scatter(np.asarray(self.design_parameter)[:, 0], np.asarray(self.design_parameter)[:, 1], c='g',s=3)
+            plt.title(function_name + " std", fontsize=fontsize_title)
+            plt.colorbar()
+
+        self.process_bb.is_pareto_BB()
+        self.process_bb.is_overlap_in_dominant()
+        self.process_bb.draw_plot_pareto(lim=self.obj_space_lim)
+
+    def _run_batches(self, state, num_init):
+        if state['phase'] == 'async':
+            # its x_max and reevaluating are in flight, the synchronous loop would drop them
+            raise RuntimeError("checkpoint of the asynchronous loop, resume it with asynchronous=True")
+        x_max = state['x_max']
+        fidelity = state.get('fidelity')
+        idx = state['idx']
+        while idx < self.num_designs:
+            if state['stage'] == 'candidate':
+                # x_max of a checkpoint without batches is a single design
+                batch = np.atleast_2d(x_max)
+                # the low-fidelity evaluations of the batch run next to its full ones and only train the GPs
+                levels = np.full(batch.shape[0], len(self.fidelities) - 1) if fidelity is None else np.asarray(fidelity)
+                is_low = levels < len(self.fidelities) - 1
+                low_fidelity_jobs = self._submit_low_fidelity(batch[is_low], levels[is_low])
+                batch = batch[np.logical_not(is_low)]
+                for k in range(batch.shape[0]):
+                    print(" design: ", idx + k, ": ", batch[k])
+                first_idx = len(self.design_parameter)
+                self.train_features = np.vstack((self.train_features, batch))
+                self.design_parameter += [x for x in batch]
+                self._evaluate_designs(range(first_idx, first_idx + batch.shape[0]))
+                self._collect_low_fidelity(low_fidelity_jobs)
+                parent_idx = -1
+                self.checkpoint('bo', idx, 'evaluated', parent_idx)
+            else:
+                parent_idx = state['parent_idx']
+            state = {'stage': 'candidate'}
+
+            # the designs of the batch are added one by one, each followed by the re-evaluations it asks for
+            while True:
+                while parent_idx != -1:
+                    parent_idx = self._reevaluate_design(parent_idx)
+                    self.checkpoint('bo', idx, 'evaluated', parent_idx)
+                if len(self.process_bb.num_exps) == len(self.num_trials):
+                    break
+                parent_idx = self._observe_design(len(self.process_bb.num_exps))
+                self.checkpoint('bo', idx, 'evaluated', parent_idx)
+            idx = len(self.design_parameter) - num_init
 
             """update gaussian process fitting & predict & new candidates"""
-            self.train_labels = (self.process_bb.upper_bounds + self.process_bb.lower_bounds) * 0.5
-            noise = ((self.process_bb.upper_bounds - self.process_bb.lower_bounds)*0.5/self.gamma)
-            for obj in range(self.num_objectives):
-                if obj == 1:
-                    self.gp[obj].alpha = noise[:, obj]
-                self.gp[obj].fit(self.train_features, self.train_labels[:, obj])
+            self._fit_gp()
             x_prev = x_max
-            if idx < self.num_designs-1:
+            if idx < self.num_designs:
                 pareto_set, _ = self.is_pareto_simple_max()
-                x_max = self.acquisition_MC_random(pareto_set)
+                x_max = self.propose_designs(pareto_set, min(self.batch_size, self.num_designs - idx))
+                fidelity = self.choose_fidelities(x_max)
                 print("design parameters: ", len(self.design_parameter))
+            self.checkpoint('bo', idx, 'candidate', x_max=x_max, fidelity=fidelity)
 
             ## Draw plot for acquisition function
             # fontsize_title = 10
@@ -353,41 +841,121 @@ class optimize_design:
             #     plt.colorbar()
             # self.process_bb.draw_plot_pareto([[-7., 0], [0, 1]])
 
-        fontsize_title = 10
-        plt.figure(figsize=(5, 6))
-        for func_idx in range(self.num_objectives):
-            function_name = "function " + str(func_idx)
-            plt.subplot(2, 2, func_idx + 1)
-            plt.title(function_name, fontsize=fontsize_title)
-            f_i = self.gp[func_idx].sample_y(x_)
-            plt.pcolormesh(x_ndim[0], x_ndim[1], f_i.reshape((20, 20)))
-            plt.scatter(np.asarray(self.design_parameter)[:, 0], np.asarray(self.design_parameter)[:, 1], c='g',s=3)
-            plt.colorbar()
-            _, std = self.gp[func_idx].predict(x_, return_std=True)
-            plt.subplot(2, 2, 3 + func_idx)
-            plt.pcolormesh(x_ndim[0], x_ndim[1], std.reshape((20, 20)))
-            plt.scatter(np.asarray(self.design_parameter)[:, 0], np.asarray(self.design_parameter)[:, 1], c='g',s=3)
-            plt.title(function_name + " std", fontsize=fontsize_title)
-            plt.colorbar()
+    def _run_async(self, state, num_init):
+        '''
+        keeps batch_size simulations in flight on the worker pool. whenever one finishes, its design is added (or its
+        re-evaluation merged), the GPs are refit and new designs are proposed with the designs still in flight as
+        fantasized points, so a slow design does not hold back the others. designs are numbered in the order they finish.
+        low-fidelity evaluations in flight are not saved in the checkpoint, they are proposed again after a resume
+        '''
+        if self.pool is None:
+            raise RuntimeError("the asynchronous loop needs the worker pool of run()")
+        if state['phase'] == 'bo' and state['stage'] != 'candidate':
+            raise RuntimeError("checkpoint of the synchronous loop, resume it with asynchronous=False")
+        # job_id -> ('design', design parameters, mass), ('reevaluate', parent_idx, None)
+        # or ('low_fidelity', (design parameters, fidelity), mass)
+        jobs = {}
+        x_max = np.asarray(state['x_max'], dtype=float).reshape(-1, self.dim_design_space)
+        for x, fidelity in zip(x_max, state.get('fidelity') or [None] * x_max.shape[0]):
+            self._submit_async(jobs, x, fidelity)
+        for parent_idx in state.get('reevaluating', []):
+            job_id, _ = self.submit_experiment(self.design_parameter[parent_idx], self.next_trial(parent_idx))
+            jobs[job_id] = ('reevaluate', parent_idx, None)
+        if not jobs:
+            # only low-fidelity evaluations were in flight
+            self._refill_async(jobs, num_init)
+
+        while jobs:
+            job_id = self.pool.wait_any(list(jobs))
+            num_success_, grasp_quality_, trials_run_ = self.pool.wait(job_id, return_trials=True)
+            num_success_ = np.asarray(num_success_)
+            kind, value, mass_ = jobs.pop(job_id)
+            print("num_success : ", num_success_)
+            print("grasp_quality: ", grasp_quality_)
+            parent_idx = -1
+            if kind == 'low_fidelity':
+                self._add_low_fidelity(value[0], value[1], num_success_, grasp_quality_, mass_)
+            elif kind == 'design':
+                idx = len(self.design_parameter)
+                print(" design: ", idx - num_init, ": ", value)
+                self.train_features = np.vstack((self.train_features, value))
+                self.design_parameter += [value]
+                self._add_design(num_success_, grasp_quality_, mass_, trials_run_)
+                parent_idx = self._observe_design(idx)
+            else:
+                parent_idx = self._add_trials(value, num_success_, grasp_quality_)
+            # one re-evaluation of a design at a time, its trials follow the ones it already has
+            if parent_idx != -1 and parent_idx not in [job[1] for job in jobs.values() if job[0] == 'reevaluate']:
+                job_id, _ = self.submit_experiment(self.design_parameter[parent_idx], self.next_trial(parent_idx))
+                jobs[job_id] = ('reevaluate', parent_idx, None)
 
-        self.process_bb.is_pareto_BB()
-        self.process_bb.is_overlap_in_dominant()
-        self.process_bb.draw_plot_pareto(lim=self.obj_space_lim)
+            """update gaussian process fitting & predict & new candidates"""
+            self._fit_gp()
+            pending = self._refill_async(jobs, num_init)
+            self.checkpoint('async', len(self.design_parameter) - num_init, 'running', x_max=pending,
+                            reevaluating=[job[1] for job in jobs.values() if job[0] == 'reevaluate'])
+
+    def _refill_async(self, jobs, num_init):
+        '''
+        propose and submit designs until batch_size jobs are in flight; returns the designs in flight
+        '''
+        pending = [job[1] for job in jobs.values() if job[0] == 'design']
+        num_new = min(self.batch_size - len(jobs),
+                      self.num_designs - (len(self.design_parameter) - num_init + len(pending)))
+        if num_new > 0:
+            pareto_set, _ = self.is_pareto_simple_max()
+            xs = self.propose_designs(pareto_set, num_new, pending=pending)
+            num_low = len([job for job in jobs.values() if job[0] == 'low_fidelity'])
+            for x, fidelity in zip(xs, self.choose_fidelities(xs, num_low)):
+                self._submit_async(jobs, x, fidelity)
+            pending = [job[1] for job in jobs.values() if job[0] == 'design']
+            print("design parameters: ", len(self.design_parameter), ", in flight: ", len(jobs))
+        return pending
+
+    def _submit_async(self, jobs, x, fidelity=None):
+        if fidelity is None or fidelity == len(self.fidelities) - 1:
+            job_id, mass = self.submit_experiment(x, early_stopping=True)
+            jobs[job_id] = ('design', x, mass)
+        else:
+            job_id, mass = self.submit_experiment(x, fidelity=fidelity)
+            jobs[job_id] = ('low_fidelity', (x, fidelity), mass)
+
+    def simulation_cost(self):
+        '''
+        simulated trials of the run in full evaluations: every full design and re-evaluation plus the cost of every
+        low-fidelity evaluation
+        '''
+        costs = np.array([level['cost'] for level in self.fidelities])
+        return np.sum(self.num_trials) / float(self.iter_per_object * self.num_objects) \
+            + np.sum(costs[self.low_fidelity_level])
 
     def get_result(self):
         pareto_d = np.asarray(self.design_parameter)[self.process_bb.is_pareto]
         print("pareto design: ", pareto_d)
+        if self.num_objectives == 2:
+            print("hypervolume: ", hypervolume_2d(self.train_labels, self.hv_reference))
+        print("simulation cost: %.2f full evaluations (%d low-fidelity evaluations)"
+              % (self.simulation_cost(), self.low_fidelity_level.shape[0]))
 
 
 if __name__ == '__main__':
-    opt_design = optimize_design(init_with_lhs = False, num_init_samples =10,
-                                 world_file_name='Simulation/box_robot_floating.xml',
-                                 object_file_name='../ObjectNet3D/CAD/off/cup/[0-9][0-9].off',
-                                 iter_per_obj=20, num_objectives=2,
-                                 exps_th=0, gamma=1.96, num_designs=30,
-                                 bounds=np.asarray([[-1.0, 1], [0, 1.]]),
-                                 obj_space_lim = [[-7., 0], [0, 1]],
-                                 show_step=False)
+    # python simple_2d_design.py [--resume optimize_design_checkpoint.npz]
+    checkpoint_file = 'optimize_design_checkpoint.npz'
+    if len(sys.argv) > 2 and sys.argv[1] == '--resume':
+        opt_design = optimize_design.load_checkpoint(sys.argv[2])
+    else:
+        if os.path.exists(checkpoint_file):
+            # a fresh run would overwrite the checkpoint of the interrupted one
+            sys.exit("%s exists: continue it with --resume %s, or move it away to start a new run"
+                     % (checkpoint_file, checkpoint_file))
+        opt_design = optimize_design(init_with_lhs = False, num_init_samples =10,
+                                     world_file_name='Simulation/box_robot_floating.xml',
+                                     object_file_name='../ObjectNet3D/CAD/off/cup/[0-9][0-9].off',
+                                     iter_per_obj=20, num_objectives=2,
+                                     exps_th=0, gamma=1.96, num_designs=30,
+                                     bounds=np.asarray([[-1.0, 1], [0, 1.]]),
+                                     obj_space_lim = [[-7., 0], [0, 1]],
+                                     show_step=False, checkpoint_file=checkpoint_file)
     opt_design.run()
     opt_design.get_result()
     print("---- %s seconds --- " % (time.time() - start_time))
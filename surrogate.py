@@ -0,0 +1,144 @@
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import Matern
+from joblib import Parallel, delayed
+from scipy.optimize import minimize
+import numpy as np
+import time
+
+
+def _optimize_theta(kernel, X, y, alpha, theta0):
+    '''
+    L-BFGS-B search of the log marginal likelihood from theta0, as GaussianProcessRegressor.fit does for one start.
+    returns (theta, log marginal likelihood, seconds)
+    '''
+    start = time.time()
+    gp = GaussianProcessRegressor(kernel=kernel.clone_with_theta(theta0), alpha=alpha, optimizer=None)
+    try:
+        gp.fit(X, y)
+    except np.linalg.LinAlgError:
+        return theta0, -np.inf, time.time() - start
+
+    def obj_func(theta):
+        lml, grad = gp.log_marginal_likelihood(theta, eval_gradient=True)
+        return -lml, -grad
+
+    res = minimize(obj_func, theta0, method='L-BFGS-B', jac=True, bounds=kernel.bounds)
+    return res.x, -res.fun, time.time() - start
+
+
+class SurrogateManager:
+    '''
+    one GP per objective, refit after every design and re-evaluation.
+    a fit starts the hyperparameter search at the theta of the previous fit only; the first fit and every
+    full_restart_every-th fit also start from the initial kernel and n_restarts_optimizer random thetas, like
+    GaussianProcessRegressor(n_restarts_optimizer=...). the searches of every start and objective run in parallel
+    with joblib on n_jobs processes, and the best theta of each objective is refit without optimizer.
+    fit_log holds the timing of every fit.
+    kernel : initial kernel of every GP, Matern(nu=2.5) by default
+    '''
+    def __init__(self, num_objectives, n_restarts_optimizer=25, full_restart_every=10, n_jobs=4, alpha=0.0001,
+                 kernel=None):
+        self.kernel = Matern(nu=2.5) if kernel is None else kernel
+        self.n_restarts_optimizer = n_restarts_optimizer
+        self.full_restart_every = full_restart_every
+        self.n_jobs = n_jobs
+        self.gp = [GaussianProcessRegressor(kernel=self.kernel, alpha=alpha, optimizer=None)
+                   for _ in range(num_objectives)]
+        self.num_fits = 0
+        self.fit_log = []
+
+    def _starting_points(self, gp, full):
+        starts = []
+        if hasattr(gp, 'kernel_'):
+            starts += [gp.kernel_.theta]
+        if full or len(starts) == 0:
+            bounds = self.kernel.bounds
+            starts += [self.kernel.theta]
+            starts += [np.random.uniform(bounds[:, 0], bounds[:, 1]) for _ in range(self.n_restarts_optimizer)]
+        return starts
+
+    def fit(self, X, Y):
+        '''
+        X : [n, dim], Y : [n, num_objectives]; the alpha of every GP is used as it is set
+        '''
+        start = time.time()
+        full = self.num_fits % self.full_restart_every == 0 or not all(hasattr(gp, 'kernel_') for gp in self.gp)
+        tasks = [(obj, theta0) for obj, gp in enumerate(self.gp) for theta0 in self._starting_points(gp, full)]
+        results = Parallel(n_jobs=self.n_jobs)(
+            delayed(_optimize_theta)(self.kernel, X, Y[:, obj], self.gp[obj].alpha, theta0) for obj, theta0 in tasks)
+        search_time = time.time() - start
+
+        lml = []
+        cpu_time = []
+        for obj, gp in enumerate(self.gp):
+            best_theta, best_lml = None, -np.inf
+            cpu_time += [0.]
+            for (obj_, _), (theta, lml_, t) in zip(tasks, results):
+                if obj_ == obj:
+                    cpu_time[obj] += t
+                    if best_theta is None or lml_ > best_lml:
+                        best_theta, best_lml = theta, lml_
+            gp.kernel = self.kernel.clone_with_theta(best_theta)
+            gp.fit(X, Y[:, obj])
+            lml += [gp.log_marginal_likelihood_value_]
+
+        self.fit_log += [{'fit': self.num_fits, 'num_points': X.shape[0], 'full': full, 'num_starts': len(tasks),
+                          'search_time': search_time, 'time': time.time() - start, 'cpu_time': cpu_time,
+                          'log_marginal_likelihood': lml}]
+        print("gp fit %d: %d points, %s, %d starts, %.3f s (search %.3f s, %s s of optimization per objective)"
+              % (self.num_fits, X.shape[0], 'full' if full else 'warm', len(tasks), time.time() - start, search_time,
+                 ', '.join('%.3f' % t for t in cpu_time)))
+        self.num_fits += 1
+
+    def restore(self, obj, theta, alpha, X, y):
+        '''
+        refit GP obj with given hyperparameters, e.g. from a checkpoint; the next fit is warm-started from theta
+        '''
+        gp = self.gp[obj]
+        gp.kernel = self.kernel.clone_with_theta(theta)
+        gp.alpha = alpha
+        gp.fit(X, y)
+
+    def report(self):
+        if len(self.fit_log) == 0:
+            print("surrogate: no fit")
+            return
+        for full in (True, False):
+            times = [log['time'] for log in self.fit_log if log['full'] == full]
+            if times:
+                print("surrogate: %d %s fits, mean %.3f s, max %.3f s"
+                      % (len(times), 'full' if full else 'warm', np.mean(times), np.max(times)))
+
+
+if __name__ == '__main__':
+    # python surrogate.py : the serial GaussianProcessRegressor refit of every iteration against SurrogateManager
+    def objectives(X):
+        return np.vstack((np.sin(3 * X[:, 0]) + X[:, 1] ** 2, np.cos(2 * X[:, 0] * X[:, 1]))).T
+
+    np.random.seed(0)
+    X_all = np.random.uniform(0, 1, size=(80, 2))
+    Y_all = objectives(X_all) + np.random.normal(0, 0.01, size=(80, 2))
+    num_points = range(10, 81, 5)
+
+    serial_time = []
+    serial_lml = []
+    for n in num_points:
+        start = time.time()
+        lml = []
+        for obj in range(2):
+            gp = GaussianProcessRegressor(kernel=Matern(nu=2.5), n_restarts_optimizer=25, alpha=0.0001)
+            gp.fit(X_all[:n], Y_all[:n, obj])
+            lml += [gp.log_marginal_likelihood_value_]
+        serial_time += [time.time() - start]
+        serial_lml += [lml]
+
+    manager = SurrogateManager(2, n_jobs=-1)
+    for n in num_points:
+        manager.fit(X_all[:n], Y_all[:n])
+
+    print("%8s %12s %12s %6s %14s %14s" % ("points", "serial [s]", "manager [s]", "mode", "serial lml", "manager lml"))
+    for n, t, lml, log in zip(num_points, serial_time, serial_lml, manager.fit_log):
+        print("%8d %12.3f %12.3f %6s %14s %14s" % (n, t, log['time'], 'full' if log['full'] else 'warm',
+                                                   '%.1f/%.1f' % tuple(lml),
+                                                   '%.1f/%.1f' % tuple(log['log_marginal_likelihood'])))
+    print("total serial %.3f s, manager %.3f s" % (np.sum(serial_time), np.sum([l['time'] for l in manager.fit_log])))